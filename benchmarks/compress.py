@@ -0,0 +1,158 @@
+'''
+speed and ratio of the LZ77/BLZ codecs against reference tools
+
+    python benchmarks/compress.py [--sizes 1 4] [--naive 64] [--keep DIR]
+
+the data is the code part of a synthetic NDS image (see synth.make_rom);
+every codec runs with numpy (sorted prefixes) and without (hash chains), a
+naive window search (bytes.rfind per length, what a quick Python port does)
+runs on the first `--naive` KB only; reference tools are used when present:
+ndspy (lz10, codeCompression), CUE's blz/lzss and devkitPro's gbalzss, and
+their output is checked with our decoders
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bin_patch_kit import compress  # noqa: E402
+from synth import make_rom  # noqa: E402
+
+
+def naive_lz_parse(data, min_disp, max_disp, max_len=0x12):
+    '''the longest match by searching the window for ever longer prefixes'''
+    refs = []
+    i = 0
+    while i < len(data) - 2:
+        best, best_disp = 0, 0
+        start = max(i - max_disp, 0)
+        for length in range(3, min(max_len, len(data) - i) + 1):
+            found = data.rfind(data[i : i + length], start, i - min_disp + length)
+            if found < 0:
+                break
+            best, best_disp = length, i - found
+        if best:
+            refs.append((i, best, best_disp))
+            i += best
+        else:
+            i += 1
+    return refs
+
+
+def timeit(func, repeat=1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_tool(command, data, directory, output=None):
+    '''run a command line tool on a copy of `data` (in place unless `output`), return what it wrote'''
+    source = os.path.join(directory, 'tool.in')
+    with open(source, 'wb') as fp:
+        fp.write(data)
+    target = os.path.join(directory, 'tool.out') if output else source
+    args = [arg.format(input=source, output=target) for arg in command]
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(target, 'rb') as fp:
+        return fp.read()
+
+
+def reference_cases(directory):
+    '''(codec, name, compress function) of the reference tools found'''
+    cases = []
+    try:
+        import ndspy.codeCompression
+        import ndspy.lz10
+
+        cases.append(('lz77', 'ndspy lz10', ndspy.lz10.compress))
+        cases.append(('blz', 'ndspy codeCompression', ndspy.codeCompression.compress))
+    except ImportError:
+        pass
+    if shutil.which('lzss'):
+        cases.append(('lz77', 'CUE lzss -evn', lambda data: run_tool(['lzss', '-evn', '{input}'], data, directory)))
+    if shutil.which('gbalzss'):
+        cases.append(
+            ('lz77', 'gbalzss', lambda data: run_tool(['gbalzss', 'e', '{input}', '{output}'], data, directory, True))
+        )
+    if shutil.which('blz'):
+        cases.append(('blz', 'CUE blz -en', lambda data: run_tool(['blz', '-en', '{input}'], data, directory)))
+        cases.append(('blz', 'CUE blz -eo', lambda data: run_tool(['blz', '-eo', '{input}'], data, directory)))
+    return cases
+
+
+def make_code(path, size):
+    '''`size` bytes of synthetic code, the code part of an NDS image twice as big'''
+    make_rom(path, 'nds', size=size * 2)
+    with open(path, 'rb') as fp:
+        return fp.read(size)
+
+
+def run(sizes, naive_kb, directory):
+    numpy = compress.np
+    decoders = {'lz77': compress.lz77_decompress, 'blz': compress.blz_decompress}
+    ours = [
+        ('lz77', 'lz77_compress', compress.lz77_compress),
+        ('blz', 'blz_compress', compress.blz_compress),
+    ]
+    references = reference_cases(directory)
+    print(f'{"data":>8} {"codec":<6} {"method":<30} {"compress":>9} {"decomp.":>8} {"ratio":>7} {"ok":>3}')
+    for mb in sizes:
+        path = os.path.join(directory, f'compress_{mb}m.bin')
+        data = make_code(path, mb << 20)
+        cases = []
+        for codec, name, func in ours:
+            if numpy is not None:
+                cases.append((codec, f'{name}, numpy', func, numpy))
+            cases.append((codec, f'{name}, hash chains', func, None))
+        cases.extend((codec, name, func, numpy) for codec, name, func in references)
+        for codec, name, func, np in cases:
+            compress.np = np
+            elapsed, packed = timeit(lambda: func(data))
+            compress.np = numpy
+            try:
+                decoded_in, decoded = timeit(lambda: decoders[codec](packed))
+                ok = bytes(decoded) == data
+            except compress.CompressionError:
+                decoded_in, ok = float('nan'), False
+            ratio = len(packed) / len(data)
+            print(
+                f'{mb:>6}MB {codec:<6} {name:<30} {elapsed:>9.3f} {decoded_in:>8.3f} {ratio:>7.3f} {"yes" if ok else "NO":>3}'
+            )
+    if naive_kb:
+        data = make_code(os.path.join(directory, 'compress_naive.bin'), naive_kb << 10)
+        expected = [ref[:2] for ref in compress.lz_parse(data, 1, 0x1000)]
+        parsers = [('hash chains', compress.lz_parse, None), ('naive rfind', naive_lz_parse, None)]
+        if numpy is not None:
+            parsers.insert(0, ('numpy', compress.lz_parse, numpy))
+        for name, parse, np in parsers:
+            compress.np = np
+            elapsed, refs = timeit(lambda: parse(data, 1, 0x1000))
+            compress.np = numpy
+            ok = [ref[:2] for ref in refs] == expected
+            print(
+                f'{naive_kb:>6}KB {"lz77":<6} {"parse, " + name:<30} {elapsed:>9.3f} {"":>8} {"":>7} {"yes" if ok else "NO":>3}'
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4], help='data sizes in MB')
+    parser.add_argument('--naive', type=int, default=64, help='KB parsed by the naive search too (0: skip)')
+    parser.add_argument('--keep', help='directory for the generated data (kept between runs)')
+    args = parser.parse_args()
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        run(args.sizes, args.naive, args.keep)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(args.sizes, args.naive, directory)
@@ -0,0 +1,91 @@
+'''
+compare the old whole-file regex free-space search with scan_free_space
+
+    python benchmarks/free_space.py [--sizes 32 256] [--keep DIR]
+'''
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bin_patch_kit import space  # noqa: E402
+
+
+def make_image(path, size, seed=0):
+    '''random "code" with scattered 0x00/0xFF runs, the last 30% padded with 0xFF like a GBA cart'''
+    rnd = random.Random(seed)
+    used = size * 7 // 10
+    with open(path, 'wb') as fp:
+        written = 0
+        while written < used:
+            block = bytearray(os.urandom(min(0x100000, used - written)))
+            for _ in range(8):
+                pos = rnd.randrange(len(block))
+                length = rnd.choice([0x40, 0x200, 0x1000, 0x8000])
+                block[pos : pos + length] = bytes([rnd.choice([0x00, 0xFF])]) * len(block[pos : pos + length])
+            fp.write(block)
+            written += len(block)
+        pad = b'\xff' * 0x100000
+        while written < size:
+            fp.write(pad[: size - written])
+            written += min(len(pad), size - written)
+
+
+def old_find_empty_space(name, min_size=0x100, align=0x10):
+    buf = open(name, 'rb').read()
+    spaces = []
+    for m in re.finditer(b'\x00{%d,}' % min_size, buf):
+        pos = (m.start() + align - 1) & (-align)
+        size = (m.end() - pos) & (-align)
+        spaces.append((pos, size))
+    spaces.sort(key=lambda x: x[1], reverse=True)
+    return spaces
+
+
+def timeit(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(sizes, directory):
+    numpy = space.np
+    print(f'{"image":>8} {"method":<28} {"seconds":>8} {"regions":>8}')
+    for mb in sizes:
+        path = os.path.join(directory, f'free_space_{mb}m.bin')
+        if not os.path.exists(path):
+            make_image(path, mb << 20)
+        cases = [('old regex, 0x00', lambda: old_find_empty_space(path))]
+        if numpy is not None:
+            cases.append(('scan numpy, 0x00', lambda: space.scan_free_space(path)))
+            cases.append(('scan numpy, 0x00/0xFF', lambda: space.scan_free_space(path, fill=(0x00, 0xFF))))
+        cases.append(('scan regex, 0x00', lambda: space.scan_free_space(path)))
+        cases.append(('scan regex, 0x00/0xFF', lambda: space.scan_free_space(path, fill=(0x00, 0xFF))))
+        for name, func in cases:
+            space.np = None if name.startswith('scan regex') else numpy
+            elapsed, result = timeit(func)
+            print(f'{mb:>6}MB {name:<28} {elapsed:>8.3f} {len(result):>8}')
+        space.np = numpy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 256], help='image sizes in MB')
+    parser.add_argument('--keep', help='directory for the generated images (kept between runs)')
+    args = parser.parse_args()
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        run(args.sizes, args.keep)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(args.sizes, directory)
@@ -0,0 +1,233 @@
+'''
+patch_rom, find_empty_space, relocate_opcodes and ElfHelper.get_opcodes on
+synthetic GBA/NDS roms (see synth.py) at growing job counts
+
+    python benchmarks/scaling.py [--jobs 10 1000 10000] [--profiles gba nds]
+                                 [--output results.json] [--compare old.json]
+                                 [--workers N] [--keep DIR]
+
+every case runs in its own process so the peak memory (ru_maxrss) is its own,
+the results go to a JSON file:
+
+    {'meta': {'revision', 'python', 'numpy', 'workers'},
+     'results': [{'profile', 'benchmark', 'jobs', 'wall', 'peak_rss_kb', 'phases': {...}}]}
+
+find_empty_space does not depend on the job count, it is run once per profile
+with 'jobs': null; `--compare` prints the wall time ratio against an older file
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import synth  # noqa: E402
+from bin_patch_kit import ArmPatcher, ElfHelper, PatchSession, ThumbPatcher, find_empty_space, patch_rom  # noqa: E402
+from bin_patch_kit import space  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+BENCHMARKS = ['patch_rom', 'find_empty_space', 'relocate_opcodes', 'get_opcodes']
+
+
+def prepare(directory, profile):
+    '''the rom of `profile` in `directory`, generated on first use'''
+    path = os.path.join(directory, f'{profile}.bin')
+    if not os.path.exists(path) or not os.path.exists(path + '.json'):
+        synth.make_rom(path, profile)
+    return path, synth.load_rom_info(path)
+
+
+def hook_sites(info, count):
+    '''`count` (arch, offset) spread evenly over the arm and thumb functions'''
+    sites = [('arm', offset) for offset in info['arm']] + [('thumb', offset) for offset in info['thumb']]
+    if count > len(sites):
+        raise ValueError(f'the {info["profile"]} rom only has {len(sites)} functions')
+    step = len(sites) / count
+    return [sites[int(i * step)] for i in range(count)]
+
+
+def bench_patch_rom(directory, rom_path, info, count, workers):
+    elf_path = os.path.join(directory, f'hooks_{count}.o')
+    synth.write_elf(elf_path, synth.hook_functions(count))
+    phases = {}
+    start = time.perf_counter()
+    regions = space.scan_free_space(rom_path, fill=info['fill'])
+    phases['scan'] = time.perf_counter() - start
+
+    jobs = []
+    for i, (arch, offset) in enumerate(hook_sites(info, count)):
+        jobs.append(
+            {
+                'arch': arch,
+                'type': 'hook_func' if i % 3 else 'hook',
+                'address': offset,
+                'func': f'hook_thumb_{i}' if i & 1 else f'hook_arm_{i}',
+            }
+        )
+    output_path = os.path.join(directory, f'{info["profile"]}_patched.bin')
+    report = patch_rom(rom_path, info['base'], elf_path, list(regions), jobs, output_path=output_path, workers=workers)
+    phases.update(report.timings)
+    return phases
+
+
+def bench_find_empty_space(directory, rom_path, info, count, workers):
+    start = time.perf_counter()
+    find_empty_space(rom_path, fill=info['fill'])
+    return {'scan': time.perf_counter() - start}
+
+
+def bench_relocate_opcodes(directory, rom_path, info, count, workers):
+    '''relocate the first 12 bytes of `count` functions into the free space at the end of the rom'''
+    phases = {}
+    with PatchSession(rom_path, info['base'], use_mmap=False) as session:
+        patchers = {
+            'arm': ArmPatcher(session.buffer, info['base']),
+            'thumb': ThumbPatcher(session.buffer, info['base']),
+        }
+        scratch = info['size'] - 0x100
+        sites = hook_sites(info, count)
+
+        start = time.perf_counter()
+        for arch, offset in sites:
+            patchers[arch].disassemble_detail(offset, 12)
+        phases['decode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        mark = session.buffer.checkpoint()
+        for arch, offset in sites:
+            patchers[arch].relocate_opcodes(12, offset, scratch)
+        session.buffer.rollback(mark)
+        phases['relocate'] = time.perf_counter() - start
+    return phases
+
+
+def bench_get_opcodes(directory, rom_path, info, count, workers):
+    '''cold symbol index, lookups, then the index from the disk cache'''
+    functions = synth.hook_functions(count)
+    elf_path = os.path.join(directory, f'hooks_{count}.o')
+    cache_path = elf_path + '.index'
+    synth.write_elf(elf_path, functions)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    phases = {}
+
+    start = time.perf_counter()
+    elf = ElfHelper(elf_path, cache_path=cache_path)
+    elf.index
+    phases['index'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name, _, _ in functions:
+        elf.get_opcodes(name)
+    phases['lookup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ElfHelper(elf_path, cache_path=cache_path).index
+    phases['cached_index'] = time.perf_counter() - start
+    return phases
+
+
+def run_one(benchmark, directory, profile, count, workers):
+    rom_path, info = prepare(directory, profile)
+    start = time.perf_counter()
+    phases = globals()['bench_' + benchmark](directory, rom_path, info, count, workers)
+    wall = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    return {
+        'profile': profile,
+        'benchmark': benchmark,
+        'jobs': count,
+        'wall': wall,
+        'peak_rss_kb': peak,
+        'phases': phases,
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, directory):
+    results = []
+    print(f'{"profile":<8} {"benchmark":<18} {"jobs":>6} {"seconds":>8} {"peak MB":>8}')
+    for profile in args.profiles:
+        # the roms are generated here, not in the timed children
+        prepare(directory, profile)
+        for benchmark in args.benchmarks:
+            for count in [None] if benchmark == 'find_empty_space' else args.jobs:
+                command = [sys.executable, os.path.abspath(__file__), '--one', benchmark, profile, str(count or 0)]
+                command += ['--keep', directory]
+                if args.workers:
+                    command += ['--workers', str(args.workers)]
+                output = subprocess.check_output(command, text=True)
+                result = json.loads(output.splitlines()[-1])
+                result['jobs'] = count
+                results.append(result)
+                peak = f'{result["peak_rss_kb"] / 1024:.1f}' if result['peak_rss_kb'] else '-'
+                print(f'{profile:<8} {benchmark:<18} {count or "-":>6} {result["wall"]:>8.3f} {peak:>8}')
+
+    meta = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'numpy': space.np is not None,
+        'workers': args.workers,
+    }
+    with open(args.output, 'w') as fp:
+        json.dump({'meta': meta, 'results': results}, fp, indent=2)
+    if args.compare:
+        compare(args.compare, results)
+
+
+def compare(path, results):
+    with open(path) as fp:
+        old = json.load(fp)
+    before = {(r['profile'], r['benchmark'], r['jobs']): r for r in old['results']}
+    print(f'\ncompared with {old["meta"].get("revision")}')
+    print(f'{"profile":<8} {"benchmark":<18} {"jobs":>6} {"before":>8} {"after":>8} {"ratio":>6}')
+    for result in results:
+        previous = before.get((result['profile'], result['benchmark'], result['jobs']))
+        if previous is None:
+            continue
+        ratio = result['wall'] / previous['wall'] if previous['wall'] else float('inf')
+        print(
+            f'{result["profile"]:<8} {result["benchmark"]:<18} {result["jobs"] or "-":>6} '
+            f'{previous["wall"]:>8.3f} {result["wall"]:>8.3f} {ratio:>6.2f}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, nargs='+', default=[10, 1000, 10000], help='job counts')
+    parser.add_argument('--profiles', nargs='+', default=list(synth.PROFILES), choices=list(synth.PROFILES))
+    parser.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--output', default='scaling_results.json', help='JSON file for the results')
+    parser.add_argument('--compare', help='results of an older revision')
+    parser.add_argument('--workers', type=int, help='workers for patch_rom')
+    parser.add_argument('--keep', help='directory for the generated roms (kept between runs)')
+    parser.add_argument('--one', nargs=3, metavar=('BENCHMARK', 'PROFILE', 'JOBS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.one:
+        benchmark, profile, count = args.one
+        print(json.dumps(run_one(benchmark, args.keep, profile, int(count), args.workers)))
+    elif args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        run(args, args.keep)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(args, directory)
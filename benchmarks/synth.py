@@ -0,0 +1,268 @@
+'''
+synthetic roms and hook objects for the benchmarks
+
+make_rom() fills a GBA/NDS sized image with ARM and Thumb functions built
+from a pool of common instructions (prologue/epilogue, data processing,
+loads/stores, literal pool loads, bl calls, conditional branches) and leaves
+fill-byte holes between sections, like a real cart; the function starts are
+the hook sites
+
+write_elf() writes a relocatable ELF32 ARM object with one global function
+symbol per hook function, enough for ElfHelper
+'''
+
+import json
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bin_patch_kit import GBA_BASE, NDS_BASE  # noqa: E402
+from bin_patch_kit.arm import (  # noqa: E402
+    encode_arm_add_pc,
+    encode_arm_branch,
+    encode_arm_ldr_pc,
+    encode_thumb_bl,
+    encode_thumb_branch,
+    encode_thumb_ldr_pc,
+    encode_word,
+)
+
+# name -> (rom base, size, fill byte, share of the image that is code, share of the code in thumb)
+PROFILES = {
+    'gba': (GBA_BASE, 8 << 20, 0xFF, 0.7, 0.7),
+    'nds': (NDS_BASE, 4 << 20, 0x00, 0.5, 0.3),
+}
+
+ARM_POOL = [
+    'mov r0, r1',
+    'mov r3, #0x10',
+    'add r0, r0, #1',
+    'sub r1, r1, r2',
+    'cmp r0, #3',
+    'and r2, r2, #0xff',
+    'orr r3, r3, r1, lsl #2',
+    'eor r1, r1, r0',
+    'mul r2, r0, r1',
+    'lsl r1, r1, #2',
+    'ldr r2, [r0]',
+    'ldr r0, [sp, #8]',
+    'str r0, [r1, #4]',
+    'ldrh r3, [r4, #2]',
+    'strb r1, [r5, #1]',
+    'ldmia r0, {r1, r2}',
+    'stmia r1!, {r2, r3}',
+]
+
+THUMB_POOL = [
+    'movs r0, r1',
+    'movs r3, #0x10',
+    'adds r0, #1',
+    'subs r1, r1, r2',
+    'cmp r0, #3',
+    'lsls r1, r1, #2',
+    'ands r2, r3',
+    'orrs r3, r1',
+    'muls r2, r0',
+    'ldr r2, [r0]',
+    'ldr r0, [sp, #8]',
+    'str r0, [r1, #4]',
+    'ldrh r3, [r4, #2]',
+    'strb r1, [r5, #1]',
+    'mov r8, r1',
+    'add r0, r8',
+]
+
+ARM_PROLOGUE = struct.pack('<I', 0xE92D40F0)  # push {r4-r7, lr}
+ARM_EPILOGUE = struct.pack('<I', 0xE8BD80F0)  # pop {r4-r7, pc}
+THUMB_PROLOGUE = struct.pack('<H', 0xB5F0)  # push {r4-r7, lr}
+THUMB_EPILOGUE = struct.pack('<H', 0xBDF0)  # pop {r4-r7, pc}
+
+CONDS = ['eq', 'ne', 'hs', 'lo', 'mi', 'pl', 'hi', 'ls', 'ge', 'lt', 'gt', 'le']
+
+_pools = {}
+
+
+def instruction_pool(thumb):
+    '''the pool encoded once with keystone'''
+    if thumb not in _pools:
+        import keystone
+
+        ks = keystone.Ks(keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB if thumb else keystone.KS_MODE_ARM)
+        _pools[thumb] = [bytes(ks.asm(asm, 0)[0]) for asm in (THUMB_POOL if thumb else ARM_POOL)]
+    return _pools[thumb]
+
+
+def _function(rnd, rom, pos, base, thumb, callees, length):
+    '''
+    write one function at `pos`, return its end
+    literal loads and forward branches are fixed up once the body is laid out
+    '''
+    pool = instruction_pool(thumb)
+    step = 2 if thumb else 4
+    code = bytearray(THUMB_PROLOGUE if thumb else ARM_PROLOGUE)
+    starts = [0]
+    literals = []
+    branches = []
+    while len(code) < length:
+        starts.append(len(code))
+        kind = rnd.random()
+        if kind < 0.1:
+            literals.append((len(code), rnd.randrange(8), rnd.getrandbits(32)))
+            code += bytes(step)
+        elif kind < 0.18 and callees:
+            here = base + pos + len(code)
+            callee = base + rnd.choice(callees)
+            if thumb:
+                code += encode_thumb_bl(here, callee)
+            else:
+                code += encode_arm_branch(here, callee, link=True)
+        elif kind < 0.28:
+            branches.append((len(code), len(starts) + rnd.randrange(1, 6), rnd.choice(CONDS)))
+            code += bytes(step)
+        elif kind < 0.3 and not thumb:
+            code += encode_arm_add_pc(rnd.randrange(8), rnd.randrange(0, 0x40, 4))
+        else:
+            code += rnd.choice(pool)
+    starts.append(len(code))
+    code += THUMB_EPILOGUE if thumb else ARM_EPILOGUE
+
+    for offset, index, cond in branches:
+        target = starts[min(index, len(starts) - 1)]
+        if thumb:
+            code[offset : offset + 2] = encode_thumb_branch(base + pos + offset, base + pos + target, cond)
+        else:
+            code[offset : offset + 4] = encode_arm_branch(base + pos + offset, base + pos + target, cond)
+
+    while (pos + len(code)) & 3:
+        code += bytes(1)
+    pool_offset = len(code)
+    for i, (offset, rt, value) in enumerate(literals):
+        literal = pool_offset + 4 * i
+        if thumb:
+            code[offset : offset + 2] = encode_thumb_ldr_pc(rt, literal - ((offset + 4) & ~3))
+        else:
+            code[offset : offset + 4] = encode_arm_ldr_pc(literal - (offset + 8), rt)
+        code += encode_word(value)
+
+    rom[pos : pos + len(code)] = code
+    return pos + len(code)
+
+
+def make_rom(path, profile='gba', seed=0, size=None):
+    '''
+    write a synthetic rom, return its description:
+    {'profile', 'base', 'size', 'fill', 'arm': [function offsets], 'thumb': [...], 'holes': [(offset, size)]}
+    the description is also saved next to the rom as `path + '.json'`
+    '''
+    base, default_size, fill, code_share, thumb_share = PROFILES[profile]
+    size = size or default_size
+    rnd = random.Random(seed)
+    rom = bytearray([fill]) * size
+    code_end = int(size * code_share) & ~0xF
+    thumb_start = int(code_end * (1 - thumb_share)) & ~0xF
+    functions = {'arm': [], 'thumb': []}
+    holes = []
+
+    # header: entry branch and some non-fill bytes, like the logo and title of a cart
+    rom[0:4] = encode_arm_branch(base, base + 0x200)
+    rom[4:0xC0] = rnd.randbytes(0xBC)
+    pos = 0x200
+    for arch, end in (('arm', thumb_start), ('thumb', code_end)):
+        thumb = arch == 'thumb'
+        starts = functions[arch]
+        while pos < end - 0x400:
+            if rnd.random() < 0.005:
+                # padding between two objects
+                hole = rnd.choice([0x200, 0x800, 0x2000])
+                holes.append((pos, hole))
+                pos += hole
+                continue
+            starts.append(pos)
+            callees = starts[-64:-1]
+            pos = _function(rnd, rom, pos, base, thumb, callees, rnd.randrange(0x20, 0x100, 4))
+            pos = (pos + 0xF) & ~0xF
+        pos = end
+
+    with open(path, 'wb') as fp:
+        fp.write(rom)
+    info = {
+        'profile': profile,
+        'base': base,
+        'size': size,
+        'fill': fill,
+        'arm': functions['arm'],
+        'thumb': functions['thumb'],
+        'holes': holes,
+    }
+    with open(path + '.json', 'w') as fp:
+        json.dump(info, fp)
+    return info
+
+
+def load_rom_info(path):
+    with open(path + '.json') as fp:
+        return json.load(fp)
+
+
+def hook_functions(count):
+    '''
+    (name, code, thumb) of small hook functions: bump a field of struct Registers
+    and return 0 (hook_func: run the original code)
+    '''
+    arm = [0xE5901000, 0xE2811001, 0xE5801000, 0xE3A00000, 0xE12FFF1E]
+    thumb = [0x6801, 0x3101, 0x6001, 0x2000, 0x4770, 0x46C0]
+    functions = []
+    for i in range(count):
+        field = 4 * (i % 13)
+        if i & 1:
+            words = [thumb[0] | field << 4, thumb[1], thumb[2] | field << 4] + thumb[3:]
+            functions.append((f'hook_thumb_{i}', struct.pack(f'<{len(words)}H', *words), True))
+        else:
+            words = [arm[0] | field, arm[1], arm[2] | field] + arm[3:]
+            functions.append((f'hook_arm_{i}', struct.pack(f'<{len(words)}I', *words), False))
+    return functions
+
+
+def write_elf(path, functions):
+    '''relocatable ELF32 little endian ARM object, one .text section, (name, code, thumb) functions'''
+    text = bytearray()
+    strtab = bytearray(b'\0')
+    symbols = [struct.pack('<IIIBBH', 0, 0, 0, 0, 0, 0)]
+    for name, code, thumb in functions:
+        text += bytes(-len(text) & 3)
+        name_offset = len(strtab)
+        strtab += name.encode() + b'\0'
+        # STB_GLOBAL, STT_FUNC in section 1 (.text)
+        symbols.append(struct.pack('<IIIBBH', name_offset, len(text) | thumb, len(code), 0x12, 0, 1))
+        text += code
+    symtab = b''.join(symbols)
+    shstrtab = b'\0.text\0.symtab\0.strtab\0.shstrtab\0'
+
+    out = bytearray(52)
+    offsets = []
+    for data in (text, symtab, strtab, shstrtab):
+        out += bytes(-len(out) & 3)
+        offsets.append(len(out))
+        out += data
+    out += bytes(-len(out) & 3)
+    section_offset = len(out)
+    # name, type, flags, addr, offset, size, link, info, addralign, entsize
+    headers = [
+        (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        (1, 1, 6, 0, offsets[0], len(text), 0, 0, 4, 0),
+        (7, 2, 0, 0, offsets[1], len(symtab), 3, 1, 4, 16),
+        (15, 3, 0, 0, offsets[2], len(strtab), 0, 0, 1, 0),
+        (23, 3, 0, 0, offsets[3], len(shstrtab), 0, 0, 1, 0),
+    ]
+    for header in headers:
+        out += struct.pack('<10I', *header)
+    ident = b'\x7fELF' + bytes([1, 1, 1]) + bytes(9)
+    # ET_REL, EM_ARM, EABI version 5
+    out[:52] = ident + struct.pack(
+        '<HHIIIIIHHHHHH', 1, 40, 1, 0, 0, section_offset, 0x05000000, 52, 0, 0, 40, len(headers), 4
+    )
+    with open(path, 'wb') as fp:
+        fp.write(out)
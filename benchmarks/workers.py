@@ -0,0 +1,59 @@
+'''
+patch_rom on a synthetic rom (see synth.py) with the hooks generated by a
+growing number of worker processes, the jobs of scaling.py
+
+    python benchmarks/workers.py [--jobs 5000] [--profile gba] [--workers 1 2 4 8]
+                                 [--output results.json] [--keep DIR]
+
+1 worker is the serial path; every run must write the same rom, the speedup
+is the patch phase (PatchReport.timings['patch']) of one worker over N, it
+can only grow while there are free cores (os.cpu_count() is in the output)
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scaling  # noqa: E402
+
+
+def run(args, directory):
+    rom_path, info = scaling.prepare(directory, args.profile)
+    results = []
+    digests = set()
+    print(f'cpus: {os.cpu_count()}')
+    print(f'{"workers":>7} {"patch s":>8} {"wall s":>8} {"speedup":>7}')
+    for workers in args.workers:
+        phases = scaling.bench_patch_rom(directory, rom_path, info, args.jobs, workers)
+        with open(os.path.join(directory, f'{args.profile}_patched.bin'), 'rb') as fp:
+            digests.add(hashlib.sha1(fp.read()).hexdigest())
+        results.append({'workers': workers, 'patch': phases['patch'], 'wall': sum(phases.values())})
+        speedup = results[0]['patch'] / phases['patch']
+        print(f'{workers:>7} {phases["patch"]:>8.3f} {results[-1]["wall"]:>8.3f} {speedup:>7.2f}')
+    if len(digests) != 1:
+        raise SystemExit('the outputs differ between worker counts')
+    if args.output:
+        meta = {'revision': scaling.revision(), 'cpus': os.cpu_count(), 'profile': args.profile, 'jobs': args.jobs}
+        with open(args.output, 'w') as fp:
+            json.dump({'meta': meta, 'results': results}, fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=5000, help='hook jobs')
+    parser.add_argument('--profile', default='gba', choices=list(scaling.synth.PROFILES))
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='worker counts')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--keep', help='directory for the generated rom (kept between runs)')
+    args = parser.parse_args()
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        run(args, args.keep)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(args, directory)
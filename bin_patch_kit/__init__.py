@@ -1,4 +1,18 @@
 from .base import *
 from .arm import *
+from .analysis import *
 from .elf import *
+from .link import *
+from .cache import *
+from .session import *
+from .space import *
+from .report import *
+from .trace import *
+from .manifest import *
+from .patchfile import *
+from .pipeline import *
+from .batch import *
+from .xref import *
+from .compress import *
+from .options import *
 from .utils import *
@@ -0,0 +1,196 @@
+'''
+    python -m bin_patch_kit batch CONFIG [--workers N] [--report REPORT.json] [--verbose]
+    python -m bin_patch_kit apply PATCH ROM [OUTPUT]
+
+batch config (JSON, numbers may be written as "0x..." strings, paths are
+relative to the config file):
+
+    {
+        "code": "build/hooks.elf",
+        "elf_cache": "build/hooks.idx",         (optional)
+        "asm_cache": "build/asm.cache",         (optional)
+        "shared_stubs": true,                   (optional, per rom too)
+        "minimal_save": true,                   (optional, per rom too)
+        "link": true,                           (optional, per rom too, with:)
+        "link_sections": [".rodata*"],
+        "link_symbols": {"DrawText": "0x08012345"},     (per rom)
+        "ram_region": ["0x03007000", "0x800"],          (per rom, for jobs with "ram": true)
+        "ram_init": {"arch": "arm", "address": "0x1c0"},    (per rom)
+        "jobs": [                               (optional, shared by every rom)
+            {"name": "font", "arch": "thumb", "type": "hook", "func": "hooker_font"}
+        ],
+        "roms": {
+            "usa": {
+                "rom": "roms/usa.gba",
+                "base": "0x08000000",
+                "platform": "nds7",             (optional, the memory timings of the cycle estimates)
+                "xrefs": "warn",                (optional, or "refuse", with:)
+                "xref_cache": "out/usa.xref",
+                "xref_regions": [["0x0", "0x7F0000"]],
+                "codec": "arm9",                (optional, a compressed file: "arm9", "blz", "lz77", "lz77_vram")
+                "empty": "0x7F0000",            (or [[address, size], ...], or "auto" with "fill")
+                "addresses": {"font": "0x1234"},    (address of each shared job in this rom)
+                "jobs": [...],                  (jobs of this rom only)
+                "output": "out/usa.gba",        (optional, like the patch_rom arguments:)
+                "patch": "out/usa.ips",
+                "manifest": "out/usa.manifest"
+            }
+        }
+    }
+'''
+
+import argparse
+import json
+import os
+import sys
+
+from .batch import BatchReport, patch_batch
+from .cache import AsmCache
+from .compress import get_codec
+from .patchfile import apply_patch
+from .space import scan_free_space
+
+# config key -> patch_rom argument, for the paths
+PATH_OPTIONS = {
+    'rom': 'rom_path',
+    'output': 'output_path',
+    'patch': 'patch_path',
+    'manifest': 'manifest_path',
+    'xref_cache': 'xref_cache_path',
+}
+
+
+def _int(value):
+    return int(value, 0) if isinstance(value, str) else value
+
+
+def _job(job, address=None):
+    job = dict(job)
+    job.pop('name', None)
+    if address is not None:
+        job['address'] = address
+    job['address'] = _int(job['address'])
+    return job
+
+
+def rom_options(config: dict, rom: dict, directory: str):
+    '''patch_rom arguments of one rom of a batch config, ValueError/KeyError when it is wrong'''
+    options = {}
+    for key, argument in PATH_OPTIONS.items():
+        if rom.get(key):
+            options[argument] = os.path.join(directory, rom[key])
+    if 'rom_path' not in options:
+        raise ValueError('no "rom"')
+    options['rom_base'] = _int(rom['base'])
+
+    jobs = []
+    addresses = rom.get('addresses', {})
+    for job in config.get('jobs', ()):
+        if job['name'] not in addresses:
+            raise KeyError(f"no address for job {job['name']}")
+        jobs.append(_job(job, addresses[job['name']]))
+    jobs.extend(_job(job) for job in rom.get('jobs', ()))
+    options['jobs'] = jobs
+
+    empty = rom.get('empty', 'auto')
+    if empty == 'auto':
+        fill = rom.get('fill', 0x00)
+        fill = [_int(value) for value in fill] if isinstance(fill, list) else _int(fill)
+        if rom.get('codec'):
+            with open(options['rom_path'], 'rb') as fp:
+                decoded = get_codec(rom['codec']).decode(fp.read(), options['rom_base'])
+            empty = list(scan_free_space(decoded, fill=fill))
+        else:
+            empty = list(scan_free_space(options['rom_path'], fill=fill))
+    elif isinstance(empty, list):
+        empty = [(_int(address), _int(size)) for address, size in empty]
+    else:
+        empty = _int(empty)
+    options['empty_address'] = empty
+    if 'align' in rom:
+        options['align'] = _int(rom['align'])
+    for option in ('shared_stubs', 'minimal_save', 'link'):
+        if rom.get(option, config.get(option)):
+            options[option] = True
+    if options.get('link') or any(job.get('ram') for job in jobs):
+        options['link_sections'] = rom.get('link_sections', config.get('link_sections', ()))
+        options['link_symbols'] = {name: _int(address) for name, address in rom.get('link_symbols', {}).items()}
+    if 'ram_region' in rom:
+        options['ram_region'] = tuple(_int(value) for value in rom['ram_region'])
+    if 'ram_init' in rom:
+        options['ram_init'] = _job(rom['ram_init'])
+    if 'platform' in rom:
+        options['platform'] = rom['platform']
+    if 'xrefs' in rom:
+        options['xrefs'] = rom['xrefs']
+    if 'xref_regions' in rom:
+        options['xref_regions'] = [(_int(start), _int(end)) for start, end in rom['xref_regions']]
+    if rom.get('codec'):
+        options['codec'] = rom['codec']
+    return options
+
+
+def batch(args):
+    with open(args.config) as fp:
+        config = json.load(fp)
+    directory = os.path.dirname(os.path.abspath(args.config))
+
+    roms = {}
+    errors = {}
+    for name, rom in config['roms'].items():
+        try:
+            roms[name] = rom_options(config, rom, directory)
+        except (ValueError, KeyError, OSError) as e:
+            errors[name] = {
+                'name': name,
+                'ok': False,
+                'error': f'{type(e).__name__}: {e}',
+                'report': None,
+                'seconds': 0.0,
+            }
+
+    asm_cache = AsmCache(os.path.join(directory, config['asm_cache'])) if config.get('asm_cache') else None
+    elf_cache = os.path.join(directory, config['elf_cache']) if config.get('elf_cache') else None
+    report = patch_batch(
+        os.path.join(directory, config['code']), roms, args.workers, asm_cache=asm_cache, elf_cache_path=elf_cache
+    )
+    summaries = {rom['name']: rom for rom in report.roms}
+    report = BatchReport([errors.get(name) or summaries[name] for name in config['roms']])
+
+    print(report)
+    if args.verbose:
+        for rom in report.failed():
+            print(f"\n{rom['name']}:\n{rom['error']}", file=sys.stderr)
+    if args.report:
+        report.to_json(args.report)
+    return 0 if report.ok else 1
+
+
+def apply(args):
+    apply_patch(args.patch, args.rom, args.output)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bin_patch_kit')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_batch = commands.add_parser('batch', help='patch several roms with one elf')
+    parser_batch.add_argument('config', help='batch config (JSON)')
+    parser_batch.add_argument('--workers', '-j', type=int, help='processes (default: one per cpu)')
+    parser_batch.add_argument('--report', help='write the per rom summary as JSON')
+    parser_batch.add_argument('--verbose', '-v', action='store_true', help='print the traceback of failed roms')
+    parser_batch.set_defaults(func=batch)
+
+    parser_apply = commands.add_parser('apply', help='apply an IPS/BPS patch')
+    parser_apply.add_argument('patch')
+    parser_apply.add_argument('rom')
+    parser_apply.add_argument('output', nargs='?', help='patched copy (default: patch the rom in place)')
+    parser_apply.set_defaults(func=apply)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+from .base import ARCH, ENGINES, CapstoneTable
+
+# struct Registers (include/registers.h, arm): field offset -> register number, cpsr as 16
+REG_SP = 13
+REG_LR = 14
+REG_CPSR = 16
+REGISTERS_FIELDS = {0: REG_CPSR, **{4 + 4 * i: i for i in range(13)}, 56: REG_LR, 60: REG_SP}
+REGISTERS_OFFSETS = {number: offset for offset, number in REGISTERS_FIELDS.items()}
+REGISTERS_SIZE = 64
+# AAPCS, what a function may change without restoring it
+CALLER_SAVED = {0, 1, 2, 3, 12, REG_LR}
+
+CS_REGS = CapstoneTable(
+    lambda arm_const: {
+        **{getattr(arm_const, f'ARM_REG_R{i}'): i for i in range(13)},
+        arm_const.ARM_REG_SP: REG_SP,
+        arm_const.ARM_REG_LR: REG_LR,
+        arm_const.ARM_REG_PC: 15,
+    }
+)
+LOADS = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_LDR,
+        arm_const.ARM_INS_LDRB,
+        arm_const.ARM_INS_LDRH,
+        arm_const.ARM_INS_LDRSB,
+        arm_const.ARM_INS_LDRSH,
+        arm_const.ARM_INS_LDRD,
+    }
+)
+STORES = CapstoneTable(
+    lambda arm_const: {arm_const.ARM_INS_STR, arm_const.ARM_INS_STRB, arm_const.ARM_INS_STRH, arm_const.ARM_INS_STRD}
+)
+# (first offset, step) of the registers of a block transfer of n registers
+MULTIPLE = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_LDM: lambda n: (0, 4 * n),
+        arm_const.ARM_INS_STM: lambda n: (0, 4 * n),
+        arm_const.ARM_INS_LDMIB: lambda n: (4, 4 * n),
+        arm_const.ARM_INS_STMIB: lambda n: (4, 4 * n),
+        arm_const.ARM_INS_LDMDA: lambda n: (-4 * n + 4, -4 * n),
+        arm_const.ARM_INS_STMDA: lambda n: (-4 * n + 4, -4 * n),
+        arm_const.ARM_INS_LDMDB: lambda n: (-4 * n, -4 * n),
+        arm_const.ARM_INS_STMDB: lambda n: (-4 * n, -4 * n),
+    }
+)
+STORE_MULTIPLE = CapstoneTable(
+    lambda arm_const: {arm_const.ARM_INS_STM, arm_const.ARM_INS_STMIB, arm_const.ARM_INS_STMDA, arm_const.ARM_INS_STMDB}
+)
+COMPARES = CapstoneTable(
+    lambda arm_const: {arm_const.ARM_INS_CMP, arm_const.ARM_INS_CMN, arm_const.ARM_INS_TST, arm_const.ARM_INS_TEQ}
+)
+# offsets a pointer to the registers may take before we give up
+MAX_OFFSETS = 8
+
+
+class Unsure(Exception):
+    pass
+
+
+class RegisterUsage:
+    '''
+    what a hook function does to the registers of the hooked code, from
+    analyze_hook_function()
+
+        read        registers whose struct Registers field is read
+        written     registers whose field is written
+        clobbered   caller-saved registers (r0-r3, r12, lr) the function changes
+        flags       the function changes the condition flags
+    '''
+
+    def __init__(self, read=(), written=(), clobbered=(), flags=False):
+        self.read = set(read)
+        self.written = set(written)
+        self.clobbered = set(clobbered)
+        self.flags = flags
+
+    def save(self, hook_type='hook'):
+        '''registers the trampoline of `hook_type` has to put in the frame before the call'''
+        return self.read | self.written | self.restore(hook_type)
+
+    def restore(self, hook_type='hook'):
+        '''
+        registers the trampoline has to load from the frame after the call,
+        r0 and lr are used by the call itself, hook_func compares the result
+        '''
+        regs = self.written | self.clobbered | {0, REG_LR}
+        if self.flags or hook_type == 'hook_func':
+            regs.add(REG_CPSR)
+        return regs - {REG_SP}
+
+    def __repr__(self):
+        return (
+            f'RegisterUsage(read={sorted(self.read)}, written={sorted(self.written)}, '
+            f'clobbered={sorted(self.clobbered)}, flags={self.flags})'
+        )
+
+
+def _decode(code: bytes, arch: ARCH):
+    '''the instructions of a function, without the literal pools its pc-relative loads point to'''
+    from capstone import arm_const
+
+    disassembler = ENGINES.disassembler(arch, detail=True)
+    thumb = arch == ARCH.ARM_THUMB
+    literals = set()
+    insns = []
+    offset = 0
+    while offset < len(code):
+        if offset in literals:
+            offset += 4
+            continue
+        insn = next(disassembler.disasm(code[offset : offset + 4], offset, 1), None)
+        if insn is None:
+            raise Unsure(f'data at +0x{offset:x}')
+        for op in insn.operands:
+            if op.type == arm_const.ARM_OP_MEM and op.mem.base == arm_const.ARM_REG_PC:
+                pc = (offset + 4) & ~3 if thumb else offset + 8
+                literals.add(pc + op.mem.disp)
+        insns.append(insn)
+        offset += insn.size
+    return insns
+
+
+def _fields(offsets):
+    '''field registers touched by word accesses at `offsets`, those outside the struct are not the struct'''
+    return {REGISTERS_FIELDS[offset & ~3] for offset in offsets if 0 <= offset < REGISTERS_SIZE}
+
+
+def analyze_hook_function(code: bytes, arch: ARCH):
+    '''
+    RegisterUsage of a hook function (the bytes from ElfHelper.get_opcodes),
+    None when the code does something the analysis can't follow
+
+    the function gets the struct Registers pointer in r0; every register that
+    may hold it (copies, constant offsets) is tracked over the whole function
+    regardless of the control flow, so the fields found are a superset of the
+    real ones. It gives up (None) when the pointer is stored, used with a
+    register offset or passed on, when regs->sp is written, and when the
+    function calls anything, jumps through a register or touches the cpsr
+    '''
+    from capstone import arm_const
+
+    try:
+        insns = _decode(code, arch)
+        # register -> offsets from the struct it may hold
+        pointers = {0: {0}}
+        read, written = set(), set()
+        for _ in range(MAX_OFFSETS * 2):
+            before = {reg: set(offsets) for reg, offsets in pointers.items()}
+            for insn in insns:
+                _follow(insn, pointers, read, written, len(code))
+            if before == pointers:
+                break
+        else:
+            raise Unsure('pointer offsets do not settle')
+        if REG_SP in written:
+            # moving the stack is left to the full save
+            raise Unsure('writes regs->sp')
+
+        clobbered = set()
+        flags = False
+        for insn in insns:
+            _, regs_write = insn.regs_access()
+            for reg in regs_write:
+                if reg == arm_const.ARM_REG_CPSR:
+                    flags = True
+                elif CS_REGS.get(reg) in CALLER_SAVED:
+                    clobbered.add(CS_REGS[reg])
+            flags |= insn.update_flags
+    except Unsure:
+        return None
+    return RegisterUsage(read, written, clobbered, flags)
+
+
+def _add_offsets(pointers, reg, offsets):
+    known = pointers.setdefault(reg, set())
+    known.update(offsets)
+    if len(known) > MAX_OFFSETS:
+        raise Unsure(f'r{reg} walks through memory')
+
+
+def _follow(insn, pointers, read, written, size):
+    '''one round of the pointer tracking over `insn`, `size` is the size of the function'''
+    import capstone
+    from capstone import arm_const
+
+    ops = insn.operands
+    regs = [CS_REGS.get(op.reg) for op in ops if op.type == arm_const.ARM_OP_REG]
+
+    if insn.group(capstone.CS_GRP_CALL) or insn.id in (arm_const.ARM_INS_SVC, arm_const.ARM_INS_BKPT):
+        raise Unsure('calls')
+    if insn.id in (arm_const.ARM_INS_MRS, arm_const.ARM_INS_MSR):
+        raise Unsure('cpsr')
+    if insn.group(capstone.CS_GRP_JUMP):
+        if ops and ops[-1].type == arm_const.ARM_OP_IMM and not 0 <= ops[-1].imm < size:
+            raise Unsure('jumps out of the function')
+        if insn.id == arm_const.ARM_INS_BX and regs != [REG_LR]:
+            raise Unsure('jumps through a register')
+
+    if insn.id in LOADS or insn.id in STORES:
+        at = next(i for i, op in enumerate(ops) if op.type == arm_const.ARM_OP_MEM)
+        mem = ops[at].mem
+        base = CS_REGS.get(mem.base)
+        data = [CS_REGS.get(op.reg) for op in ops[:at]]
+        if insn.id in STORES and any(reg in pointers for reg in data):
+            raise Unsure('stores the pointer')
+        if base not in pointers:
+            return
+        post = ops[at + 1] if len(ops) > at + 1 else None
+        if mem.index != 0 or post is not None and post.type != arm_const.ARM_OP_IMM:
+            raise Unsure('register offset from the pointer')
+        offsets = {offset + mem.disp + 4 * k for offset in pointers[base] for k in range(len(data))}
+        (read if insn.id in LOADS else written).update(_fields(offsets))
+        if insn.writeback:
+            step = mem.disp if post is None else -post.imm if post.subtracted else post.imm
+            _add_offsets(pointers, base, {offset + step for offset in pointers[base]})
+        return
+
+    if insn.id in (arm_const.ARM_INS_PUSH, arm_const.ARM_INS_POP):
+        # saving and restoring registers, the pointer comes back where it was;
+        # a pushed pointer could be loaded back from the stack into any register
+        if insn.id == arm_const.ARM_INS_PUSH and any(reg in pointers for reg in regs):
+            raise Unsure('stores the pointer')
+        return
+    if insn.id in MULTIPLE:
+        base, listed = regs[0], regs[1:]
+        is_store = insn.id in STORE_MULTIPLE
+        if is_store and any(reg in pointers for reg in listed):
+            raise Unsure('stores the pointer')
+        if base == REG_SP:
+            return
+        if base not in pointers:
+            return
+        first, step = MULTIPLE[insn.id](len(listed))
+        offsets = {offset + first + 4 * k for offset in pointers[base] for k in range(len(listed))}
+        (written if is_store else read).update(_fields(offsets))
+        if insn.writeback:
+            _add_offsets(pointers, base, {offset + step for offset in pointers[base]})
+        return
+
+    regs_read, _ = insn.regs_access()
+    sources = {CS_REGS.get(reg) for reg in regs_read} & pointers.keys()
+    if not sources or insn.id in COMPARES:
+        return
+    shifted = any(op.shift.type != arm_const.ARM_SFT_INVALID for op in ops)
+    dst = regs[0] if ops and ops[0].type == arm_const.ARM_OP_REG else None
+    if dst is None or dst == 15 or shifted:
+        raise Unsure('arithmetic on the pointer')
+    if insn.id == arm_const.ARM_INS_MOV and len(ops) == 2 and ops[1].type == arm_const.ARM_OP_REG:
+        _add_offsets(pointers, dst, pointers[regs[1]])
+        return
+    if insn.id in (arm_const.ARM_INS_ADD, arm_const.ARM_INS_SUB) and ops[-1].type == arm_const.ARM_OP_IMM:
+        # add rd, rn, #imm or the two operands thumb form add rd, #imm
+        src = regs[1] if len(ops) == 3 else dst
+        if src in pointers:
+            imm = ops[-1].imm if insn.id == arm_const.ARM_INS_ADD else -ops[-1].imm
+            _add_offsets(pointers, dst, {offset + imm for offset in pointers[src]})
+            return
+    raise Unsure('arithmetic on the pointer')
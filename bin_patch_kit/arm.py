@@ -1,4 +1,7 @@
 from .base import *
+from .analysis import REG_CPSR, REG_SP, REGISTERS_OFFSETS, REGISTERS_SIZE, analyze_hook_function
+from .cycles import count_cycles
+import io
 from struct import pack
 import re
 
@@ -27,15 +30,187 @@ def ALIGN_UP(size, align):
     return (size + align - 1) & ~(align - 1)
 
 
+# native encodings of the fixed forms the patchers emit, so the trampolines don't
+# go through keystone; `src`/`dst` are absolute addresses like keystone's `#0x...`
+COND_CODES = {
+    'eq': 0x0,
+    'ne': 0x1,
+    'cs': 0x2,
+    'hs': 0x2,
+    'cc': 0x3,
+    'lo': 0x3,
+    'mi': 0x4,
+    'pl': 0x5,
+    'vs': 0x6,
+    'vc': 0x7,
+    'hi': 0x8,
+    'ls': 0x9,
+    'ge': 0xA,
+    'lt': 0xB,
+    'gt': 0xC,
+    'le': 0xD,
+    'al': 0xE,
+    '': 0xE,
+}
+
+REG_LR = 14
+REG_PC = 15
+ARM_NOP = pack('<I', 0xE1A00000)  # mov r0, r0
+THUMB_NOP = pack('<H', 0x46C0)  # mov r8, r8
+# push {r0, r1}; ldr r0, [pc, #4]; str r0, [sp, #4]; pop {r0, pc}
+THUMB_FAR_JUMP = pack('<4H', 0xB403, 0x4801, 0x9001, 0xBD01)
+# push {r0, r1}; mov r0, pc; adds r0, #imm; mov lr, r0; ldr r0, [pc, #4]; str r0, [sp, #4]; pop {r0, pc}
+THUMB_FAR_CALL = (0xB403, 0x4678, 0x3000, 0x4686, 0x4801, 0x9001, 0xBD01)
+# the start of a hook entry calling a shared stub, lr goes below sp leaving a word for regs->sp
+ARM_SHARED_ENTRY = pack('<I', 0xE52DE008)  # str lr, [sp, #-8]!
+THUMB_SHARED_ENTRY = pack('<2H', 0xB081, 0xB500)  # sub sp, #4; push {lr}
+
+
+def _branch_offset(offset, low, high, name):
+    if not low <= offset <= high:
+        raise ValueError(f'{name} offset {offset:#x} out of range [{low:#x}, {high:#x}]')
+    return offset
+
+
+def encode_word(value):
+    return pack('<I', value & 0xFFFFFFFF)
+
+
+def encode_arm_branch(src, dst, cond='al', link=False):
+    '''b<cond>/bl<cond> #dst at src, +-32M'''
+    offset = _branch_offset(dst - (src + 8), -0x2000000, 0x1FFFFFC, 'arm b')
+    if offset & 3:
+        raise ValueError(f'arm b target 0x{dst:x} is not 4 aligned')
+    return pack('<I', COND_CODES[cond] << 28 | 0x0A000000 | link << 24 | (offset >> 2) & 0xFFFFFF)
+
+
+def encode_arm_blx(src, dst):
+    '''blx #dst at src, to thumb code, +-32M'''
+    offset = _branch_offset(dst - (src + 8), -0x2000000, 0x1FFFFFE, 'arm blx')
+    if offset & 1:
+        raise ValueError(f'arm blx target 0x{dst:x} is not 2 aligned')
+    return pack('<I', 0xFA000000 | (offset >> 1 & 1) << 24 | (offset >> 2) & 0xFFFFFF)
+
+
+def encode_arm_ldr_pc(imm, rt=REG_PC):
+    '''ldr rt, [pc, #imm]'''
+    _branch_offset(imm, -0xFFF, 0xFFF, 'ldr pc')
+    return pack('<I', 0xE51F0000 | (imm >= 0) << 23 | rt << 12 | abs(imm))
+
+
+# ldr<kind> rt, [rn]
+ARM_LOADS = {'ldr': 0xE5900000, 'ldrb': 0xE5D00000, 'ldrh': 0xE1D000B0, 'ldrsb': 0xE1D000D0, 'ldrsh': 0xE1D000F0}
+THUMB_LOADS = {'ldr': 0x6800, 'ldrb': 0x7800, 'ldrh': 0x8800}
+
+
+def encode_arm_load(kind, rt, rn):
+    return pack('<I', ARM_LOADS[kind] | rn << 16 | rt << 12)
+
+
+def encode_arm_add_pc(rd, imm):
+    '''add rd, pc, #imm, only the unrotated immediates'''
+    _branch_offset(imm, 0, 0xFF, 'add pc')
+    return pack('<I', 0xE28F0000 | rd << 12 | imm)
+
+
+def encode_thumb_branch(src, dst, cond='al'):
+    '''
+    b<cond> #dst at src, the 16 bits form when it reaches, else the thumb-2 32 bits one
+    keystone (llvm) relaxes to the wide form 4 bytes before the narrow limit,
+    that is kept so that the output doesn't change
+    '''
+    offset = dst - (src + 4)
+    if offset & 1:
+        raise ValueError(f'thumb b target 0x{dst:x} is not 2 aligned')
+    code = COND_CODES[cond]
+    if code == 0xE:
+        if -0x800 <= offset <= 0x7FA:
+            return pack('<H', 0xE000 | (offset >> 1) & 0x7FF)
+        offset = _branch_offset(offset, -0x1000000, 0xFFFFFE, 'thumb b.w')
+        s = offset >> 24 & 1
+        j1 = (~(offset >> 23) ^ s) & 1
+        j2 = (~(offset >> 22) ^ s) & 1
+        return pack('<HH', 0xF000 | s << 10 | offset >> 12 & 0x3FF, 0x9000 | j1 << 13 | j2 << 11 | offset >> 1 & 0x7FF)
+    if -0x100 <= offset <= 0xFA:
+        return pack('<H', 0xD000 | code << 8 | (offset >> 1) & 0xFF)
+    offset = _branch_offset(offset, -0x100000, 0xFFFFE, f'thumb b{cond}.w')
+    s = offset >> 20 & 1
+    j1 = offset >> 18 & 1
+    j2 = offset >> 19 & 1
+    return pack(
+        '<HH', 0xF000 | s << 10 | code << 6 | offset >> 12 & 0x3F, 0x8000 | j1 << 13 | j2 << 11 | offset >> 1 & 0x7FF
+    )
+
+
+def encode_thumb_bl(src, dst):
+    '''bl #dst at src, +-16M, same bits as the thumb-1 bl pair within +-4M'''
+    offset = _branch_offset(dst - (src + 4), -0x1000000, 0xFFFFFE, 'thumb bl')
+    if offset & 1:
+        raise ValueError(f'thumb bl target 0x{dst:x} is not 2 aligned')
+    s = offset >> 24 & 1
+    j1 = (~(offset >> 23) ^ s) & 1
+    j2 = (~(offset >> 22) ^ s) & 1
+    return pack('<HH', 0xF000 | s << 10 | offset >> 12 & 0x3FF, 0xD000 | j1 << 13 | j2 << 11 | offset >> 1 & 0x7FF)
+
+
+def encode_thumb_blx(src, dst):
+    '''blx #dst at src, to arm code, +-16M from the aligned pc, the thumb-1 pair within +-4M'''
+    offset = _branch_offset(dst - ALIGN_4(src + 4), -0x1000000, 0xFFFFFC, 'thumb blx')
+    if offset & 3:
+        raise ValueError(f'thumb blx target 0x{dst:x} is not 4 aligned')
+    s = offset >> 24 & 1
+    j1 = (~(offset >> 23) ^ s) & 1
+    j2 = (~(offset >> 22) ^ s) & 1
+    return pack('<HH', 0xF000 | s << 10 | offset >> 12 & 0x3FF, 0xC000 | j1 << 13 | j2 << 11 | offset >> 1 & 0x7FE)
+
+
+def encode_thumb_far_call(src):
+    '''THUMB_FAR_CALL at src, lr gets the thumb address past the literal (and the nop aligning it)'''
+    pad = 0 if TEST_ALIGN_4(src + 14) else 2
+    # mov r0, pc reads src + 6
+    return pack('<7H', *THUMB_FAR_CALL[:2], THUMB_FAR_CALL[2] | 13 + pad, *THUMB_FAR_CALL[3:])
+
+
+def encode_thumb_cbz(src, dst, rn, nonzero=False):
+    '''cbz/cbnz rn, #dst at src, forward only'''
+    offset = _branch_offset(dst - (src + 4), 0, 0x7E, 'cbz')
+    return pack('<H', 0xB100 | nonzero << 11 | (offset >> 6) << 9 | (offset >> 1 & 0x1F) << 3 | rn)
+
+
+def encode_thumb_ldr_pc(rt, imm):
+    '''ldr rt, [pc, #imm], 16 bits, r0-r7'''
+    _branch_offset(imm, 0, 0x3FC, 'ldr pc')
+    return pack('<H', 0x4800 | rt << 8 | imm >> 2)
+
+
+def encode_thumb_load(kind, rt, rn):
+    return pack('<H', THUMB_LOADS[kind] | rn << 3 | rt)
+
+
+def encode_thumb2_ldr_pc(imm):
+    '''ldr.w pc, [pc, #imm]'''
+    _branch_offset(imm, -0xFFF, 0xFFF, 'ldr.w pc')
+    return pack('<HH', 0xF85F | (imm >= 0) << 7, 0xF000 | abs(imm))
+
+
+def encode_thumb2_add_pc(rd, imm):
+    '''addw rd, pc, #imm'''
+    _branch_offset(imm, 0, 0xFFF, 'addw pc')
+    return pack('<HH', 0xF20F | (imm >> 11) << 10, (imm >> 8 & 7) << 12 | rd << 8 | imm & 0xFF)
+
+
 class ArmPatcher(Patcher):
-    def __init__(self, io, base):
-        super().__init__(io, base, ArchMode(ARCH.ARM))
+    def __init__(self, io, base, asm_cache=None, tracer=None):
+        super().__init__(io, base, ArchMode(ARCH.ARM), asm_cache, tracer)
 
     def nop_patch(self, size, address=None):
-        length = 0
-        for i in range(size):
-            length += self.assemble('mov r0, r0', address)
-        return length
+        return self.emit(ARM_NOP * size, address)
+
+    def emit_word(self, value, address=None):
+        '''a literal'''
+        address = self.seek(address)
+        self._data[address] = 4
+        return self.emit(encode_word(value), address, f'.word 0x{value:08x}')
 
     def push_all_regs(self, address=None):
         return self.assemble(
@@ -45,8 +220,76 @@ class ArmPatcher(Patcher):
     def pop_all_regs(self, address=None):
         return self.assemble('pop {r0};' 'msr cpsr, r0;' 'pop {r0-r12, lr};' 'add sp, #4;', address)
 
+    @staticmethod
+    def _low_regs(low):
+        return 'r0' if low == 0 else f'r0-r{low}'
+
+    @staticmethod
+    def _block_end(regs, last, single):
+        '''
+        rN of the r0-rN block transfer push_regs/pop_regs use for the registers up
+        to `last`, a register in the block costs one cycle, one after it a single
+        str/ldr of `single` cycles
+        '''
+        low = [reg for reg in regs if reg <= last]
+        return min(low, key=lambda end: (end + single * sum(reg > end for reg in low), -end))
+
+    def push_regs(self, regs, address=None):
+        '''
+        the struct Registers frame of push_all_regs with only the fields of `regs`
+        (register numbers, analysis.REG_CPSR for the cpsr) filled in, r0 must be one of them
+        '''
+        end = self._block_end(regs, 12, 2)
+        asm = [f'sub sp, #{REGISTERS_SIZE};', f'stmib sp, {{{self._low_regs(end)}}};']
+        for reg in sorted(reg for reg in regs if end < reg <= REG_LR):
+            name = 'lr' if reg == REG_LR else f'r{reg}'
+            asm.append(f'str {name}, [sp, #{REGISTERS_OFFSETS[reg]}];')
+        if REG_SP in regs:
+            asm.append(f'add r0, sp, #{REGISTERS_SIZE};' f'str r0, [sp, #{REGISTERS_OFFSETS[REG_SP]}];')
+        if REG_CPSR in regs:
+            asm.append('mrs r0, cpsr;' 'str r0, [sp];')
+        return self.assemble(''.join(asm), address)
+
+    def pop_regs(self, regs, address=None):
+        '''load `regs` back from the frame of push_regs and drop it'''
+        end = self._block_end(regs, 12, 3)
+        asm = []
+        if REG_CPSR in regs:
+            asm.append('ldr r0, [sp];' 'msr cpsr, r0;')
+        for reg in sorted(reg for reg in regs if end < reg <= REG_LR):
+            name = 'lr' if reg == REG_LR else f'r{reg}'
+            asm.append(f'ldr {name}, [sp, #{REGISTERS_OFFSETS[reg]}];')
+        asm.append(f'ldmib sp, {{{self._low_regs(end)}}};' f'add sp, #{REGISTERS_SIZE};')
+        return self.assemble(''.join(asm), address)
+
+    def hook_usage(self, function_codes):
+        '''
+        the RegisterUsage of a hook function when its trampoline saves only what
+        the function uses (`minimal_save`), None for the full save
+        '''
+        if not self.minimal_save:
+            return None
+        key = bytes(function_codes)
+        if key not in self._usage_cache:
+            start = perf_counter()
+            self._usage_cache[key] = analyze_hook_function(key, self._arch_mode.arch)
+            if self._tracer is not None:
+                self._tracer.elapsed(self._name, 'capstone', start)
+        return self._usage_cache[key]
+
+    def _save_regs(self, hook_type, usage, address=None):
+        if usage is None:
+            return self.push_all_regs(address)
+        return self.push_regs(usage.save(hook_type), address)
+
+    def _restore_regs(self, hook_type, usage, address=None):
+        if usage is None:
+            return self.pop_all_regs(address)
+        return self.pop_regs(usage.restore(hook_type), address)
+
     def _in_range(self, addr1, addr2):
-        return abs(addr1 - addr2) < 0x2000000
+        # b/bl reach pc+8-32M .. pc+8+32M-4
+        return abs(addr1 - addr2) < 0x1FFFFFC
 
     def _get_jmp_patch_size(self, dst_address, address):
         return 4 if self._in_range(dst_address, address) else 8
@@ -56,68 +299,244 @@ class ArmPatcher(Patcher):
         length = 0
         if self._in_range(dst_address, address):
             # jump range is in 32M
-            length = self.assemble(f'b #0x{self._base+dst_address:x}')
+            length = self.emit(encode_arm_branch(self._base + address, self._base + dst_address))
         else:
-            length = self.assemble('ldr pc, [pc, #-4]')
-            self._io.write(pack('<I', self._base + dst_address))
-            length += 4
+            length = self.emit(encode_arm_ldr_pc(-4))
+            length += self.emit_word(self._base + dst_address)
         return length
 
-    def call_patch(self, dst_address, address=None):
+    def branch_patch(self, dst_address, cond='al', address=None):
+        address = self.seek(address)
+        return self.emit(encode_arm_branch(self._base + address, self._base + dst_address, cond))
+
+    def call_patch(self, dst_address, address=None, exchange=False):
+        '''bl (blx to thumb code with `exchange`) dst_address, through a literal when out of range'''
         address = self.seek(address)
         length = 0
         if self._in_range(address, dst_address):
-            length = self.assemble(f'bl #0x{self._base+dst_address:x}')
+            if exchange:
+                length = self.emit(encode_arm_blx(self._base + address, self._base + dst_address))
+            else:
+                length = self.emit(encode_arm_branch(self._base + address, self._base + dst_address, link=True))
         else:
-            length = self.assemble('add lr, pc, #4;' 'ldr pc, [pc, #-4];', address)
-            self._io.write(pack('<I', self._base + dst_address))
-            length += 4
+            length = self.emit(encode_arm_add_pc(REG_LR, 4) + encode_arm_ldr_pc(-4))
+            # ldr pc interworks where there is a blx (armv5), bit 0 for thumb
+            length += self.emit_word(self._base + dst_address | exchange)
         return length
 
-    def set_hooker(self, target_address: int, empty_address: int, function_codes: bytes):
+    # a bl from a hook entry reaches its shared stub this far
+    CALL_RANGE = 0x1FFFFF0
+
+    # [sp] = lr of the hook, [sp + 4] = room for regs->sp, lr = address of the function's address
+    SHARED_STUB = (
+        'push {{r0-r12}};'
+        'add r0, sp, #60;'
+        'str r0, [sp, #56];'  # regs->sp
+        'mrs r0, cpsr;'
+        'push {{r0}};'
+        'mov r4, lr;'
+        'ldr r1, [r4], #4;'  # r4 = return address
+        'mov r0, sp;'
+        'mov lr, pc;'
+        'bx r1;'
+        '{check}'
+        'str r4, [sp, #60];'
+        'pop {{r0}};'
+        'msr cpsr, r0;'
+        'pop {{r0-r12, lr}};'
+        'pop {{pc}};'
+    )
+    # hook_func, return to regs->lr when the function returns non zero
+    SHARED_STUB_CHECK = 'cmp r0, #0;' 'ldrne r4, [sp, #56];'
+
+    def _code_address(self, address):
+        '''what a bx to code at `address` takes'''
+        return self._base + address
+
+    def emit_shared_stub(self, hook_type, address=None):
+        '''
+        the register save/restore every hook of `hook_type` would inline, as one
+        piece of code their entries call once it is registered with add_shared_stub
+        (see _set_shared_hooker); return its size
+        '''
+        check = self.SHARED_STUB_CHECK if hook_type == 'hook_func' else ''
+        return self.assemble(self.SHARED_STUB.format(check=check), address)
+
+    def add_shared_stub(self, hook_type, address):
+        self._shared_stubs.setdefault(hook_type, []).append(address)
+
+    def shared_stub(self, hook_type, address, reach=None):
+        '''the closest shared stub of `hook_type` within `reach` (a bl by default) of `address`, or None'''
+        reach = reach or self.CALL_RANGE
+        best = None
+        for stub in self._shared_stubs.get(hook_type, ()):
+            if abs(stub - address) < reach and (best is None or abs(stub - address) < abs(best - address)):
+                best = stub
+        return best
+
+    def _shared_entry(self, stub, address=None):
+        '''str lr, [sp, #-8]!; bl stub; .word 0, return (length, address of the word)'''
+        address = self.seek(address)
+        length = self.emit(ARM_SHARED_ENTRY + encode_arm_branch(self._base + address + 4, self._base + stub, link=True))
+        literal = address + length
+        return length + self.emit_word(0), literal
+
+    def _set_shared_hooker(
+        self, hook_type, stub, target_address: int, empty_address: int, function_codes: bytes, function_address=None
+    ):
+        '''
+        target                          empty space
+        +----------------------+        +--------------------------+
+        | jmp empty            | ---->  | save lr                  |        shared stub
+        | ...                  | <---+  | call stub                | -----> push all regs, call [lr]
+        |                      |     |  | .word function           | <----- pop all regs, return past the word
+        |                      |     |  | run old instructions     |
+        |                      |     +- | jmp back                 |
+        |                      |        | function                 |
+        +----------------------+        +--------------------------+
+        '''
+        self._data = {}
         size = self._get_jmp_patch_size(target_address, empty_address)
+        _, literal = self._shared_entry(stub, empty_address)
+        self.relocate_opcodes(size, target_address)
+        self.jump_patch(self.relocated[1])
+        back = self._io.tell()
+
+        func_addr = function_address
+        if func_addr is None:
+            func_addr = self._io.tell()
+            self.emit(function_codes)
+        size = self._io.tell() - empty_address
+        self.emit_word(self._code_address(func_addr), literal)
 
-        self.push_all_regs(empty_address)
+        jump = self.jump_patch(empty_address, target_address)
+        self.record_path(
+            [
+                (target_address, target_address + jump),
+                (empty_address, back),
+                (stub, stub + self.shared_stub_size(hook_type)),
+            ]
+        )
+        return size
+
+    def shared_stub_size(self, hook_type):
+        if hook_type not in self._stub_sizes:
+            scratch = type(self)(io.BytesIO(bytes(0x200)), self._base, self._asm_cache)
+            self._stub_sizes[hook_type] = scratch.emit_shared_stub(hook_type, 0x100)
+        return self._stub_sizes[hook_type]
+
+    def shared_stub_cost(self, hook_type):
+        '''
+        bytes and cycles of the register save/restore of one hook of `hook_type`,
+        inlined or through a shared stub, measured on a scratch buffer:
+            {'inline_size', 'entry_size', 'stub_size', 'inline_cycles', 'shared_cycles'}
+        cycles are count_cycles() totals (1 cycle memory) of the path taken when
+        the hook function returns 0, without the function itself
+        '''
+        scratch = type(self)(io.BytesIO(bytes(0x400)), self._base, self._asm_cache)
+        start, stub, far = 0x100, 0x200, 0x300
+        scratch.push_all_regs(start)
+        scratch.assemble('mov r0, sp')
+        scratch.call_patch(far)
+        runs = [(start, scratch._io.tell())]
+        if hook_type == 'hook_func':
+            scratch.assemble('cmp r0, 0')
+            scratch.branch_patch(far, 'eq')
+            runs.append((runs[0][1], scratch._io.tell()))
+            scratch.pop_all_regs()
+            scratch.assemble('mov pc, lr')
+        pop_start = scratch._io.tell()
+        inline_size = scratch.pop_all_regs() + pop_start - start
+        runs.append((pop_start, start + inline_size))
+
+        entry_size, literal = scratch._shared_entry(stub, far)
+        stub_size = scratch.emit_shared_stub(hook_type, stub)
+        code = scratch._io.getvalue()
+
+        def cycles(ranges):
+            arch = self._arch_mode.arch
+            return sum(sum(count_cycles(code[s:e], arch, self._base + s)) for s, e in ranges)
+
+        return {
+            'inline_size': inline_size,
+            'entry_size': entry_size,
+            'stub_size': stub_size,
+            'inline_cycles': cycles(runs),
+            'shared_cycles': cycles([(far, literal), (stub, stub + stub_size)]),
+        }
+
+    def set_hooker(self, target_address: int, empty_address: int, function_codes: bytes, function_address=None):
+        usage = self.hook_usage(function_codes)
+        stub = self.shared_stub('hook', empty_address) if usage is None else None
+        if stub is not None:
+            return self._set_shared_hooker(
+                'hook', stub, target_address, empty_address, function_codes, function_address
+            )
+        self._data = {}
+        size = self._get_jmp_patch_size(target_address, empty_address)
+
+        self._save_regs('hook', usage, empty_address)
         self.assemble('mov r0, sp')
         call_addr = self._io.tell()
-        self.call_patch(self._io.tell() + 0x10)  # we'll rewrite it later
-        self.pop_all_regs()
+        # we'll rewrite it later unless the function was linked
+        self.call_patch(self._io.tell() + 0x10 if function_address is None else function_address)
+        self._restore_regs('hook', usage)
         self.relocate_opcodes(size, target_address)
-        self.jump_patch(target_address + size)
+        # back past the last instruction moved, which may end after the jump (a bl under a 2 bytes b)
+        self.jump_patch(self.relocated[1])
+        back = self._io.tell()
 
-        func_addr = self._io.tell()
-        self._io.write(function_codes)
+        func_addr = function_address
+        if func_addr is None:
+            func_addr = self._io.tell()
+            self.emit(function_codes)
         size = self._io.tell() - empty_address
         self.call_patch(func_addr, call_addr)
 
-        self.jump_patch(empty_address, target_address)
+        jump = self.jump_patch(empty_address, target_address)
+        self.record_path([(target_address, target_address + jump), (empty_address, back)])
         return size
 
-    def set_function_hooker(self, target_address: int, empty_address: int, function_codes: bytes):
+    def set_function_hooker(
+        self, target_address: int, empty_address: int, function_codes: bytes, function_address=None
+    ):
+        usage = self.hook_usage(function_codes)
+        stub = self.shared_stub('hook_func', empty_address) if usage is None else None
+        if stub is not None:
+            return self._set_shared_hooker(
+                'hook_func', stub, target_address, empty_address, function_codes, function_address
+            )
+        self._data = {}
         size = self._get_jmp_patch_size(target_address, empty_address)
-        self.push_all_regs(empty_address)
+        self._save_regs('hook_func', usage, empty_address)
         self.assemble('mov r0, sp')
         call_addr = self._io.tell()
-        self.call_patch(self._io.tell() + 0x10)  # we'll rewrite it later
-        # print('%x' % self._io.tell())
-        # if 'Thumb' in type(self).__name__:
-        #     self.assemble(f'cbz r0, #0x{self._io.tell()+0x10:08x}')
-        # else:
+        # we'll rewrite it later unless the function was linked
+        self.call_patch(self._io.tell() + 0x10 if function_address is None else function_address)
         self.assemble('cmp r0, 0')
-        self.assemble(f'beq #0x{self._base+self._io.tell()+0x1c:08x}')
-        self.pop_all_regs()
+        branch_addr = self._io.tell()
+        self.branch_patch(branch_addr + 0x10, 'eq')  # we'll rewrite it later
+        branch_end = self._io.tell()
+        self._restore_regs('hook_func', usage)
         self.assemble('mov pc, lr')
-        self.pop_all_regs()
+        continue_addr = self._io.tell()
+        self.branch_patch(continue_addr, 'eq', branch_addr)
+        self._restore_regs('hook_func', usage, continue_addr)
         self.relocate_opcodes(size, target_address)
 
-        self.jump_patch(target_address + size)
+        self.jump_patch(self.relocated[1])
+        back = self._io.tell()
 
-        func_addr = self._io.tell()
-        self._io.write(function_codes)
+        func_addr = function_address
+        if func_addr is None:
+            func_addr = self._io.tell()
+            self.emit(function_codes)
         size = self._io.tell() - empty_address
         self.call_patch(func_addr, call_addr)
 
-        self.jump_patch(empty_address, target_address)
+        jump = self.jump_patch(empty_address, target_address)
+        # the function returned 0, the relocated instructions run
+        self.record_path([(target_address, target_address + jump), (empty_address, branch_end), (continue_addr, back)])
         return size
 
     PC_RE = re.compile(r'(.*,.*)pc(.*)')
@@ -136,7 +555,8 @@ class ArmPatcher(Patcher):
                 header = m.group(1)
                 tail = m.group(2)
 
-                if self._arch_mode == ARCH.ARM_THUMB:
+                is_thumb = self._arch_mode.arch == ARCH.ARM_THUMB
+                if is_thumb:
                     pc = CLEAR_BIT0(src_address) + 4
                     if '[' in instr:
                         pc = ALIGN_4(pc)
@@ -145,20 +565,19 @@ class ArmPatcher(Patcher):
 
                 reg = find_empty_register(instr)
 
-                adjust1, adjust2 = (4, 6) if self._arch_mode == ARCH.ARM_THUMB else (8, 8)
+                adjust1, insn_size = (4, 2) if is_thumb else (8, 4)
+
+                self.seek(dst_address)
 
-                if self._arch_mode == ARCH.ARM_THUMB and TEST_ALIGN_4(dst_address):
+                if is_thumb and TEST_ALIGN_4(dst_address):
                     length = self.nop_patch(1, dst_address)
 
                 length += self.assemble(
-                    f'push {{ {reg} }};'
-                    f'ldr {reg}, [pc, #{adjust1}];'
-                    f'{header}{reg}{tail};'
-                    f'pop {{ {reg} }};'
-                    f'b #0x{self._base+self._io.tell()+ adjust2:x};'
+                    f'push {{ {reg} }};' f'ldr {reg}, [pc, #{adjust1}];' f'{header}{reg}{tail};' f'pop {{ {reg} }};'
                 )
-                self._io.write(pack('I', self._base + pc))
-                length += 4
+                # over the literal
+                length += self.branch_patch(self._io.tell() + insn_size + 4)
+                length += self.emit_word(self._base + pc)
 
         return length
 
@@ -173,22 +592,25 @@ class ArmPatcher(Patcher):
             cmd = m.group(1)
             reg = m.group(2)
             digitstr = m.group(3)
-            addr = int(digitstr, 16)
+            addr = int(digitstr, 16) - self._base
             if cmd in ('bl', 'blx'):
-                length = self.call_patch(addr, dst_address)
+                length = self.call_patch(addr, dst_address, cmd == 'blx')
             elif cmd in ('b', 'bx'):
                 length = self.jump_patch(addr, dst_address)
             elif cmd in ('cbz', 'cbnz'):
                 adjust1, adjust2 = (4, 0xA) if self._arch_mode.arch == ARCH.ARM_THUMB else (8, 0xC)
                 length = self.assemble(f'{cmd} {reg} #0x{self._base+dst_address+adjust1:08x}', dst_address)
-                length += self.assemble(f'b #0x{self._base+dst_address+length+adjust2:08x}')
-                length += self.jump_patch(addr - self._base)
+                length += self.branch_patch(dst_address + length + adjust2)
+                length += self.jump_patch(addr)
             else:
                 # conditional jmp
                 adjust1, adjust2 = (4, 0xE) if self._arch_mode.arch == ARCH.ARM_THUMB else (8, 0xC)
-                length = self.assemble(f'{cmd} #0x{self._base+dst_address+adjust1:08x}', dst_address)
-                length += self.assemble(f'b #0x{self._base+dst_address+length+adjust2:08x}')
-                length += self.jump_patch(addr - self._base)
+                if cmd[1:] in COND_CODES:
+                    length = self.branch_patch(dst_address + adjust1, cmd[1:], dst_address)
+                else:
+                    length = self.assemble(f'{cmd} #0x{self._base+dst_address+adjust1:08x}', dst_address)
+                length += self.branch_patch(dst_address + length + adjust2)
+                length += self.jump_patch(addr)
 
         return length
 
@@ -203,49 +625,337 @@ class ArmPatcher(Patcher):
 
         return length
 
+    # capstone operands -> register numbers and condition names
+    REG_NUMBERS = CapstoneTable(
+        lambda arm_const: {
+            **{getattr(arm_const, f'ARM_REG_R{i}'): i for i in range(13)},
+            arm_const.ARM_REG_SP: 13,
+            arm_const.ARM_REG_LR: REG_LR,
+            arm_const.ARM_REG_PC: REG_PC,
+        }
+    )
+    CS_CONDS = CapstoneTable(
+        lambda arm_const: {
+            getattr(arm_const, f'ARM_CC_{cond.upper()}'): cond
+            for cond in ('eq', 'ne', 'hs', 'lo', 'mi', 'pl', 'vs', 'vc', 'hi', 'ls', 'ge', 'lt', 'gt', 'le', 'al')
+        }
+    )
+    CS_LOADS = CapstoneTable(
+        lambda arm_const: {
+            arm_const.ARM_INS_LDR: 'ldr',
+            arm_const.ARM_INS_LDRB: 'ldrb',
+            arm_const.ARM_INS_LDRH: 'ldrh',
+            arm_const.ARM_INS_LDRSB: 'ldrsb',
+            arm_const.ARM_INS_LDRSH: 'ldrsh',
+        }
+    )
+    # the short branch emitted by branch_patch in _branch_around
+    SHORT_BRANCH_SIZE = 4
+
+    def _pc_value(self, src_address, aligned=False):
+        return self._base + src_address + 8
+
+    def _encode_branch(self, src_address, dst_address, cond='al'):
+        return encode_arm_branch(self._base + src_address, self._base + dst_address, cond)
+
+    @staticmethod
+    def _reads_pc(insn):
+        from capstone import CS_AC_READ, arm_const
+
+        if insn.id == arm_const.ARM_INS_ADR:
+            return True
+        for op in insn.operands:
+            if op.type == arm_const.ARM_OP_REG and op.reg == arm_const.ARM_REG_PC and op.access & CS_AC_READ:
+                return True
+            if op.type == arm_const.ARM_OP_MEM and arm_const.ARM_REG_PC in (op.mem.base, op.mem.index):
+                return True
+        return False
+
+    def _relocate_insn(self, insn, src_address, dst_address):
+        '''
+        relocate one instruction from its capstone details: immediate branches are
+        re-targeted, pc-relative loads and pc values become literal loads, the
+        rest does not depend on where it runs and is copied as it is
+        '''
+        from capstone import CS_GRP_CALL, CS_GRP_JUMP, arm_const
+
+        length = 0
+        if insn.group(CS_GRP_JUMP) or insn.group(CS_GRP_CALL):
+            if insn.operands and insn.operands[-1].type == arm_const.ARM_OP_IMM:
+                length = self._relocate_branch(insn, dst_address)
+            elif not self._reads_pc(insn):
+                # bx lr, pop {pc} ...
+                return self.emit(bytes(insn.bytes), dst_address)
+        elif not self._reads_pc(insn):
+            return self.emit(bytes(insn.bytes), dst_address)
+        else:
+            length = self._relocate_pc_value(insn, src_address, dst_address)
+
+        if length == 0:
+            # forms not rewritten here (conditional calls, stores to pc-relative addresses, jump tables ...)
+            length = self._fix_opstr(f'{insn.mnemonic} {insn.op_str}', src_address, dst_address)
+        return length
+
+    def _relocate_branch(self, insn, dst_address):
+        from capstone import arm_const
+
+        target = insn.operands[-1].imm - self._base
+        cond = self.CS_CONDS.get(insn.cc, 'al')
+        if insn.id in (arm_const.ARM_INS_BL, arm_const.ARM_INS_BLX):
+            # blx #imm switches to the other instruction set
+            exchange = insn.id == arm_const.ARM_INS_BLX
+            return self.call_patch(target, dst_address, exchange) if cond == 'al' else 0
+        if insn.id in (arm_const.ARM_INS_CBZ, arm_const.ARM_INS_CBNZ):
+            rn = self.REG_NUMBERS[insn.operands[0].reg]
+            nonzero = insn.id == arm_const.ARM_INS_CBNZ
+            return self._branch_around(
+                lambda at, to: encode_thumb_cbz(self._base + at, self._base + to, rn, nonzero), target, dst_address
+            )
+        if insn.id == arm_const.ARM_INS_B:
+            if cond == 'al':
+                return self.jump_patch(target, dst_address)
+            return self._branch_around(lambda at, to: self._encode_branch(at, to, cond), target, dst_address)
+        return 0
+
+    def _branch_around(self, encode_first, target, dst_address):
+        '''
+        a conditional branch reaching `target` from anywhere:
+            first condition, TAKEN      ; encode_first(address, TAKEN)
+            b NEXT
+        TAKEN:
+            jump_patch target
+        NEXT:
+        '''
+        size = self.SHORT_BRANCH_SIZE
+        length = self.emit(encode_first(dst_address, dst_address + 2 * size), dst_address)
+        over_address = dst_address + length
+        length += size
+        length += self.jump_patch(target, dst_address + length)
+        self.branch_patch(dst_address + length, address=over_address)
+        self.seek(dst_address + length)
+        return length
+
+    def _relocate_pc_value(self, insn, src_address, dst_address):
+        '''rd = value computed from pc, or rt = [pc + disp], as a literal load, 0 when not one of them'''
+        from capstone import arm_const
+
+        ops = insn.operands
+        if insn.cc not in (arm_const.ARM_CC_AL, arm_const.ARM_CC_INVALID) or insn.update_flags or insn.writeback:
+            return 0
+        if len(ops) < 2 or ops[0].type != arm_const.ARM_OP_REG or ops[0].reg == arm_const.ARM_REG_PC:
+            return 0
+        rd = self.REG_NUMBERS.get(ops[0].reg)
+        if rd is None:
+            return 0
+
+        def is_pc(op):
+            return op.type == arm_const.ARM_OP_REG and op.reg == arm_const.ARM_REG_PC
+
+        if len(ops) == 2 and ops[1].type == arm_const.ARM_OP_MEM:
+            mem = ops[1].mem
+            load = self.CS_LOADS.get(insn.id)
+            if load is None or mem.base != arm_const.ARM_REG_PC or mem.index != 0:
+                return 0
+            return self._load_literal(rd, self._pc_value(src_address, aligned=True) + mem.disp, load, dst_address)
+
+        if insn.id == arm_const.ARM_INS_ADR and len(ops) == 2 and ops[1].type == arm_const.ARM_OP_IMM:
+            value = self._pc_value(src_address, aligned=True) + ops[1].imm
+        elif insn.id == arm_const.ARM_INS_MOV and len(ops) == 2 and is_pc(ops[1]):
+            value = self._pc_value(src_address)
+        elif (
+            insn.id in (arm_const.ARM_INS_ADD, arm_const.ARM_INS_ADDW, arm_const.ARM_INS_SUB, arm_const.ARM_INS_SUBW)
+            and len(ops) == 3
+            and is_pc(ops[1])
+            and ops[2].type == arm_const.ARM_OP_IMM
+        ):
+            imm = ops[2].imm
+            if insn.id in (arm_const.ARM_INS_SUB, arm_const.ARM_INS_SUBW):
+                imm = -imm
+            value = self._pc_value(src_address, aligned=True) + imm
+        else:
+            return 0
+        return self._load_literal(rd, value, None, dst_address)
+
+    def _load_literal(self, rt, value, load=None, address=None):
+        '''
+        rt = value, or rt = [value] with `load` (ldr/ldrb/ldrh/ldrsb/ldrsh)
+            ldr rt, [pc, #LITERAL]
+            ldr<load> rt, [rt]
+            b NEXT
+        LITERAL:
+            .word value
+        NEXT:
+        return the length, 0 if rt can't be loaded this way
+        '''
+        address = self.seek(address)
+        code = [encode_arm_ldr_pc(4 if load else 0, rt)]
+        if load:
+            code.append(encode_arm_load(load, rt, rt))
+        branch_address = address + 4 * len(code)
+        code.append(self._encode_branch(branch_address, branch_address + 8))
+        return self.emit(b''.join(code)) + self.emit_word(value)
+
 
 class Thumb2Patcher(ArmPatcher):
     # support 32bits thumb instructions
-    def __init__(self, io, base):
-        super(ArmPatcher, self).__init__(io, base, ArchMode(ARCH.ARM_THUMB))
+    def __init__(self, io, base, asm_cache=None, tracer=None):
+        super(ArmPatcher, self).__init__(io, base, ArchMode(ARCH.ARM_THUMB), asm_cache, tracer)
 
     def _in_range(self, addr1, addr2):
-        return abs(addr1 - addr2) < 0x1000000
+        # b.w/bl reach pc+4-16M .. pc+4+16M-2
+        return abs(addr1 - addr2) < 0xFFFFFC
 
     def nop_patch(self, size, address=None):
-        length = 0
-        for i in range(size):
-            length += self.assemble('mov r8, r8', address)
-        return length
+        return self.emit(THUMB_NOP * size, address)
+
+    def branch_patch(self, dst_address, cond='al', address=None):
+        address = self.seek(address)
+        return self.emit(encode_thumb_branch(self._base + address, self._base + dst_address, cond))
+
+    def push_regs(self, regs, address=None):
+        # 16 bits forms but mrs, r8-r12 and lr go through r0 once it is saved
+        end = self._block_end(regs, 7, 2)
+        asm = [
+            f'sub sp, #{REGISTERS_SIZE - REGISTERS_OFFSETS[end + 1]};'
+            f'push {{{self._low_regs(end)}}};'
+            'sub sp, #4;'  # cpsr
+        ]
+        for reg in sorted(reg for reg in regs if end < reg <= 7):
+            asm.append(f'str r{reg}, [sp, #{REGISTERS_OFFSETS[reg]}];')
+        for reg in sorted(reg for reg in regs if 8 <= reg <= REG_LR):
+            name = 'lr' if reg == REG_LR else f'r{reg}'
+            asm.append(f'mov r0, {name};' f'str r0, [sp, #{REGISTERS_OFFSETS[reg]}];')
+        if REG_SP in regs:
+            asm.append(f'add r0, sp, #{REGISTERS_SIZE};' f'str r0, [sp, #{REGISTERS_OFFSETS[REG_SP]}];')
+        if REG_CPSR in regs:
+            asm.append('mrs r0, cpsr;' 'str r0, [sp];')
+        return self.assemble(''.join(asm), address)
+
+    def pop_regs(self, regs, address=None):
+        end = self._block_end(regs, 7, 3)
+        asm = []
+        for reg in sorted(reg for reg in regs if 8 <= reg <= REG_LR):
+            name = 'lr' if reg == REG_LR else f'r{reg}'
+            asm.append(f'ldr r0, [sp, #{REGISTERS_OFFSETS[reg]}];' f'mov {name}, r0;')
+        if REG_CPSR in regs:
+            asm.append('ldr r0, [sp];' 'msr cpsr, r0;')
+        for reg in sorted(reg for reg in regs if end < reg <= 7):
+            asm.append(f'ldr r{reg}, [sp, #{REGISTERS_OFFSETS[reg]}];')
+        asm.append(
+            'add sp, #4;' f'pop {{{self._low_regs(end)}}};' f'add sp, #{REGISTERS_SIZE - REGISTERS_OFFSETS[end + 1]};'
+        )
+        return self.assemble(''.join(asm), address)
+
+    SHORT_BRANCH_SIZE = 2
+
+    CALL_RANGE = 0xFFFFF0
+
+    # thumb-1 only, r12 is saved too; the cpsr slot is left as it is
+    SHARED_STUB = (
+        'sub sp, #20;'  # r8-r12
+        'push {{r0-r7}};'
+        'mov r0, r8;'
+        'mov r1, r9;'
+        'mov r2, r10;'
+        'mov r3, r11;'
+        'mov r4, r12;'
+        'add r5, sp, #32;'
+        'stmia r5!, {{r0-r4}};'
+        'add r0, sp, #60;'
+        'str r0, [sp, #56];'  # regs->sp
+        'sub sp, #4;'  # skip cpsr
+        'mov r4, lr;'
+        'subs r4, #1;'
+        'ldmia r4!, {{r1}};'  # r4 = return address
+        'adds r4, #1;'
+        'mov r0, sp;'
+        'bl call;'
+        '{check}'
+        'str r4, [sp, #60];'
+        'ldr r0, [sp, #56];'
+        'mov lr, r0;'
+        'add r5, sp, #36;'
+        'ldmia r5!, {{r0-r4}};'
+        'mov r8, r0;'
+        'mov r9, r1;'
+        'mov r10, r2;'
+        'mov r11, r3;'
+        'mov r12, r4;'
+        'add sp, #4;'
+        'pop {{r0-r7}};'
+        'add sp, #24;'
+        'pop {{pc}};'
+        'call: bx r1;'
+    )
+    SHARED_STUB_CHECK = 'cmp r0, #0;' 'beq keep;' 'ldr r4, [sp, #56];' 'keep:'
+
+    def _code_address(self, address):
+        return self._base + SET_BIT0(address)
+
+    def _shared_entry(self, stub, address=None):
+        '''[nop]; sub sp, #4; push {lr}; bl stub; .word 0 (aligned), return (length, address of the word)'''
+        address = self.seek(address)
+        length = self.nop_patch(1) if address & 2 else 0
+        length += self.emit(THUMB_SHARED_ENTRY)
+        length += self.emit(encode_thumb_bl(self._base + self._io.tell(), self._base + stub))
+        literal = self._io.tell()
+        return length + self.emit_word(0), literal
+
+    def _pc_value(self, src_address, aligned=False):
+        pc = self._base + CLEAR_BIT0(src_address) + 4
+        return ALIGN_4(pc) if aligned else pc
+
+    def _encode_branch(self, src_address, dst_address, cond='al'):
+        return encode_thumb_branch(self._base + src_address, self._base + dst_address, cond)
+
+    def _load_literal(self, rt, value, load=None, address=None):
+        # 16 bits forms only, so it works on thumb-1 too
+        if rt > 7 or (load is not None and load not in THUMB_LOADS):
+            return 0
+        address = self.seek(address)
+        code = [b'']
+        if load:
+            code.append(encode_thumb_load(load, rt, rt))
+        branch_address = address + 2 * len(code)
+        literal = ALIGN_UP(branch_address + 2, 4)
+        code[0] = encode_thumb_ldr_pc(rt, literal - ALIGN_4(address + 4))
+        code.append(self._encode_branch(branch_address, literal + 4))
+        code.append(THUMB_NOP * ((literal - branch_address - 2) // 2))
+        return self.emit(b''.join(code)) + self.emit_word(value)
 
     def jump_patch(self, dst_address, address=None):
         address = self.seek(address)
         length = 0
         if self._in_range(address, dst_address):
-            length = self.assemble(f'b #0x{self._base+dst_address:x}')
+            length = self.branch_patch(dst_address)
         else:
-            length = self.assemble(f'ldr.w pc, [pc, #{address&2:x}];')
-            self._io.write(pack('<I', self._base + dst_address))
-            length += 4
+            length = self.emit(encode_thumb2_ldr_pc(address & 2))
+            # ldr pc interworks, stay in thumb
+            length += self.emit_word(self._base + SET_BIT0(dst_address))
         return length
 
-    def call_patch(self, dst_address, address=None):
+    def call_patch(self, dst_address, address=None, exchange=False):
         address = self.seek(address)
         length = 0
         if self._in_range(address, dst_address):
-            length = self.assemble(f'bl #0x{self._base+dst_address:x}')
+            encode = encode_thumb_blx if exchange else encode_thumb_bl
+            length = self.emit(encode(self._base + address, self._base + dst_address))
         else:
+            # lr = the thumb address after the literal
             align4 = address & 2
-            length = self.assemble(f'add lr, pc, #{align4+9:x}')
-            length += self.assemble(f'ldr.w pc, [pc, #{align4:x}]')
-            self._io.write(pack('I', self._base + CLEAR_BIT0(dst_address)))
-            length += 4
+            length = self.emit(encode_thumb2_add_pc(REG_LR, align4 + 9) + encode_thumb2_ldr_pc(align4))
+            # ldr pc interworks, the thumb bit unless it goes to arm code
+            length += self.emit_word(self._base + (dst_address if exchange else SET_BIT0(dst_address)))
         return length
 
 
 class ThumbPatcher(Thumb2Patcher):
+    # the thumb-1 bl pair
+    CALL_RANGE = 0x3FFFF0
+
     def _in_range(self, addr1, addr2):
-        return abs(addr1 - addr2) < 0x800
+        # 16 bits b reaches pc+4-2K .. pc+4+2K-2
+        return abs(addr1 - addr2) < 0x7FE
 
     def push_all_regs(self, address=None):
         # return self.assemble('sub sp, 0x1c;'  # skip r8-r15
@@ -283,6 +993,13 @@ class ThumbPatcher(Thumb2Patcher):
             address,
         )
 
+    # no mrs/msr, the cpsr slot is left as it is like push_all_regs does
+    def push_regs(self, regs, address=None):
+        return super().push_regs(regs - {REG_CPSR}, address)
+
+    def pop_regs(self, regs, address=None):
+        return super().pop_regs(regs - {REG_CPSR}, address)
+
     def _get_jmp_patch_size(self, dst_address, address):
         if self._in_range(dst_address, address):
             return 2
@@ -295,32 +1012,26 @@ class ThumbPatcher(Thumb2Patcher):
         address = self.seek(address)
         length = 0
         if self._in_range(address, dst_address):
-            length = self.assemble(f'b #0x{self._base+dst_address:x}')
+            length = self.branch_patch(dst_address)
         else:
-            length = self.assemble('push {r0, r1};' 'ldr r0, [pc, #4];' 'str r0, [sp, #4];' 'pop {r0, pc};')
+            length = self.emit(THUMB_FAR_JUMP)
             if not TEST_ALIGN_4(self._io.tell()):
+                self._data[self._io.tell()] = 2
                 length += self.nop_patch(1)
-            self._io.write(pack('I', self._base + SET_BIT0(dst_address)))
-            length += 4
+            length += self.emit_word(self._base + SET_BIT0(dst_address))
         return length
 
-    def call_patch(self, dst_address, address=None):
+    def call_patch(self, dst_address, address=None, exchange=False):
         address = self.seek(address)
         length = 0
-        if self._in_range(address, dst_address):
-            length = self.assemble(f'bl #0x{self._base+dst_address:x}')
+        if abs(address - dst_address) < self.CALL_RANGE:
+            encode = encode_thumb_blx if exchange else encode_thumb_bl
+            length = self.emit(encode(self._base + address, self._base + dst_address))
         else:
-            length = self.assemble(
-                'push {r0, r1};'
-                'mov r0, pc;'
-                'adds r0, #0xc;'
-                'mov lr, r0;'
-                'ldr r0, [pc, #4];'
-                'str r0, [sp, #4];'
-                'pop {r0, pc};'
-            )
+            length = self.emit(encode_thumb_far_call(self._base + address))
             if not TEST_ALIGN_4(self._io.tell()):
+                self._data[self._io.tell()] = 2
                 length += self.nop_patch(1)
-            self._io.write(pack('I', self._base + CLEAR_BIT0(dst_address)))
-            length += 4
+            # pop {pc} switches to arm on armv5 when bit 0 is clear
+            length += self.emit_word(self._base + (dst_address if exchange else SET_BIT0(dst_address)))
         return length
@@ -1,7 +1,53 @@
-import keystone
-import capstone
 from enum import Enum
+import importlib.util
+import json
 import os
+import sys
+import threading
+from time import perf_counter
+
+
+def lazy_import(name: str):
+    '''
+    the top level module `name`, run when one of its attributes is first read
+    (importlib.util.LazyLoader), None when it is not installed; for optional
+    dependencies that are slow to load, like numpy
+    '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_json(path: str, version: int):
+    '''
+    the dict save_json() wrote to `path` with `version`, None when there is none
+    or it is broken or of another version; the caches and manifests kept next
+    to a rom are plain data, loading one shipped with a rom can't run code
+    '''
+    try:
+        with open(path, 'rb') as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != version:
+        return None
+    return data
+
+
+def save_json(path: str, version: int, data: dict):
+    '''write `data` with its `version` to `path`, through a temporary file'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump({'version': version, **data}, fp, separators=(',', ':'))
+    os.replace(tmp, path)
 
 
 class ARCH(Enum):
@@ -13,20 +59,21 @@ class ARCH(Enum):
 
 
 class ArchMode:
+    # names in keystone/capstone, looked up on use so importing the package loads neither
     KS_ARCH_MODE = {
-        ARCH.ARM: (keystone.KS_ARCH_ARM, keystone.KS_MODE_ARM),
-        ARCH.ARM_THUMB: (keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB),
-        ARCH.ARM64: (keystone.KS_ARCH_ARM64, keystone.KS_MODE_LITTLE_ENDIAN),
-        ARCH.X86: (keystone.KS_ARCH_X86, keystone.KS_MODE_32),
-        ARCH.X86_64: (keystone.KS_ARCH_X86, keystone.KS_MODE_64),
+        ARCH.ARM: ('KS_ARCH_ARM', 'KS_MODE_ARM'),
+        ARCH.ARM_THUMB: ('KS_ARCH_ARM', 'KS_MODE_THUMB'),
+        ARCH.ARM64: ('KS_ARCH_ARM64', 'KS_MODE_LITTLE_ENDIAN'),
+        ARCH.X86: ('KS_ARCH_X86', 'KS_MODE_32'),
+        ARCH.X86_64: ('KS_ARCH_X86', 'KS_MODE_64'),
     }
 
     CS_ARCH_MODE = {
-        ARCH.ARM: (capstone.CS_ARCH_ARM, capstone.CS_MODE_ARM),
-        ARCH.ARM_THUMB: (capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB),
-        ARCH.ARM64: (capstone.CS_ARCH_ARM64, capstone.CS_MODE_LITTLE_ENDIAN),
-        ARCH.X86: (capstone.CS_ARCH_X86, capstone.CS_MODE_32),
-        ARCH.X86_64: (capstone.CS_ARCH_X86, capstone.CS_MODE_64),
+        ARCH.ARM: ('CS_ARCH_ARM', 'CS_MODE_ARM'),
+        ARCH.ARM_THUMB: ('CS_ARCH_ARM', 'CS_MODE_THUMB'),
+        ARCH.ARM64: ('CS_ARCH_ARM64', 'CS_MODE_LITTLE_ENDIAN'),
+        ARCH.X86: ('CS_ARCH_X86', 'CS_MODE_32'),
+        ARCH.X86_64: ('CS_ARCH_X86', 'CS_MODE_64'),
     }
 
     def __init__(self, arch: ARCH):
@@ -34,49 +81,260 @@ class ArchMode:
 
     @property
     def ks_arch_mode(self):
-        return self.KS_ARCH_MODE[self.arch]
+        import keystone
+
+        return tuple(getattr(keystone, name) for name in self.KS_ARCH_MODE[self.arch])
 
     @property
     def cs_arch_mode(self):
-        return self.CS_ARCH_MODE[self.arch]
+        import capstone
+
+        return tuple(getattr(capstone, name) for name in self.CS_ARCH_MODE[self.arch])
+
+
+class EnginePool:
+    '''
+    keystone and capstone engines per ARCH, made on first use and shared by every
+    patcher (and by analysis, cycles and trace) instead of one set per patcher;
+    an engine must not run in two threads at once, so each thread has its own
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _engines(self):
+        engines = getattr(self._local, 'engines', None)
+        if engines is None:
+            engines = self._local.engines = {}
+        return engines
+
+    def assembler(self, arch: ARCH):
+        engines = self._engines()
+        key = ('keystone', arch)
+        if key not in engines:
+            import keystone
+
+            engines[key] = keystone.Ks(*ArchMode(arch).ks_arch_mode)
+        return engines[key]
+
+    def disassembler(self, arch: ARCH, detail: bool = False):
+        '''a capstone engine, with operand details when `detail`, don't change its options'''
+        engines = self._engines()
+        key = ('capstone', arch, detail)
+        if key not in engines:
+            import capstone
+
+            engines[key] = capstone.Cs(*ArchMode(arch).cs_arch_mode)
+            engines[key].detail = detail
+        return engines[key]
+
+
+ENGINES = EnginePool()
+
+
+class CapstoneTable:
+    '''
+    a set or dict of capstone arm ids (instructions, registers, shifts) built by
+    `make(arm_const)` the first time it is looked into, so modules can keep such
+    tables at their top without importing capstone
+    '''
+
+    def __init__(self, make):
+        self._make = make
+        self._table = None
+
+    def _get(self):
+        if self._table is None:
+            from capstone import arm_const
+
+            self._table = self._make(arm_const)
+        return self._table
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def get(self, key, default=None):
+        return self._get().get(key, default)
 
 
 class Patcher:
-    def __init__(self, io, base: int, arch_mode: ArchMode):
+    def __init__(self, io, base: int, arch_mode: ArchMode, asm_cache=None, tracer=None):
         self._io = io
         self._base = base
         self._arch_mode = arch_mode
-        self._assembler = keystone.Ks(*arch_mode.ks_arch_mode)
-        self._disassembler = capstone.Cs(*arch_mode.cs_arch_mode)
+        self._asm_cache = asm_cache
+        # a PatchTracer, counters and emitted code per patcher/job
+        self._tracer = tracer
+        self._name = type(self).__name__
+        # address -> (raw bytes, (address, size, mnemonic, op_str))
+        self._insn_cache = {}
+        # address -> (raw bytes, CsInsn with details)
+        self._detail_cache = {}
+        # hook type -> addresses of the shared save/restore stubs (see ArmPatcher.emit_shared_stub)
+        self._shared_stubs = {}
+        # hook type -> size of its shared stub
+        self._stub_sizes = {}
+        # save only the registers the hook function uses (see ArmPatcher.hook_usage)
+        self.minimal_save = False
+        # function bytes -> RegisterUsage or None
+        self._usage_cache = {}
+        # address -> size of the literals and padding emitted between the code of the current hook
+        self._data = {}
+        # [(start, end)] the last hook runs per call, without its function (see record_path)
+        self.hook_path = None
+        # (start, end) of the instructions the last relocate_opcodes moved
+        self.relocated = None
+
+    # the engines come from ENGINES, per thread, a patcher costs none of its own
+    @property
+    def _assembler(self):
+        return ENGINES.assembler(self._arch_mode.arch)
+
+    @property
+    def _disassembler(self):
+        return ENGINES.disassembler(self._arch_mode.arch)
+
+    @property
+    def _detail_disassembler(self):
+        return ENGINES.disassembler(self._arch_mode.arch, detail=True)
 
     # 以下 address 参数，均为不含 base 的，以 rom 为准的绝对地址
     def seek(self, address):
         if address:
             self._io.seek(address, os.SEEK_SET)
+            if self._tracer is not None:
+                self._tracer.count(self._name, 'seeks')
         return self._io.tell()
 
+    def _keystone(self, asm, address):
+        if self._tracer is None:
+            return bytes(self._assembler.asm(asm, self._base + address)[0])
+        start = perf_counter()
+        encoding = bytes(self._assembler.asm(asm, self._base + address)[0])
+        self._tracer.elapsed(self._name, 'keystone', start)
+        return encoding
+
+    def _write(self, data, text=None):
+        if self._tracer is not None:
+            self._tracer.emit(self._name, self._arch_mode.arch, self._base + self._io.tell(), data, text)
+        self._io.write(data)
+
     def assemble(self, asm, address=None):
         # https://www.keystone-engine.org/docs/tutorial.html
         address = self.seek(address)
-        encoding, count = self._assembler.asm(asm, self._base + address)
-        # print(f'{self._base + address:08x} {bytes(encoding).hex()}\t\t{asm}')
-        self._io.write(bytes(encoding))
+        if self._asm_cache is None:
+            encoding = self._keystone(asm, address)
+        else:
+            key = self._asm_cache.make_key(self._arch_mode.arch, asm, self._base + address)
+            encoding = self._asm_cache.get(key)
+            if encoding is None:
+                encoding = self._keystone(asm, address)
+                self._asm_cache.put(key, encoding)
+            elif self._tracer is not None:
+                self._tracer.count(self._name, 'asm_cache_hits')
+        self._write(encoding, asm)
+        return len(encoding)
+
+    def emit(self, encoding: bytes, address=None, text=None):
+        # bytes from the native encoders in arm.py, written like assemble() writes keystone's
+        # `text` only goes to the tracer (e.g. `.word` for literals), None means code
+        self.seek(address)
+        self._write(encoding, text)
         return len(encoding)
 
     def diassemble(self, address=None):
         # https://www.capstone-engine.org/lang_python.html
         address = self.seek(address)
         buf = self._io.read(64)
+        start = perf_counter()
         result = next(self._disassembler.disasm(buf, self._base + address))
+        if self._tracer is not None:
+            self._tracer.elapsed(self._name, 'capstone', start)
         self._io.seek(-64 + result.size, os.SEEK_CUR)
         return result
 
-    def get_min_opcodes_len(self, address, min_size):
+    def _read_view(self, address, size):
+        # zero-copy when the io exposes its buffer (RomBuffer, io.BytesIO)
+        if hasattr(self._io, 'getbuffer'):
+            return self._io.getbuffer()[address : address + size]
+        pos = self._io.tell()
+        self._io.seek(address, os.SEEK_SET)
+        buf = self._io.read(size)
+        self._io.seek(pos, os.SEEK_SET)
+        return buf
+
+    def _cached_insn(self, address, cache=None):
+        if cache is None:
+            cache = self._insn_cache
+        entry = cache.get(address)
+        if entry is not None:
+            raw, insn = entry
+            # the bytes may have been patched since they were decoded
+            if self._read_view(address, len(raw)) == raw:
+                return insn
+            del cache[address]
+        return None
+
+    def _decode_range(self, address, size, cache, decode):
+        # decode(window, address) yields (address with base, size, instruction)
+        result = []
         addr = address
-        while addr - address < min_size:
-            r = self.diassemble(addr)
-            addr += max(r.size, 1)
-        return addr - address
+        end = address + size
+        while addr < end:
+            insn = self._cached_insn(addr, cache)
+            if insn is None:
+                # 4 extra bytes for an instruction crossing the end
+                window = self._read_view(addr, end - addr + 4)
+                start = perf_counter()
+                for insn_address, insn_size, insn in decode(window, self._base + addr):
+                    offset = insn_address - self._base - addr
+                    cache[insn_address - self._base] = (bytes(window[offset : offset + insn_size]), insn)
+                    if offset + insn_size >= end - addr:
+                        break
+                if self._tracer is not None:
+                    self._tracer.elapsed(self._name, 'capstone', start)
+                insn = self._cached_insn(addr, cache)
+                if insn is None:
+                    raise ValueError(f'invalid instruction at 0x{self._base + addr:08x}')
+            result.append(insn)
+            addr += len(cache[addr][0])
+        return result
+
+    def disassemble_range(self, address, size):
+        '''
+        decode the instructions covering [address, address + size) in one pass
+        return a list of capstone lite tuples (address with base, size, mnemonic, op_str)
+        decoded instructions are cached per address, so decoding the same code again is free
+        '''
+
+        def decode(window, address):
+            return ((insn[0], insn[1], insn) for insn in self._disassembler.disasm_lite(window, address))
+
+        return self._decode_range(address, size, self._insn_cache, decode)
+
+    def disassemble_detail(self, address, size):
+        '''like disassemble_range, but CsInsn objects with the operand details'''
+
+        def decode(window, address):
+            return ((insn.address, insn.size, insn) for insn in self._detail_disassembler.disasm(window, address))
+
+        return self._decode_range(address, size, self._detail_cache, decode)
+
+    def clear_insn_cache(self):
+        self._insn_cache.clear()
+        self._detail_cache.clear()
+
+    def get_min_opcodes_len(self, address, min_size):
+        return sum(insn[1] for insn in self.disassemble_range(address, min_size))
 
     def push_all_regs(self, address=None):
         raise NotImplementedError
@@ -87,7 +345,24 @@ class Patcher:
     def jump_patch(self, dst_address, address=None):
         raise NotImplementedError
 
-    def call_patch(self, dst_address, address=None):
+    def record_path(self, runs):
+        '''
+        keep in hook_path the (start, end) `runs` of code a call of the hook goes
+        through, less the literals and padding between them, for the cycle
+        estimates of cycles.MemoryTimings.path_cycles
+        '''
+        path = []
+        for start, end in runs:
+            for address in sorted(address for address in self._data if start <= address < end):
+                if start < address:
+                    path.append((start, address))
+                start = max(start, address + self._data[address])
+            if start < end:
+                path.append((start, end))
+        self.hook_path = path
+        self._data = {}
+
+    def call_patch(self, dst_address, address=None, exchange=False):
         raise NotImplementedError
 
     def nop_patch(self, size, address=None):
@@ -96,23 +371,25 @@ class Patcher:
     def _fix_opstr(self, instr, src_address, dst_address):
         return self.assemble(instr, dst_address)
 
+    def _relocate_insn(self, insn, src_address, dst_address):
+        # `insn` is a CsInsn with details, patchers knowing their operands override this
+        return self._fix_opstr(f'{insn.mnemonic} {insn.op_str}', src_address, dst_address)
+
     def relocate_opcodes(self, size, src_address, address=None):
         if address is None:
             address = self._io.tell()
 
         src_addr = src_address
         addr = address
-        while src_addr - src_address < size:
-            r = self.diassemble(src_addr)
-            if r.size == 0:
-                break
-            addr += self._fix_opstr(f'{r.mnemonic} {r.op_str}', src_addr, addr)
-            src_addr += r.size
+        for insn in self.disassemble_detail(src_address, size):
+            addr += self._relocate_insn(insn, src_addr, addr)
+            src_addr += insn.size
+        self.relocated = (src_address, src_addr)
 
         self._io.seek(addr, os.SEEK_SET)
         return addr - address
 
-    def set_hooker(self, target_address: int, empty_address: int, function_codes: bytes):
+    def set_hooker(self, target_address: int, empty_address: int, function_codes: bytes, function_address=None):
         '''
         target                          empty space
         +----------------------+        +--------------------------------------------------------+
@@ -123,10 +400,15 @@ class Patcher:
         |                      |     +- | jmp back             |     +- |                      | |
         |                      |        |                      |        +----------------------+ |
         +----------------------+        +--------------------------------------------------------+
+
+        a function linked elsewhere (see ElfLinker) is called at `function_address`
+        instead of being copied after the trampoline
         '''
         raise NotImplementedError
 
-    def set_function_hooker(self, target_address: int, empty_address: int, function_codes: bytes):
+    def set_function_hooker(
+        self, target_address: int, empty_address: int, function_codes: bytes, function_address=None
+    ):
         '''
                 target                          empty space
         +----------------------+        +--------------------------------------------------------+
@@ -155,3 +437,6 @@ class ExeHelper:
 
     def get_opcodes(self, func_name: str):
         raise NotImplementedError
+
+    def get_many(self, func_names):
+        return {name: self.get_opcodes(name) for name in func_names}
@@ -0,0 +1,142 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from time import perf_counter
+import traceback
+
+from .cache import AsmCache
+from .elf import ElfHelper
+from .utils import patch_rom
+
+
+class BatchReport:
+    '''
+    one summary per rom of patch_batch:
+        {'name', 'ok', 'seconds', 'error' (traceback or None), 'report' (PatchReport.to_dict() or None)}
+    '''
+
+    def __init__(self, roms=None):
+        self.roms = roms or []
+
+    @property
+    def ok(self):
+        return all(rom['ok'] for rom in self.roms)
+
+    def failed(self):
+        return [rom for rom in self.roms if not rom['ok']]
+
+    def to_dict(self):
+        return {'ok': self.ok, 'roms': self.roms}
+
+    def to_json(self, path=None, indent=2):
+        text = json.dumps(self.to_dict(), indent=indent)
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(text)
+        return text
+
+    def __str__(self):
+        rows = [['rom', 'status', 'jobs', 'used', 'seconds']]
+        for rom in self.roms:
+            seconds = f"{rom['seconds']:.2f}"
+            if rom['ok']:
+                report = rom['report']
+                rows.append([rom['name'], 'ok', str(len(report['jobs'])), f"0x{report['used']:x}", seconds])
+            else:
+                # the exception, last line of the traceback
+                rows.append([rom['name'], 'FAILED', '-', '-', seconds, rom['error'].strip().splitlines()[-1]])
+        widths = [max(len(row[i]) for row in rows) for i in range(5)]
+        lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths + [0])).rstrip() for row in rows]
+        lines.append(f'{len(self.roms) - len(self.failed())}/{len(self.roms)} roms patched')
+        return '\n'.join(lines)
+
+
+# per worker process state, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(functions: dict, cache_items: list, maxsize: int, code_path: str = None):
+    asm_cache = AsmCache(maxsize=maxsize)
+    asm_cache.update(cache_items)
+    _worker['functions'] = functions
+    # linking (patch_rom's `link`) needs the elf itself
+    _worker['code_path'] = code_path
+    _worker['asm_cache'] = asm_cache
+    # keys sent back to the parent already
+    _worker['known'] = {key for key, _ in cache_items}
+
+
+def _patch_one(task):
+    name, options = task
+    asm_cache = _worker['asm_cache']
+    start = perf_counter()
+    try:
+        link = (
+            options.get('link')
+            or getattr(options.get('options'), 'link', False)
+            or any(job.get('ram') for job in options.get('jobs', ()))
+        )
+        code_path = _worker['code_path'] if link else None
+        report = patch_rom(code_path=code_path, functions=_worker['functions'], asm_cache=asm_cache, **options)
+        summary = {'name': name, 'ok': True, 'error': None, 'report': report.to_dict()}
+    except Exception:
+        summary = {'name': name, 'ok': False, 'error': traceback.format_exc(), 'report': None}
+    summary['seconds'] = perf_counter() - start
+
+    known = _worker['known']
+    new_items = [(key, encoding) for key, encoding in asm_cache.items() if key not in known]
+    known.update(key for key, _ in new_items)
+    return summary, new_items
+
+
+def patch_batch(code_path: str, roms: dict, workers: int = None, asm_cache: AsmCache = None, elf_cache_path=None):
+    '''
+    patch several roms with the functions of one elf
+
+    roms = {name: {patch_rom arguments: 'rom_path', 'rom_base', 'empty_address', 'jobs',
+                   'output_path', 'patch_path', 'manifest_path', ..., or 'options', a PatchOptions}}
+
+    the elf is read once and its functions are shared by all roms, every
+    worker process keeps one asm cache for all the roms it patches (seeded
+    from `asm_cache`, which gets everything they assembled back and is saved
+    if it has a path), so the trampoline templates are assembled once per
+    process instead of once per rom
+
+    roms are patched in `workers` processes (os.cpu_count() by default, 1
+    patches in this process), a rom that fails does not stop the others
+
+    return a BatchReport with a summary per rom, in the order of `roms`
+    '''
+    names = set()
+    for options in roms.values():
+        names.update(job.get('func') for job in options.get('jobs', ()) if job.get('type') in ('hook', 'hook_func'))
+    functions = {}
+    if code_path:
+        with ElfHelper(code_path, cache_path=elf_cache_path) as elf:
+            # a missing symbol fails its rom only
+            functions = {name: elf.get_opcodes(name) for name in names if name in elf.index}
+
+    if asm_cache is None:
+        asm_cache = AsmCache()
+    initargs = (functions, asm_cache.items(), asm_cache.maxsize, code_path)
+    tasks = list(roms.items())
+    workers = min(workers or os.cpu_count() or 1, len(tasks) or 1)
+
+    if workers == 1:
+        _init_worker(*initargs)
+        results = map(_patch_one, tasks)
+        summaries = [_collect(asm_cache, result) for result in results]
+        _worker.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+            summaries = [_collect(asm_cache, result) for result in executor.map(_patch_one, tasks)]
+
+    if asm_cache.path:
+        asm_cache.save()
+    return BatchReport(summaries)
+
+
+def _collect(asm_cache, result):
+    summary, new_items = result
+    asm_cache.update(new_items)
+    return summary
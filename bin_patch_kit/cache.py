@@ -0,0 +1,105 @@
+from collections import OrderedDict
+import re
+
+from .base import load_json, save_json
+
+
+class AsmCache:
+    '''
+    memoize keystone results
+
+    key: (arch, asm text, address), the address is only part of the key when the
+    encoding depends on it (branches to absolute targets, adr, labels),
+    so fixed sequences like push/pop all regs or `ldr pc, [pc, #-4]` hit
+    wherever they are assembled
+
+    with `path` the cache is loaded from disk on creation and written by `save()`,
+    as JSON
+    '''
+
+    VERSION = 2
+
+    # b/bl/blx/cbz/cbnz with an immediate target (`#0x100` or a bare `0x100`, keystone takes both),
+    # adr, `add rX, pc, #imm` (keystone turns it into adr in thumb), directives, label references or literal pools
+    ADDRESS_DEPENDENT_RE = re.compile(
+        r'(?:^|[;\n])\s*(?:(?:bl?x?|cbn?z)(?:eq|ne|cs|hs|cc|lo|mi|pl|vs|vc|hi|ls|ge|lt|gt|le|al)?(?:\.[wn])?\s+'
+        r'(?:\w+\s*,\s*)?(?:#|[-+]?\d)'
+        r'|adr|add\w*\s+\w+\s*,\s*pc\s*,|\.)'
+        r'|=|:',
+        re.IGNORECASE,
+    )
+
+    def __init__(self, path: str = None, maxsize: int = 0x10000):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if path:
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @classmethod
+    def is_address_dependent(cls, asm: str):
+        return cls.ADDRESS_DEPENDENT_RE.search(asm) is not None
+
+    def make_key(self, arch, asm: str, address: int):
+        return (arch.name, asm, address if self.is_address_dependent(asm) else None)
+
+    def get(self, key):
+        encoding = self._entries.get(key)
+        if encoding is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return encoding
+
+    def put(self, key, encoding: bytes):
+        self._entries[key] = encoding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def items(self):
+        '''(key, encoding) pairs, least recently used first'''
+        return list(self._entries.items())
+
+    def update(self, items):
+        for key, encoding in items:
+            self.put(key, encoding)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+    def load(self, path: str):
+        data = load_json(path, self.VERSION)
+        if data is None:
+            # missing, broken or foreign file, start from scratch
+            return
+        try:
+            entries = [
+                ((arch, asm, address), bytes.fromhex(encoding)) for arch, asm, address, encoding in data['entries']
+            ]
+        except (KeyError, TypeError, ValueError):
+            return
+        self.update(entries)
+
+    def save(self, path: str = None):
+        path = path or self.path
+        if not path:
+            raise ValueError('no path to save the asm cache')
+        save_json(path, self.VERSION, {'entries': [[*key, encoding.hex()] for key, encoding in self.items()]})
@@ -0,0 +1,511 @@
+import struct
+
+from .base import lazy_import
+
+np = lazy_import('numpy')
+
+LZ77_TYPE = 0x10
+LZ77_MAX_SIZE = 0xFFFFFF
+# an arm9 keeps its secure area (and the decompressor in crt0) uncompressed
+ARM9_RAW_SIZE = 0x4000
+# the "nitrocode" words ending the module params of an arm9, and starting its footer
+NITRO_CODE = struct.pack('<II', 0xDEC00621, 0x2106C0DE)
+NITRO_FOOTER = struct.pack('<I', 0xDEC00621)
+# offset of compressed_static_end in the module params
+PARAMS_COMPRESSED_END = 0x14
+PARAMS_SIZE = 0x24
+
+
+class CompressionError(ValueError):
+    pass
+
+
+def _chains(data):
+    '''
+    prev[i]: the last position before i where the same 3 bytes start, -1 if none;
+    walking prev from i visits every earlier candidate of a match at i, nearest first
+    '''
+    prev = [-1] * len(data)
+    last = {}
+    for i in range(len(data) - 2):
+        key = data[i : i + 3]
+        prev[i] = last.get(key, -1)
+        last[key] = i
+    return prev
+
+
+def _matches_numpy(data, min_disp, max_disp, longest):
+    '''
+    (lengths, displacements, chain) lists: the longest match at every position
+    up to `longest` bytes, 0 for none, and the hash chain (see _chains) of the
+    `longest` bytes prefixes, to extend those matches
+
+    the positions are sorted by their first 3 bytes, then by position (in one
+    int, so the sort needs not be stable); the positions of each 3 bytes string
+    are a run, in order, so the nearest earlier one is the previous entry, or
+    the one before for a displacement too short; each next length sorts the
+    positions again by the rank of their run and the next byte, leaving out the
+    ones alone in their run, which can't match any longer
+    '''
+    size = len(data)
+    padded = np.zeros(size + longest, dtype=np.uint8)
+    padded[:size] = np.frombuffer(data, dtype=np.uint8)
+    bits = np.uint64(size.bit_length())
+    lengths = np.zeros(size, dtype=np.int8)
+    disps = np.zeros(size, dtype=np.int32)
+    chain = np.full(size, -1, dtype=np.int64)
+    wide = padded.astype(np.uint64)
+    prefix = (wide[:size] << np.uint64(16)) | (wide[1 : size + 1] << np.uint64(8)) | wide[2 : size + 2]
+    order = np.argsort((prefix << bits) | np.arange(size, dtype=np.uint64))
+    prefix = prefix[order]
+    for length in range(3, longest + 1):
+        # same[k]: entry k + 1 is in the run of entry k
+        same = prefix[1:] == prefix[:-1]
+        disp = order[1:] - order[:-1]
+        match = same.copy()
+        for back in range(2, min_disp + 1):
+            near = np.flatnonzero(match & (disp < min_disp))
+            entry = near + 1
+            further = entry >= back
+            further[further] = same[entry[further] - back]
+            match[near[~further]] = False
+            disp[near[further]] = order[entry[further]] - order[entry[further] - back]
+        found = np.flatnonzero(match & (disp >= min_disp) & (disp <= max_disp) & (order[1:] <= size - length))
+        if not len(found):
+            break
+        lengths[order[found + 1]] = length
+        disps[order[found + 1]] = disp[found]
+        if length == longest:
+            chain[order[1:][same]] = order[:-1][same]
+            break
+        keep = np.zeros(len(order), dtype=bool)
+        keep[1:] = same
+        keep[:-1] |= same
+        rank = np.zeros(len(order), dtype=np.uint64)
+        rank[1:] = np.cumsum(~same, dtype=np.uint64)
+        order, rank = order[keep], rank[keep]
+        prefix = (rank << np.uint64(8)) | padded[order + length].astype(np.uint64)
+        sort = np.argsort((prefix << bits) | order.astype(np.uint64))
+        order, prefix = order[sort], prefix[sort]
+    return lengths.tolist(), disps.tolist(), chain.tolist()
+
+
+def _parse_numpy(data, min_disp, max_disp, max_len):
+    '''lz_parse with the matches up to 8 bytes from _matches_numpy, longer ones by walking its 8 bytes chain'''
+    size = len(data)
+    longest = min(8, max_len)
+    lengths, disps, chain = _matches_numpy(data, min_disp, max_disp, longest)
+    refs = []
+    append = refs.append
+    i = 0
+    while i < size:
+        best = lengths[i]
+        if not best:
+            i += 1
+            continue
+        best_disp = disps[i]
+        if best == longest and i + longest < size:
+            limit = min(max_len, size - i)
+            low = max(i - max_disp, 0)
+            j = chain[i]
+            while j >= low:
+                if i - j >= min_disp and data[j + best] == data[i + best]:
+                    if data[j : j + limit] == data[i : i + limit]:
+                        best, best_disp = limit, i - j
+                        break
+                    length = longest
+                    while data[j + length] == data[i + length]:
+                        length += 1
+                    if length > best:
+                        best, best_disp = length, i - j
+                j = chain[j]
+        append((i, best, best_disp))
+        i += best
+    return refs
+
+
+def lz_parse(data: bytes, min_disp: int, max_disp: int, max_len: int = 0x12):
+    '''
+    greedy parse of `data` into [(position, length, displacement)] references of
+    3-`max_len` bytes to bytes `min_disp`-`max_disp` back, everything else is a
+    literal
+
+    the longest match at a position comes from walking a hash chain of the
+    3 byte prefixes, nearest first (see _chains), with numpy from sorts of the
+    positions by their prefixes instead (see _matches_numpy), never from
+    searching the whole window
+    '''
+    data = bytes(data)
+    size = len(data)
+    refs = []
+    if size < 3:
+        return refs
+    if np is not None:
+        return _parse_numpy(data, min_disp, max_disp, max_len)
+    prev = _chains(data)
+    i = 0
+    while i < size - 2:
+        limit = min(max_len, size - i)
+        best = 2
+        best_disp = 0
+        low = max(i - max_disp, 0)
+        j = prev[i]
+        while j >= low:
+            if i - j >= min_disp and data[j + best] == data[i + best]:
+                if data[j : j + limit] == data[i : i + limit]:
+                    best, best_disp = limit, i - j
+                    break
+                length = 3
+                while data[j + length] == data[i + length]:
+                    length += 1
+                if length > best:
+                    best, best_disp = length, i - j
+            j = prev[j]
+        if best_disp:
+            refs.append((i, best, best_disp))
+            i += best
+        else:
+            i += 1
+    return refs
+
+
+def _lz_stream_numpy(data, refs, bias, cut):
+    size = len(data)
+    starts, lengths, disps = np.array(refs, dtype=np.int64).reshape(-1, 3).T
+    # every position not inside a reference starts an item, a literal or a reference
+    inside = np.zeros(size + 1, dtype=np.int64)
+    inside[starts + 1] += 1
+    inside[starts + lengths] -= 1
+    items = np.flatnonzero(np.cumsum(inside[:size]) == 0)
+    is_ref = np.zeros(size, dtype=bool)
+    is_ref[starts] = True
+    kind = is_ref[items]
+    raw = np.ones(size, dtype=np.int64)
+    raw[starts] = lengths
+    # stream size after each item, with the flag byte of each block of 8
+    ends = np.cumsum(kind + 1) + np.arange(len(items)) // 8 + 1
+    count = len(items)
+    if cut:
+        gain = ends - np.cumsum(raw[items])
+        best = int(np.argmin(gain)) if count else 0
+        count = best + 1 if count and gain[best] < 0 else 0
+    ends, kind, items = ends[:count], kind[:count], items[:count]
+    out = np.zeros(int(ends[-1]) if count else 0, dtype=np.uint8)
+    out[ends[::8] - kind[::8] - 2] = np.packbits(kind)
+    literal = items[~kind]
+    out[ends[~kind] - 1] = np.frombuffer(data, dtype=np.uint8)[literal]
+    value = np.zeros(size, dtype=np.int64)
+    value[starts] = (lengths - 3) << 12 | (disps - bias)
+    value = value[items[kind]]
+    out[ends[kind] - 2] = value >> 8
+    out[ends[kind] - 1] = value & 0xFF
+    return bytearray(out.tobytes()), int(raw[items].sum())
+
+
+def _lz_stream(data, refs, bias: int, cut: bool = False):
+    '''
+    (stream, data bytes in it) of `data` parsed into `refs` (see lz_parse):
+    blocks of a flag byte (a bit per item, high bit first, set for references)
+    and 8 items, a literal byte or a 2 bytes reference, big endian (length - 3)
+    << 12 | (displacement - `bias`)
+
+    with `cut` the stream stops after the item where it is the most shorter
+    than the data it holds, and is empty when no such item saves anything
+    '''
+    if np is not None:
+        return _lz_stream_numpy(data, refs, bias, cut)
+    out = bytearray()
+    best = (0, 0, 0, 0)
+    raw = 0
+    count = 0
+    flag_at = 0
+    position = 0
+    for start, length, disp in refs + [(len(data), 0, 0)]:
+        for i in range(position, start + (length > 0)):
+            if count % 8 == 0:
+                flag_at = len(out)
+                out.append(0)
+            count += 1
+            if i == start:
+                value = (length - 3) << 12 | (disp - bias)
+                out[flag_at] |= 0x80 >> ((count - 1) % 8)
+                out += bytes((value >> 8, value & 0xFF))
+                raw += length
+            else:
+                out.append(data[i])
+                raw += 1
+            if cut and len(out) - raw < best[0] - best[1]:
+                best = (len(out), raw, flag_at, count)
+        position = start + length
+    if not cut:
+        return out, raw
+    read, raw, flag_at, count = best
+    del out[read:]
+    if read:
+        # the flag byte of the last block loses the items cut off
+        out[flag_at] &= (0xFF00 >> ((count - 1) % 8 + 1)) & 0xFF
+    return out, raw
+
+
+def lz77_decompress(data) -> bytearray:
+    '''GBA/NDS BIOS LZ77 (type 0x10) data -> the bytes, `data` starts at the header'''
+    data = memoryview(data).cast('B')
+    if len(data) < 4 or data[0] != LZ77_TYPE:
+        raise CompressionError('not LZ77 (type 0x10) data')
+    size = int.from_bytes(data[1:4], 'little')
+    out = bytearray()
+    i = 4
+    try:
+        while len(out) < size:
+            flags = data[i]
+            i += 1
+            for bit in range(8):
+                if len(out) >= size:
+                    break
+                if flags & (0x80 >> bit):
+                    first, second = data[i], data[i + 1]
+                    i += 2
+                    length = (first >> 4) + 3
+                    disp = ((first & 0xF) << 8 | second) + 1
+                    if disp > len(out):
+                        raise CompressionError(f'LZ77 reference before the start at 0x{i - 2:x}')
+                    start = len(out) - disp
+                    if disp >= length:
+                        out += out[start : start + length]
+                    else:
+                        out += (out[start:] * (length // disp + 1))[:length]
+                else:
+                    out.append(data[i])
+                    i += 1
+    except IndexError:
+        raise CompressionError('LZ77 data ends early') from None
+    del out[size:]
+    return out
+
+
+def lz77_compress(data, vram: bool = False) -> bytes:
+    '''
+    `data` as BIOS LZ77 (type 0x10), padded to 4 bytes; with `vram` no reference
+    copies the byte just written, so the BIOS can decompress it to VRAM (16 bits
+    writes, LZ77UnCompReadNormalWrite16bit)
+    '''
+    data = bytes(data)
+    if len(data) > LZ77_MAX_SIZE:
+        raise CompressionError(f'LZ77 data is limited to 16MB, got 0x{len(data):x} bytes')
+    out, _ = _lz_stream(data, lz_parse(data, 2 if vram else 1, 0x1000), 1)
+    out[0:0] = struct.pack('<I', LZ77_TYPE | len(data) << 8)
+    out += bytes(-len(out) % 4)
+    return bytes(out)
+
+
+def blz_decompress(data) -> bytearray:
+    '''
+    NDS bottom LZ (arm9/overlay code compression) data -> the bytes; it is
+    decompressed from its end, in place: the footer tells how many bytes before
+    it are compressed (the ones before those are kept as they are) and how much
+    longer the result is; data with a 0 length increase is not compressed
+    '''
+    data = memoryview(data).cast('B')
+    size = len(data)
+    if size < 8:
+        raise CompressionError('BLZ data needs an 8 bytes footer')
+    encoded, increase = struct.unpack_from('<II', data, size - 8)
+    if not increase:
+        return bytearray(data)
+    header, encoded = encoded >> 24, encoded & 0xFFFFFF
+    if header < 8 or header > encoded or encoded > size:
+        raise CompressionError(f'not BLZ data (footer {header:#x}, {encoded:#x})')
+    raw_size = size - encoded
+    stream = bytes(data[raw_size : size - header])[::-1]
+    target = encoded + increase
+    out = bytearray()
+    i = 0
+    try:
+        while i < len(stream) and len(out) < target:
+            flags = stream[i]
+            i += 1
+            for bit in range(8):
+                if i >= len(stream) or len(out) >= target:
+                    break
+                if flags & (0x80 >> bit):
+                    first, second = stream[i], stream[i + 1]
+                    i += 2
+                    length = (first >> 4) + 3
+                    disp = ((first & 0xF) << 8 | second) + 3
+                    if disp > len(out):
+                        raise CompressionError(f'BLZ reference past the end at 0x{size - header - i:x}')
+                    start = len(out) - disp
+                    if disp >= length:
+                        out += out[start : start + length]
+                    else:
+                        out += (out[start:] * (length // disp + 1))[:length]
+                else:
+                    out.append(stream[i])
+                    i += 1
+    except IndexError:
+        raise CompressionError('BLZ data ends early') from None
+    if len(out) != target:
+        raise CompressionError(f'BLZ data gives 0x{len(out):x} bytes instead of 0x{target:x}')
+    out.reverse()
+    return bytearray(data[:raw_size]) + out
+
+
+def blz_compress(data, raw_size: int = 0) -> bytes:
+    '''
+    `data` as bottom LZ, at least its first `raw_size` bytes are left as they
+    are; the data is parsed backwards from its end and the compressed part stops
+    where it is smallest and the in-place decompression never writes over bytes
+    it has yet to read, which also decides how much of the start stays raw
+
+    the result is `data` itself (no footer) when compressing doesn't make it
+    smaller, so a shorter result means compressed data
+    '''
+    data = bytes(data)
+    size = len(data)
+    tail = data[raw_size:][::-1]
+    # decompressing the first n items reads n items of the stream and writes
+    # their bytes; stopping where the stream is the most shorter than the data
+    # is the smallest result, and no earlier point has a shorter stream (for its
+    # data), which is exactly the in-place condition: the writes never get past
+    # the reads
+    stream, raw = _lz_stream(tail, lz_parse(tail, 3, 0x1002), 3, cut=True)
+    if not stream:
+        return data
+    read = len(stream)
+    kept = size - raw
+    padding = -(kept + read) % 4
+    header = 8 + padding
+    if kept + read + header >= size:
+        return data
+    out = bytearray(data[:kept])
+    out += stream[::-1]
+    out += b'\xff' * padding
+    out += struct.pack('<II', (read + header) | header << 24, size - (kept + read + header))
+    return bytes(out)
+
+
+def _module_params(data):
+    '''offset of the module params of an arm9, from its nitrocode footer or found by their nitrocode words'''
+    if _nitro_footer(data):
+        (offset,) = struct.unpack_from('<I', data, len(data) - 8)
+        if bytes(data[offset + PARAMS_SIZE - len(NITRO_CODE) : offset + PARAMS_SIZE]) == NITRO_CODE:
+            return offset
+    found = bytes(data).find(NITRO_CODE)
+    if found < PARAMS_SIZE - len(NITRO_CODE):
+        raise CompressionError('no module params (nitrocode 0xDEC00621 0x2106C0DE) in the arm9')
+    return found - (PARAMS_SIZE - len(NITRO_CODE))
+
+
+def _nitro_footer(data):
+    '''size of the 12 bytes nitrocode footer some tools leave at the end of an arm9, or 0'''
+    if len(data) >= 12 and bytes(data[-12:-8]) == NITRO_FOOTER:
+        return 12
+    return 0
+
+
+class Codec:
+    '''
+    how a compressed file maps to the bytes the patchers see: decode() on load,
+    encode() on commit (see PatchSession's `codec`), `base` is where the file
+    is loaded, the patch_rom `rom_base`
+    '''
+
+    name = None
+
+    def decode(self, data, base: int) -> bytearray:
+        raise NotImplementedError
+
+    def encode(self, data, base: int) -> bytes:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name!r})'
+
+
+class Lz77Codec(Codec):
+    '''a whole file in BIOS LZ77, e.g. a code blob a GBA game decompresses to EWRAM'''
+
+    def __init__(self, vram: bool = False):
+        self.name = 'lz77_vram' if vram else 'lz77'
+        self.vram = vram
+
+    def decode(self, data, base: int) -> bytearray:
+        return lz77_decompress(data)
+
+    def encode(self, data, base: int) -> bytes:
+        return lz77_compress(data, self.vram)
+
+
+class BlzCodec(Codec):
+    '''
+    a bottom LZ file, like a compressed NDS overlay; its overlay table entry
+    (y9.bin/y7.bin) has to get the new size, see set_overlay_size()
+    '''
+
+    name = 'blz'
+
+    def decode(self, data, base: int) -> bytearray:
+        return blz_decompress(data)
+
+    def encode(self, data, base: int) -> bytes:
+        return blz_compress(data)
+
+
+class Arm9Codec(Codec):
+    '''
+    an NDS arm9.bin, compressed or not: compressed_static_end of its module
+    params tells where the compressed part ends, decode() clears it like crt0
+    does and encode() compresses everything after the secure area and sets it
+    again (0 when compressing doesn't help); a trailing nitrocode footer is kept
+    '''
+
+    name = 'arm9'
+
+    def decode(self, data, base: int) -> bytearray:
+        params = _module_params(data)
+        (end,) = struct.unpack_from('<I', data, params + PARAMS_COMPRESSED_END)
+        if not end:
+            return bytearray(data)
+        end -= base
+        if not 0 < end <= len(data):
+            raise CompressionError(f'compressed_static_end {end + base:08x} is outside the arm9')
+        out = blz_decompress(memoryview(data)[:end])
+        out += data[end:]
+        struct.pack_into('<I', out, params + PARAMS_COMPRESSED_END, 0)
+        return out
+
+    def encode(self, data, base: int) -> bytes:
+        params = _module_params(data)
+        footer = _nitro_footer(data)
+        code = bytes(data[: len(data) - footer])
+        out = bytearray(blz_compress(code, max(ARM9_RAW_SIZE, params + PARAMS_SIZE)))
+        end = base + len(out) if len(out) < len(code) else 0
+        struct.pack_into('<I', out, params + PARAMS_COMPRESSED_END, end)
+        return bytes(out + data[len(data) - footer :])
+
+
+CODECS = {codec.name: codec for codec in (Lz77Codec(), Lz77Codec(vram=True), BlzCodec(), Arm9Codec())}
+
+
+def get_codec(codec):
+    '''a Codec from CODECS by name, a Codec itself is returned as it is'''
+    if codec is None or isinstance(codec, Codec):
+        return codec
+    if codec not in CODECS:
+        raise ValueError(f'unknown codec {codec!r}, one of {", ".join(CODECS)}')
+    return CODECS[codec]
+
+
+def set_overlay_size(table_path: str, overlay_id: int, size: int, compressed: bool = True):
+    '''
+    set the file size and compressed flag of overlay `overlay_id` in an overlay
+    table (y9.bin/y7.bin), after its file was compressed again to `size` bytes
+    '''
+    with open(table_path, 'rb+') as fp:
+        table = fp.read()
+        for offset in range(0, len(table) - 31, 32):
+            if struct.unpack_from('<I', table, offset)[0] == overlay_id:
+                fp.seek(offset + 0x1C)
+                fp.write(struct.pack('<I', (size & 0xFFFFFF) | (compressed << 24)))
+                return
+    raise KeyError(f'no overlay {overlay_id} in {table_path}')
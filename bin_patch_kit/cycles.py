@@ -0,0 +1,273 @@
+from .base import ARCH, ENGINES, CapstoneTable
+
+# ARM7TDMI instruction timings (TRM, "Instruction cycle timings") as
+# (S, N, I): sequential, non-sequential and internal cycles
+MULTI_LOADS = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_LDM,
+        arm_const.ARM_INS_LDMIB,
+        arm_const.ARM_INS_LDMDA,
+        arm_const.ARM_INS_LDMDB,
+        arm_const.ARM_INS_POP,
+    }
+)
+MULTI_STORES = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_STM,
+        arm_const.ARM_INS_STMIB,
+        arm_const.ARM_INS_STMDA,
+        arm_const.ARM_INS_STMDB,
+        arm_const.ARM_INS_PUSH,
+    }
+)
+LOADS = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_LDR,
+        arm_const.ARM_INS_LDRB,
+        arm_const.ARM_INS_LDRH,
+        arm_const.ARM_INS_LDRSB,
+        arm_const.ARM_INS_LDRSH,
+        arm_const.ARM_INS_LDRT,
+        arm_const.ARM_INS_LDRBT,
+    }
+)
+STORES = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_STR,
+        arm_const.ARM_INS_STRB,
+        arm_const.ARM_INS_STRH,
+        arm_const.ARM_INS_STRT,
+        arm_const.ARM_INS_STRBT,
+    }
+)
+BRANCHES = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_B,
+        arm_const.ARM_INS_BL,
+        arm_const.ARM_INS_BX,
+        arm_const.ARM_INS_BLX,
+        arm_const.ARM_INS_CBZ,
+        arm_const.ARM_INS_CBNZ,
+    }
+)
+# worst case of the early terminating multiplier
+MULTIPLIES = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_MUL: 4,
+        arm_const.ARM_INS_MLA: 5,
+        arm_const.ARM_INS_UMULL: 5,
+        arm_const.ARM_INS_SMULL: 5,
+        arm_const.ARM_INS_UMLAL: 6,
+        arm_const.ARM_INS_SMLAL: 6,
+    }
+)
+REGISTER_SHIFTS = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_SFT_ASR_REG,
+        arm_const.ARM_SFT_LSL_REG,
+        arm_const.ARM_SFT_LSR_REG,
+        arm_const.ARM_SFT_ROR_REG,
+        arm_const.ARM_SFT_RRX_REG,
+    }
+)
+
+
+def _is_pc(op):
+    from capstone import arm_const
+
+    return op.type == arm_const.ARM_OP_REG and op.reg == arm_const.ARM_REG_PC
+
+
+HALFWORD_ACCESSES = CapstoneTable(
+    lambda arm_const: {
+        arm_const.ARM_INS_LDRB,
+        arm_const.ARM_INS_LDRH,
+        arm_const.ARM_INS_LDRSB,
+        arm_const.ARM_INS_LDRSH,
+        arm_const.ARM_INS_LDRBT,
+        arm_const.ARM_INS_STRB,
+        arm_const.ARM_INS_STRH,
+        arm_const.ARM_INS_STRBT,
+        arm_const.ARM_INS_SWPB,
+    }
+)
+
+
+def insn_accesses(insn, thumb: bool = False):
+    '''
+    the cycles of insn_cycles() split by bus: ((S, N) of code fetches, (S, N) of
+    data accesses, I), the fetches include the refill after a branch or a pc write
+    '''
+    from capstone import CS_AC_WRITE, arm_const
+
+    ops = insn.operands
+    if insn.id in MULTI_LOADS:
+        registers = [op for op in ops if op.type == arm_const.ARM_OP_REG]
+        if insn.id != arm_const.ARM_INS_POP:
+            # the base register
+            registers = registers[1:]
+        n = len(registers)
+        code = (2, 1) if any(_is_pc(op) for op in registers) else (1, 0)
+        return code, (n - 1, 1), 1
+    if insn.id in MULTI_STORES:
+        n = len([op for op in ops if op.type == arm_const.ARM_OP_REG]) - (insn.id != arm_const.ARM_INS_PUSH)
+        return (0, 1), (n - 1, 1), 0
+    if insn.id in LOADS:
+        return ((2, 1) if ops and _is_pc(ops[0]) else (1, 0)), (0, 1), 1
+    if insn.id in STORES:
+        return (0, 1), (0, 1), 0
+    if insn.id in BRANCHES:
+        # thumb bl is two instructions
+        return ((3, 1) if thumb and insn.id == arm_const.ARM_INS_BL else (2, 1)), (0, 0), 0
+    if insn.id in (arm_const.ARM_INS_SWP, arm_const.ARM_INS_SWPB):
+        return (1, 0), (0, 2), 1
+    if insn.id in (arm_const.ARM_INS_SVC, arm_const.ARM_INS_UDF):
+        return (2, 1), (0, 0), 0
+    if insn.id in MULTIPLIES:
+        return (1, 0), (0, 0), MULTIPLIES[insn.id]
+    # data processing
+    s, n, i = 1, 0, 0
+    if any(op.shift.type in REGISTER_SHIFTS for op in ops):
+        i += 1
+    if ops and _is_pc(ops[0]) and ops[0].access & CS_AC_WRITE:
+        s, n = s + 1, n + 1
+    return (s, n), (0, 0), i
+
+
+def insn_cycles(insn, thumb: bool = False):
+    '''(S, N, I) of one capstone instruction (with details), branches are taken'''
+    (code_s, code_n), (data_s, data_n), i = insn_accesses(insn, thumb)
+    return (code_s + data_s, code_n + data_n, i)
+
+
+def count_cycles(code: bytes, arch: ARCH, address: int = 0):
+    '''
+    (S, N, I) of running `code` once from start to end, every instruction once
+    and every branch taken; S + N + I is the cycle count with 1 cycle memory
+    '''
+    disassembler = ENGINES.disassembler(arch, detail=True)
+    thumb = arch == ARCH.ARM_THUMB
+    total = [0, 0, 0]
+    for insn in disassembler.disasm(code, address):
+        for k, value in enumerate(insn_cycles(insn, thumb)):
+            total[k] += value
+    return tuple(total)
+
+
+class MemoryTimings:
+    '''
+    the memory map of a platform for cycle estimates: `regions` are
+    (start, end, name, (N, S) of a 16 bits access, (N, S) of a 32 bits access)
+    in cpu cycles, wait states included; data accesses not relative to pc
+    are taken to hit the memory at `stack`, where they mostly go in hooks
+
+    the ARM7TDMI timings of insn_accesses() are used for every cpu, so the
+    nds9 figures (uncached, no ARM9 pipeline) are an upper bound
+    '''
+
+    def __init__(self, name: str, regions, stack: int):
+        self.name = name
+        self.regions = regions
+        self.stack = stack
+
+    def region(self, address):
+        for region in self.regions:
+            if region[0] <= address < region[1]:
+                return region
+        raise ValueError(f'0x{address:08x} is not mapped on {self.name}')
+
+    def access(self, address, width=32):
+        '''(N, S) cycles of an access of `width` bits at `address`'''
+        region = self.region(address)
+        return region[3] if width == 16 else region[4]
+
+    def path_cycles(self, code, path, arch: ARCH, base: int):
+        '''
+        cycles of running the ranges of `path` ((start, end) in `code`, a buffer
+        of the rom, addresses without `base`) once each; an unconditional branch
+        forward inside a range skips to its target, like the branches over the
+        literals of relocated code do, one out of the range ends it
+        '''
+        from capstone import arm_const
+
+        disassembler = ENGINES.disassembler(arch, detail=True)
+        thumb = arch == ARCH.ARM_THUMB
+        total = 0
+        for start, end in path:
+            fetch_n, fetch_s = self.access(base + start, 16 if thumb else 32)
+            address = start
+            while address < end:
+                insn = next(disassembler.disasm(bytes(code[address : min(address + 4, end)]), base + address, 1), None)
+                if insn is None:
+                    break
+                (code_s, code_n), (data_s, data_n), internal = insn_accesses(insn, thumb)
+                total += code_s * fetch_s + code_n * fetch_n + internal
+                if data_s or data_n:
+                    data_n_cycles, data_s_cycles = self._data_access(insn, base + address)
+                    total += data_s * data_s_cycles + data_n * data_n_cycles
+                address += insn.size
+                ops = insn.operands
+                if (
+                    insn.id == arm_const.ARM_INS_B
+                    and insn.cc in (arm_const.ARM_CC_AL, arm_const.ARM_CC_INVALID)
+                    and ops[0].type == arm_const.ARM_OP_IMM
+                ):
+                    if not address <= ops[0].imm - base <= end:
+                        # a relocated branch leaving the hook, what follows doesn't run
+                        break
+                    address = ops[0].imm - base
+        return total
+
+    def _data_access(self, insn, address):
+        from capstone import arm_const
+
+        width = 16 if insn.id in HALFWORD_ACCESSES else 32
+        for op in insn.operands:
+            if op.type == arm_const.ARM_OP_MEM and op.mem.base == arm_const.ARM_REG_PC:
+                # a literal, next to the code
+                return self.access(address, width)
+        return self.access(self.stack, width)
+
+
+# GBA, with the WAITCNT most games set (rom 3/1 wait states)
+GBA_TIMINGS = MemoryTimings(
+    'gba',
+    [
+        (0x00000000, 0x00004000, 'bios', (1, 1), (1, 1)),
+        (0x02000000, 0x03000000, 'ewram', (3, 3), (6, 6)),
+        (0x03000000, 0x04000000, 'iwram', (1, 1), (1, 1)),
+        (0x04000000, 0x05000000, 'io', (1, 1), (1, 1)),
+        (0x05000000, 0x07000000, 'vram', (1, 1), (2, 2)),
+        (0x07000000, 0x08000000, 'oam', (1, 1), (1, 1)),
+        (0x08000000, 0x0E000000, 'rom', (4, 2), (6, 4)),
+        (0x0E000000, 0x10000000, 'sram', (5, 5), (5, 5)),
+    ],
+    stack=0x03007F00,
+)
+# NDS arm7, 33MHz cycles
+NDS7_TIMINGS = MemoryTimings(
+    'nds7',
+    [
+        (0x00000000, 0x00004000, 'bios', (1, 1), (1, 1)),
+        (0x02000000, 0x03000000, 'main', (8, 1), (9, 2)),
+        (0x03000000, 0x04000000, 'wram', (1, 1), (1, 1)),
+        (0x04000000, 0x05000000, 'io', (1, 1), (1, 1)),
+        (0x06000000, 0x07000000, 'vram', (1, 1), (2, 2)),
+    ],
+    stack=0x0380FF00,
+)
+# NDS arm9, 66MHz cycles, caches off; dtcm where libnds puts it
+NDS9_TIMINGS = MemoryTimings(
+    'nds9',
+    [
+        (0x00000000, 0x02000000, 'itcm', (1, 1), (1, 1)),
+        (0x02000000, 0x03000000, 'main', (16, 2), (18, 4)),
+        (0x03000000, 0x04000000, 'wram', (2, 2), (2, 2)),
+        (0x04000000, 0x05000000, 'io', (2, 2), (2, 2)),
+        (0x05000000, 0x08000000, 'vram', (2, 2), (4, 4)),
+        (0x0B000000, 0x0B004000, 'dtcm', (1, 1), (1, 1)),
+        (0xFFFF0000, 0x100000000, 'bios', (2, 2), (4, 4)),
+    ],
+    stack=0x0B003F00,
+)
+MEMORY_TIMINGS = {timings.name: timings for timings in (GBA_TIMINGS, NDS7_TIMINGS, NDS9_TIMINGS)}
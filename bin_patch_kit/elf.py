@@ -1,22 +1,136 @@
-from .base import ExeHelper
-from elftools.elf.elffile import ELFFile
-from elftools.elf.sections import SymbolTableSection
+from .base import ExeHelper, load_json, save_json
+import hashlib
+import mmap
 import os
 
 
 class ElfHelper(ExeHelper):
-    def __init__(self, name: str):
-        self.elf = ELFFile(open(name, 'rb'))
+    '''
+    the elf is memory-mapped, symbols are indexed once as
+    name -> (section index, file offset, size, thumb)
 
-    def get_opcodes(self, func_name: str):
+    with `cache_path` the index is stored on disk (JSON) together with the elf's
+    mtime and hash, an unchanged elf is then never parsed by pyelftools
+    '''
+
+    INDEX_VERSION = 2
+
+    def __init__(self, name: str, cache_path: str = None):
+        self.name = name
+        self.cache_path = cache_path
+        self._file = open(name, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self._elf = None
+        self._index = None
+
+    @property
+    def elf(self):
+        if self._elf is None:
+            from elftools.elf.elffile import ELFFile
+
+            self._elf = ELFFile(self._file)
+        return self._elf
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._load_index()
+        return self._index
+
+    def _digest(self):
+        return hashlib.sha1(self._view).hexdigest()
+
+    def _build_index(self):
+        from elftools.elf.sections import SymbolTableSection
+
+        is_arm = self.elf.get_machine_arch() == 'ARM'
+        index = {}
         for section in self.elf.iter_sections():
-            if isinstance(section, SymbolTableSection):
-                symbols = section.get_symbol_by_name(func_name)
-                if symbols is not None and len(symbols) > 0:
-                    symbol = symbols[0]
-                    sec = self.elf.get_section(symbol['st_shndx'])
-                    offset = sec['sh_offset'] + symbol['st_value']
-                    if self.elf.get_machine_arch() == 'ARM':
-                        offset &= 0xFFFFFFFE
-                    self.elf.stream.seek(offset, os.SEEK_SET)
-                    return self.elf.stream.read(symbol['st_size'])
+            if not isinstance(section, SymbolTableSection):
+                continue
+            for symbol in section.iter_symbols():
+                shndx = symbol['st_shndx']
+                # first definition wins, like get_symbol_by_name()[0]
+                if not symbol.name or symbol.name in index or not isinstance(shndx, int):
+                    continue
+                sec = self.elf.get_section(shndx)
+                offset = sec['sh_offset'] + symbol['st_value']
+                thumb = False
+                if is_arm:
+                    thumb = bool(offset & 1)
+                    offset &= 0xFFFFFFFE
+                index[symbol.name] = (shndx, offset, symbol['st_size'], thumb)
+        return index
+
+    def _load_index(self):
+        stat = os.stat(self.name)
+        digest = None
+        cached = load_json(self.cache_path, self.INDEX_VERSION) if self.cache_path else None
+        if cached is not None:
+            try:
+                mtime, size, cached_digest = cached['mtime'], cached['size'], cached['digest']
+                index = {
+                    name: (int(shndx), int(offset), int(size), bool(thumb))
+                    for name, (shndx, offset, size, thumb) in cached['index'].items()
+                }
+            except (KeyError, TypeError, ValueError, AttributeError):
+                index = None
+            if index is not None:
+                if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+                    return index
+                # touched but maybe not changed
+                digest = self._digest()
+                if digest == cached_digest:
+                    self._save_index(stat, digest, index)
+                    return index
+
+        index = self._build_index()
+        if self.cache_path:
+            self._save_index(stat, digest or self._digest(), index)
+        return index
+
+    def _save_index(self, stat, digest, index):
+        save_json(
+            self.cache_path,
+            self.INDEX_VERSION,
+            {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'digest': digest, 'index': index},
+        )
+
+    def get_view(self, func_name: str):
+        '''zero-copy memoryview of the symbol's bytes'''
+        try:
+            _, offset, size, _ = self.index[func_name]
+        except KeyError:
+            raise KeyError(f'symbol not found: {func_name}') from None
+        return self._view[offset : offset + size]
+
+    def get_many(self, func_names):
+        return {name: self.get_view(name) for name in func_names}
+
+    def is_thumb(self, func_name: str):
+        return self.index[func_name][3]
+
+    def get_size(self, func_name: str):
+        return self.index[func_name][2]
+
+    def get_opcodes(self, func_name: str):
+        if func_name not in self.index:
+            return None
+        return bytes(self.get_view(func_name))
+
+    def close(self):
+        self._elf = None
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # views from get_view/get_many are still alive, the map is released with them
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
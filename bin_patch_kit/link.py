@@ -0,0 +1,430 @@
+from bisect import bisect_right
+from fnmatch import fnmatch
+import hashlib
+from struct import pack, pack_into, unpack_from
+
+from .arm import encode_thumb_bl
+
+R_ARM_NONE = 0
+R_ARM_ABS32 = 2
+R_ARM_REL32 = 3
+R_ARM_THM_CALL = 10
+R_ARM_CALL = 28
+R_ARM_JUMP24 = 29
+R_ARM_THM_JUMP24 = 30
+R_ARM_TARGET1 = 38
+R_ARM_V4BX = 40
+R_ARM_MOVW_ABS_NC = 43
+R_ARM_MOVT_ABS = 44
+R_ARM_THM_MOVW_ABS_NC = 47
+R_ARM_THM_MOVT_ABS = 48
+
+# relocations of branches, -> (thumb, pc bias, reach)
+BRANCHES = {
+    R_ARM_CALL: (False, 8, 0x2000000),
+    R_ARM_JUMP24: (False, 8, 0x2000000),
+    # the thumb-1 bl pair
+    R_ARM_THM_CALL: (True, 4, 0x400000),
+    R_ARM_THM_JUMP24: (True, 4, 0x1000000),
+}
+
+SHF_WRITE = 1
+SHF_ALLOC = 2
+SHF_EXECINSTR = 4
+
+# ldr ip, [pc]; bx ip; .word target
+ARM_VENEER = pack('<2I', 0xE59FC000, 0xE12FFF1C)
+# bx pc; mov r8, r8; then the arm veneer
+THUMB_VENEER = pack('<2H', 0x4778, 0x46C0) + ARM_VENEER
+VENEER_SIZE = {False: len(ARM_VENEER) + 4, True: len(THUMB_VENEER) + 4}
+
+
+class LinkError(ValueError):
+    pass
+
+
+def _signed(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def _align(value, align):
+    return (value + align - 1) & -align
+
+
+def _thumb_imm16(hi, lo):
+    return (hi & 0xF) << 12 | (hi >> 10 & 1) << 11 | (lo >> 12 & 7) << 8 | lo & 0xFF
+
+
+def _thumb_constant(rd, value):
+    '''movs/lsls/adds building `value` in low register rd, no literal pool'''
+    code = [0x2000 | rd << 8 | value >> 24 & 0xFF]
+    for shift in (16, 8, 0):
+        # lsls rd, rd, #8; adds rd, #byte
+        code += [0x0200 | rd << 3 | rd, 0x3000 | rd << 8 | value >> shift & 0xFF]
+    return code
+
+
+def copy_routine(thumb: bool, src: int, dst: int, size: int):
+    '''
+    a hook function copying `size` bytes (a multiple of 4, at least 4) from
+    `src` to `dst` a word at a time, the boot time copy of a ram segment;
+    the thumb one has no literal pool, it runs at any halfword address
+    '''
+    end = dst + size
+    if thumb:
+        code = _thumb_constant(1, src) + _thumb_constant(2, dst) + _thumb_constant(3, end)
+        # ldmia r1!, {r0}; stmia r2!, {r0}; cmp r2, r3; bcc the ldmia; bx lr
+        code += [0xC901, 0xC201, 0x429A, 0xD3FB, 0x4770]
+        return pack(f'<{len(code)}H', *code)
+    # ldr r1/r2/r3, [pc, #0x18]; ldr ip, [r1], #4; str ip, [r2], #4; cmp r2, r3; blo the ldr ip; bx lr
+    code = [0xE59F1018, 0xE59F2018, 0xE59F3018, 0xE491C004, 0xE482C004, 0xE1520003, 0x3AFFFFFB, 0xE12FFF1E]
+    return pack('<11I', *code, src, dst, end)
+
+
+def _encode_thumb_b_w(src, dst):
+    '''b.w #dst at src, always the 32 bits form'''
+    offset = dst - (src + 4)
+    s = offset >> 24 & 1
+    j1 = (~(offset >> 23) ^ s) & 1
+    j2 = (~(offset >> 22) ^ s) & 1
+    return pack('<HH', 0xF000 | s << 10 | offset >> 12 & 0x3FF, 0x9000 | j1 << 13 | j2 << 11 | offset >> 1 & 0x7FF)
+
+
+class ElfLinker:
+    '''
+    a small static linker for the relocatable elf of the hook functions (an ElfHelper)
+
+        linker = ElfLinker(elf, GBA_BASE, symbols={'DrawText': 0x08012345})
+        sections = linker.select(['hooker_font'], ['.rodata*'])
+        size, align = linker.measure(sections)
+        linker.place(sections, address)
+        for segment in linker.resolve():
+            ...write segment['data'] at segment['address']
+
+    select() keeps the allocated sections defining the roots and everything
+    they refer to through relocations (like --gc-sections, so with
+    -ffunction-sections only the helpers in use are linked), place() lays
+    sections out one after the other as a segment, resolve() applies the
+    relocations of all placed segments
+
+    symbols the elf doesn't define come from `symbols` (name -> address with
+    base, bit 0 set for thumb functions), e.g. functions of the game
+
+    a call or jump which can't reach its target, or has to switch between
+    arm and thumb (ARMv4T has no blx), goes through a veneer at the end of
+    its segment; measure() includes the room the veneers may need
+    '''
+
+    def __init__(self, elf, base: int, symbols: dict = None):
+        self.elf = elf
+        self.base = base
+        self.symbols = dict(symbols or {})
+        self.segments = []
+        # section index -> (segment, offset in it)
+        self._placed = {}
+        self._symbols = None
+
+    def _load(self):
+        if self._symbols is not None:
+            return
+        from elftools.elf.relocation import RelocationSection
+        from elftools.elf.sections import SymbolTableSection
+
+        elf = self.elf.elf
+        if elf['e_type'] != 'ET_REL':
+            raise LinkError(f'{self.elf.name} is not a relocatable object (build it with -c)')
+        # (name, value, type, shndx) per symbol number
+        self._symbols = []
+        # name -> symbol number of the global definitions
+        self._globals = {}
+        # section index -> sorted [(offset, 'a'/'t'/'d')] from the mapping symbols
+        self._mapping = {}
+        # section index -> [(offset, type, symbol number, addend or None for REL)]
+        self._relocs = {}
+        for section in elf.iter_sections():
+            if isinstance(section, SymbolTableSection):
+                for symbol in section.iter_symbols():
+                    shndx = symbol['st_shndx']
+                    info = symbol['st_info']
+                    self._symbols.append((symbol.name, symbol['st_value'], info['type'], shndx))
+                    if symbol.name[:2] in ('$a', '$t', '$d') and isinstance(shndx, int):
+                        self._mapping.setdefault(shndx, []).append((symbol['st_value'], symbol.name[1]))
+                    elif info['bind'] != 'STB_LOCAL' and shndx != 'SHN_UNDEF':
+                        self._globals.setdefault(symbol.name, len(self._symbols) - 1)
+            elif isinstance(section, RelocationSection):
+                relocs = self._relocs.setdefault(section['sh_info'], [])
+                for reloc in section.iter_relocations():
+                    addend = reloc['r_addend'] if reloc.is_RELA() else None
+                    relocs.append((reloc['r_offset'], reloc['r_info_type'], reloc['r_info_sym'], addend))
+        for mapping in self._mapping.values():
+            mapping.sort()
+
+    def _section(self, index):
+        return self.elf.elf.get_section(index)
+
+    def flags(self, index):
+        '''sh_flags of section `index` (SHF_WRITE, SHF_ALLOC, SHF_EXECINSTR)'''
+        return self._section(index)['sh_flags']
+
+    def _definition(self, number):
+        '''symbol number of the definition of symbol `number` (itself unless it is undefined here)'''
+        name, _, _, shndx = self._symbols[number]
+        if shndx == 'SHN_UNDEF':
+            return self._globals.get(name, number)
+        return number
+
+    def select(self, roots=(), patterns=()):
+        '''
+        sorted indexes of the allocated sections defining `roots` (symbol names)
+        or matching `patterns` (fnmatch, e.g. '.rodata*'), and of every section
+        they refer to
+        '''
+        self._load()
+        todo = []
+        for name in roots:
+            if name not in self._globals:
+                raise LinkError(f'symbol not found: {name}')
+            todo.append(self._symbols[self._globals[name]][3])
+        for index, section in enumerate(self.elf.elf.iter_sections()):
+            if section['sh_flags'] & SHF_ALLOC and any(fnmatch(section.name, pattern) for pattern in patterns):
+                todo.append(index)
+        selected = set()
+        while todo:
+            index = todo.pop()
+            if index in selected:
+                continue
+            selected.add(index)
+            for _, _, number, _ in self._relocs.get(index, ()):
+                shndx = self._symbols[self._definition(number)][3]
+                if isinstance(shndx, int) and shndx not in selected and self._section(shndx)['sh_flags'] & SHF_ALLOC:
+                    todo.append(shndx)
+        return sorted(selected)
+
+    def _layout(self, sections):
+        '''[(index, offset)] of `sections` from offset 0, the end of the last one'''
+        offsets = []
+        end = 0
+        for index in sections:
+            section = self._section(index)
+            end = _align(end, max(section['sh_addralign'], 1))
+            offsets.append((index, end))
+            end += section['sh_size']
+        return offsets, end
+
+    def _data(self, index):
+        section = self._section(index)
+        if section['sh_type'] == 'SHT_NOBITS':
+            return bytes(section['sh_size'])
+        return section.data()
+
+    def _addend(self, rtype, data, pos, addend):
+        '''the addend of a relocation, from the bytes at `pos` for REL'''
+        if addend is not None:
+            return addend
+        if rtype in (R_ARM_ABS32, R_ARM_REL32, R_ARM_TARGET1):
+            return _signed(unpack_from('<I', data, pos)[0], 32)
+        if rtype in (R_ARM_CALL, R_ARM_JUMP24):
+            return _signed(unpack_from('<I', data, pos)[0] << 2, 26)
+        if rtype in (R_ARM_THM_CALL, R_ARM_THM_JUMP24):
+            hi, lo = unpack_from('<HH', data, pos)
+            s = hi >> 10 & 1
+            i1 = ~(lo >> 13 ^ s) & 1
+            i2 = ~(lo >> 11 ^ s) & 1
+            return _signed(s << 24 | i1 << 23 | i2 << 22 | (hi & 0x3FF) << 12 | (lo & 0x7FF) << 1, 25)
+        if rtype in (R_ARM_MOVW_ABS_NC, R_ARM_MOVT_ABS):
+            insn = unpack_from('<I', data, pos)[0]
+            return _signed((insn >> 4 & 0xF000) | insn & 0xFFF, 16)
+        if rtype in (R_ARM_THM_MOVW_ABS_NC, R_ARM_THM_MOVT_ABS):
+            return _signed(_thumb_imm16(*unpack_from('<HH', data, pos)), 16)
+        return 0
+
+    def _thumb(self, number, offset):
+        '''
+        is the code symbol `number` + `offset` points to thumb: bit 0 of functions,
+        the mapping symbols for the rest, None when nothing tells
+        '''
+        name, value, stype, shndx = self._symbols[self._definition(number)]
+        if stype == 'STT_FUNC':
+            return bool(value & 1)
+        if shndx == 'SHN_UNDEF':
+            return bool(self.symbols[name] & 1) if name in self.symbols else None
+        mapping = self._mapping.get(shndx)
+        if not mapping:
+            return None
+        i = bisect_right(mapping, (value + offset, '~')) - 1
+        return mapping[i][1] == 't' if i >= 0 else None
+
+    def _needs_veneer(self, number, thumb, segment_sections):
+        '''may a branch from `thumb` code to symbol `number` need a veneer, before anything is placed'''
+        shndx = self._symbols[self._definition(number)][3]
+        if shndx not in segment_sections:
+            return True
+        target = self._thumb(number, 0)
+        return target is not None and target != thumb
+
+    def measure(self, sections):
+        '''(size, alignment) of the segment place() makes of `sections`, with the room for the veneers'''
+        self._load()
+        offsets, end = self._layout(sections)
+        selected = set(sections)
+        veneers = set()
+        for index, offset in offsets:
+            data = self._data(index)
+            for r_offset, rtype, number, addend in self._relocs.get(index, ()):
+                if rtype in BRANCHES:
+                    thumb = BRANCHES[rtype][0]
+                    if self._needs_veneer(number, thumb, selected):
+                        veneers.add((number, self._addend(rtype, data, r_offset, addend), thumb))
+        size = _align(end, 4) + sum(VENEER_SIZE[thumb] for _, _, thumb in veneers)
+        align = max([4] + [self._section(index)['sh_addralign'] for index in sections])
+        return size, align
+
+    def place(self, sections, address: int, vma: int = None, name: str = 'rom'):
+        '''
+        lay `sections` out from `address` (rom address, where the bytes go) for
+        code running at `vma` (with base, default base + address), return the
+        segment {'name', 'address', 'vma', 'size', 'reserved', 'sections': [{'name', 'address', 'size'}]};
+        'reserved' is the size from measure(), 'size' the same until resolve()
+        '''
+        if vma is None:
+            vma = self.base + address
+        size, align = self.measure(sections)
+        if vma % align:
+            raise LinkError(f'segment {name} at 0x{vma:08x} is not aligned to 0x{align:x}')
+        offsets, end = self._layout(sections)
+        segment = {
+            'name': name,
+            'address': address,
+            'vma': vma,
+            'size': size,
+            'reserved': size,
+            'sections': [
+                {
+                    'name': self._section(index).name,
+                    'address': address + offset,
+                    'size': self._section(index)['sh_size'],
+                }
+                for index, offset in offsets
+            ],
+            'veneers': 0,
+            '_offsets': offsets,
+            '_end': end,
+        }
+        for index, offset in offsets:
+            if index in self._placed:
+                raise LinkError(f'section {self._section(index).name} is placed twice')
+            self._placed[index] = (segment, offset)
+        self.segments.append(segment)
+        return segment
+
+    def address_of(self, name: str):
+        '''(address with base, thumb) of a linked symbol'''
+        self._load()
+        if name not in self._globals:
+            raise LinkError(f'symbol not found: {name}')
+        number = self._globals[name]
+        address, thumb = self._resolve(number)
+        return address, bool(thumb)
+
+    def _resolve(self, number):
+        '''(address with base, thumb or None) of symbol `number`'''
+        name, value, stype, shndx = self._symbols[self._definition(number)]
+        if shndx == 'SHN_UNDEF':
+            if name not in self.symbols:
+                raise LinkError(f'undefined symbol: {name}')
+            address = self.symbols[name]
+            return address & ~1, bool(address & 1) if address & 1 else None
+        if shndx == 'SHN_ABS':
+            return value, None
+        if shndx == 'SHN_COMMON':
+            raise LinkError(f'common symbol {name}, build with -fno-common')
+        if shndx not in self._placed:
+            raise LinkError(f'{name or "a symbol"} is in {self._section(shndx).name}, which was not placed')
+        segment, offset = self._placed[shndx]
+        if stype == 'STT_FUNC':
+            return segment['vma'] + offset + (value & ~1), bool(value & 1)
+        return segment['vma'] + offset + value, None
+
+    def resolve(self):
+        '''
+        apply the relocations of every placed section, return the segments
+        with their bytes in 'data', 'size' trimmed to the veneers used
+        '''
+        for segment in self.segments:
+            data = bytearray(segment['size'])
+            for index, offset in segment['_offsets']:
+                section = self._data(index)
+                data[offset : offset + len(section)] = section
+            # (target with the thumb bit, thumb caller) -> offset of the veneer
+            veneers = {}
+            end = _align(segment['_end'], 4)
+
+            def veneer(target, thumb):
+                nonlocal end
+                key = (target, thumb)
+                if key not in veneers:
+                    code = (THUMB_VENEER if thumb else ARM_VENEER) + pack('<I', target & 0xFFFFFFFF)
+                    if end + len(code) > len(data):
+                        raise LinkError(f'no room left for the veneers of segment {segment["name"]}')
+                    data[end : end + len(code)] = code
+                    veneers[key] = end
+                    end += len(code)
+                return segment['vma'] + veneers[key]
+
+            for index, offset in segment['_offsets']:
+                for reloc in self._relocs.get(index, ()):
+                    self._apply(segment, data, offset, index, reloc, veneer)
+            segment['data'] = bytes(data[:end])
+            segment['size'] = end
+            segment['veneers'] = len(veneers)
+            segment['digest'] = hashlib.sha1(segment['data']).hexdigest()
+        return self.segments
+
+    def _apply(self, segment, data, section_offset, index, reloc, veneer):
+        r_offset, rtype, number, addend = reloc
+        if rtype in (R_ARM_NONE, R_ARM_V4BX):
+            return
+        pos = section_offset + r_offset
+        place = segment['vma'] + pos
+        addend = self._addend(rtype, data, pos, addend)
+        address, thumb = self._resolve(number)
+
+        if rtype in BRANCHES:
+            caller_thumb, bias, reach = BRANCHES[rtype]
+            target = address + addend + bias
+            if thumb is None:
+                thumb = self._thumb(number, addend + bias)
+            if thumb is None:
+                thumb = caller_thumb
+            offset = target - (place + bias)
+            if thumb != caller_thumb or not -reach <= offset < reach:
+                target = veneer(target | thumb, caller_thumb)
+                offset = target - (place + bias)
+            if rtype == R_ARM_THM_CALL:
+                # a blx becomes a bl, the veneers do the switching
+                data[pos : pos + 4] = encode_thumb_bl(place, target)
+            elif rtype == R_ARM_THM_JUMP24:
+                data[pos : pos + 4] = _encode_thumb_b_w(place, target)
+            else:
+                insn = unpack_from('<I', data, pos)[0]
+                pack_into('<I', data, pos, insn & 0xFF000000 | (offset >> 2) & 0xFFFFFF)
+            return
+
+        value = (address + addend) | bool(thumb)
+        if rtype in (R_ARM_ABS32, R_ARM_TARGET1):
+            pack_into('<I', data, pos, value & 0xFFFFFFFF)
+        elif rtype == R_ARM_REL32:
+            pack_into('<I', data, pos, (value - place) & 0xFFFFFFFF)
+        elif rtype in (R_ARM_MOVW_ABS_NC, R_ARM_MOVT_ABS):
+            imm = (value >> 16 if rtype == R_ARM_MOVT_ABS else value) & 0xFFFF
+            insn = unpack_from('<I', data, pos)[0]
+            pack_into('<I', data, pos, insn & 0xFFF0F000 | (imm & 0xF000) << 4 | imm & 0xFFF)
+        elif rtype in (R_ARM_THM_MOVW_ABS_NC, R_ARM_THM_MOVT_ABS):
+            imm = (value >> 16 if rtype == R_ARM_THM_MOVT_ABS else value) & 0xFFFF
+            hi, lo = unpack_from('<HH', data, pos)
+            hi = hi & 0xFBF0 | imm >> 12 | (imm >> 11 & 1) << 10
+            lo = lo & 0x8F00 | (imm >> 8 & 7) << 12 | imm & 0xFF
+            pack_into('<HH', data, pos, hi, lo)
+        else:
+            raise LinkError(f'unsupported relocation type {rtype} at {self._section(index).name}+0x{r_offset:x}')
@@ -0,0 +1,138 @@
+import hashlib
+import os
+
+from .base import load_json, save_json
+
+
+def file_digest(path: str):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(0x100000), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _writes_to_json(writes):
+    return [[start, data.hex()] for start, data in writes]
+
+
+def _writes_from_json(writes):
+    return [(start, bytes.fromhex(data)) for start, data in writes]
+
+
+def _range(value):
+    return None if value is None else tuple(value)
+
+
+class PatchManifest:
+    '''
+    what an earlier patch_rom run wrote, stored next to its output
+
+    one entry per job:
+        key         hash of the job dict, of the function bytes, of minimal_save and of
+                    the address of the linked function
+        job         the job dict
+        placement   (trampoline address, size), (None, size) for patch jobs
+        writes      [(start, original bytes)] of every range the job wrote
+        read        (start, end) of the bytes the hook may relocate, None for patch jobs
+        path        [(start, end)] of the code a call of the hook runs, None for patch jobs
+        relocated   (start, end) of the instructions the hook moved, None for patch jobs
+
+    `stubs` are the shared stubs the hooks call (see patch_rom's `shared_stubs`),
+    {'arch', 'type', 'address', 'size', 'writes'}, `segments` the linked hook
+    functions (see patch_rom's `link`), {'address', 'size', 'digest', 'writes', ...}
+
+    `digest` is the sha1 of the patched rom, `source_digest` the one of the
+    source rom when the output went to another file; a manifest only applies
+    to the rom it was made for (see matches())
+
+    it is saved as JSON, the bytes as hex
+    '''
+
+    VERSION = 6
+
+    def __init__(
+        self, base: int, entries=None, digest: str = None, source_digest: str = None, stubs=None, segments=None
+    ):
+        self.base = base
+        self.entries = entries or []
+        self.digest = digest
+        self.source_digest = source_digest
+        self.stubs = stubs or []
+        self.segments = segments or []
+
+    @staticmethod
+    def job_key(job: dict, function_codes=None, minimal_save=False, function_address=None):
+        digest = hashlib.sha1(repr(sorted(job.items())).encode())
+        if function_codes is not None:
+            digest.update(function_codes)
+        if minimal_save:
+            # another trampoline for the same job
+            digest.update(b'minimal_save')
+        if function_address is not None:
+            # calls the linked function instead of a copy
+            digest.update(f'linked {function_address}'.encode())
+        return digest.hexdigest()
+
+    def add(self, key, job, placement, writes, read=None, path=None, relocated=None):
+        entry = {
+            'key': key,
+            'job': dict(job),
+            'placement': placement,
+            'writes': writes,
+            'read': read,
+            'path': path,
+            'relocated': relocated,
+        }
+        self.entries.append(entry)
+        return entry
+
+    def matches(self, base: int, path: str, source_digest: str = None):
+        '''is the rom at `path` still what this manifest describes (and made from the same source)'''
+        if base != self.base or source_digest != self.source_digest or not os.path.exists(path):
+            return False
+        return file_digest(path) == self.digest
+
+    @classmethod
+    def load(cls, path: str):
+        '''the manifest at `path`, None if there is none (or a broken/foreign one)'''
+        data = load_json(path, cls.VERSION)
+        if data is None:
+            return None
+        try:
+            entries = [
+                {
+                    **entry,
+                    'placement': tuple(entry['placement']),
+                    'writes': _writes_from_json(entry['writes']),
+                    'read': _range(entry['read']),
+                    'path': None if entry['path'] is None else [tuple(run) for run in entry['path']],
+                    'relocated': _range(entry['relocated']),
+                }
+                for entry in data['entries']
+            ]
+            stubs = [{**stub, 'writes': _writes_from_json(stub['writes'])} for stub in data['stubs']]
+            segments = [
+                {**segment, 'data': bytes.fromhex(segment['data']), 'writes': _writes_from_json(segment['writes'])}
+                for segment in data['segments']
+            ]
+            return cls(data['base'], entries, data['digest'], data['source_digest'], stubs, segments)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def save(self, path: str):
+        save_json(
+            path,
+            self.VERSION,
+            {
+                'base': self.base,
+                'digest': self.digest,
+                'source_digest': self.source_digest,
+                'entries': [{**entry, 'writes': _writes_to_json(entry['writes'])} for entry in self.entries],
+                'stubs': [{**stub, 'writes': _writes_to_json(stub['writes'])} for stub in self.stubs],
+                'segments': [
+                    {**segment, 'data': segment['data'].hex(), 'writes': _writes_to_json(segment['writes'])}
+                    for segment in self.segments
+                ],
+            },
+        )
@@ -0,0 +1,85 @@
+class PatchOptions:
+    '''
+    the optional features of patch_rom, each one can also be passed to
+    patch_rom as a keyword argument (which overrides `options`)
+    '''
+
+    def __init__(
+        self,
+        asm_cache=None,
+        elf_cache_path: str = None,
+        align: int = 0x10,
+        workers: int = None,
+        tracer=None,
+        manifest_path: str = None,
+        patch_path: str = None,
+        functions: dict = None,
+        shared_stubs: bool = False,
+        minimal_save: bool = False,
+        link: bool = False,
+        link_sections=(),
+        link_symbols: dict = None,
+        ram_region=None,
+        ram_init: dict = None,
+        platform: str = None,
+        xrefs: str = None,
+        xref_cache_path: str = None,
+        xref_regions=None,
+        codec=None,
+    ):
+        # an AsmCache for keystone results, saved after patching if it has a path
+        self.asm_cache = asm_cache
+        # where ElfHelper keeps the symbol index of code_path
+        self.elf_cache_path = elf_cache_path
+        # alignment of the trampolines in the free space
+        self.align = align
+        # > 1: plan the hooks, then generate their code in that many processes (ParallelPlanner)
+        self.workers = workers
+        # a PatchTracer, the jobs are then patched serially
+        self.tracer = tracer
+        # a PatchManifest of the run, the next one only re-patches the changed jobs
+        self.manifest_path = manifest_path
+        # an .ips or .bps from the source rom to the result, rom left as it is without output_path
+        self.patch_path = patch_path
+        # {name: bytes} of the hook functions when the elf was already read
+        self.functions = functions
+        # hooks call one register save/restore stub per arch and type instead of inlining it
+        self.shared_stubs = shared_stubs
+        # hooks save only the registers their function uses (analysis.analyze_hook_function)
+        self.minimal_save = minimal_save
+        # link the hook functions once with what they use (link_hook_functions), code_path is a .o
+        self.link = link
+        # more sections to link, fnmatch patterns
+        self.link_sections = link_sections
+        # {name: address with base} for the symbols the elf leaves undefined
+        self.link_symbols = link_symbols
+        # (address with base, size) in IWRAM/ITCM for the jobs with 'ram' and .data/.bss
+        self.ram_region = ram_region
+        # {'arch', 'address'} run once at boot, where ram_copy_job copies the ram segment
+        self.ram_init = ram_init
+        # 'gba', 'nds9' or 'nds7' for the cycle estimates (cycles.MEMORY_TIMINGS)
+        self.platform = platform
+        # 'warn' or 'refuse' hooks whose moved instructions are branched into (BranchIndex)
+        self.xrefs = xrefs
+        # where the BranchIndex of the rom is kept
+        self.xref_cache_path = xref_cache_path
+        # [(start, end)] the code regions to sweep for branches
+        self.xref_regions = xref_regions
+        # a compress.Codec or its name ('arm9', 'blz', 'lz77', 'lz77_vram') for a compressed rom
+        self.codec = codec
+
+    def __repr__(self):
+        defaults = vars(PatchOptions())
+        changed = ', '.join(f'{name}={value!r}' for name, value in vars(self).items() if value != defaults[name])
+        return f'PatchOptions({changed})'
+
+    def replace(self, **changes):
+        '''a copy with `changes`, TypeError for an unknown option'''
+        return PatchOptions(**{**vars(self), **changes})
+
+    def check(self, jobs, code_path: str = None, output_path: str = None):
+        '''ValueError for options that can't go together'''
+        if self.patch_path and self.manifest_path and not output_path:
+            raise ValueError('a patch file with a manifest needs output_path, the manifest tracks the output')
+        if (self.link or any(job.get('ram') for job in jobs)) and not code_path:
+            raise ValueError("link and jobs with 'ram' need code_path, the elf to link")
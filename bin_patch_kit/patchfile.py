@@ -0,0 +1,274 @@
+import mmap
+import os
+import shutil
+import zlib
+
+IPS_MAGIC = b'PATCH'
+IPS_EOF = b'EOF'
+# a record can't start here, its offset would read as the EOF marker
+IPS_EOF_OFFSET = 0x454F46
+IPS_MAX_OFFSET = 0xFFFFFF
+IPS_MAX_RECORD = 0xFFFF
+# runs of one byte at least this long become RLE records
+IPS_RLE_MIN = 0x10
+
+BPS_MAGIC = b'BPS1'
+BPS_SOURCE_READ = 0
+BPS_TARGET_READ = 1
+BPS_SOURCE_COPY = 2
+BPS_TARGET_COPY = 3
+
+
+def _runs(data):
+    '''split `data` into (offset, length, rle) pieces, rle for long runs of one byte'''
+    pieces = []
+    start = 0
+    i = 0
+    while i < len(data):
+        j = i + 1
+        while j < len(data) and data[j] == data[i]:
+            j += 1
+        if j - i >= IPS_RLE_MIN:
+            if i > start:
+                pieces.append((start, i - start, False))
+            pieces.append((i, j - i, True))
+            start = j
+        i = j
+    if start < len(data):
+        pieces.append((start, len(data) - start, False))
+    return pieces
+
+
+def make_ips(target, ranges, source_size: int = None):
+    '''
+    IPS patch (bytes) writing the `ranges` [(start, end)] of `target`
+    `source_size` adds the truncation extension when the target is shorter
+    '''
+    out = bytearray(IPS_MAGIC)
+    for start, end in ranges:
+        if end - 1 > IPS_MAX_OFFSET:
+            raise ValueError(f'IPS offsets stop at 16MB, 0x{start:x}-0x{end:x} needs a BPS patch')
+        for offset, length, rle in _runs(target[start:end]):
+            offset += start
+            while length:
+                if offset == IPS_EOF_OFFSET:
+                    # start one byte earlier, the byte before is written as it is
+                    size = 1 if rle else min(length, IPS_MAX_RECORD - 1)
+                    out += (offset - 1).to_bytes(3, 'big') + (size + 1).to_bytes(2, 'big')
+                    out += target[offset - 1 : offset + size]
+                elif rle:
+                    size = min(length, IPS_MAX_RECORD)
+                    out += offset.to_bytes(3, 'big') + bytes(2) + size.to_bytes(2, 'big') + bytes([target[offset]])
+                else:
+                    size = min(length, IPS_MAX_RECORD)
+                    out += offset.to_bytes(3, 'big') + size.to_bytes(2, 'big') + target[offset : offset + size]
+                offset += size
+                length -= size
+    out += IPS_EOF
+    if source_size is not None and len(target) < source_size:
+        out += len(target).to_bytes(3, 'big')
+    return bytes(out)
+
+
+def _bps_number(value):
+    out = bytearray()
+    while True:
+        x = value & 0x7F
+        value >>= 7
+        if value == 0:
+            out.append(0x80 | x)
+            return out
+        out.append(x)
+        value -= 1
+
+
+def _bps_action(out, action, length):
+    out += _bps_number((length - 1) << 2 | action)
+
+
+def make_bps(source, target, ranges, metadata: bytes = b''):
+    '''
+    BPS patch (bytes) turning `source` into `target`, which only differ in `ranges`
+    the bytes in between are copied from the source (SourceRead), the ranges
+    are stored as they are (TargetRead)
+    '''
+    out = bytearray(BPS_MAGIC)
+    out += _bps_number(len(source)) + _bps_number(len(target)) + _bps_number(len(metadata)) + metadata
+    pos = 0
+    for start, end in list(ranges) + [(len(target), len(target))]:
+        # SourceRead can't go past the end of the source
+        middle = max(pos, min(start, len(source)))
+        if middle > pos:
+            _bps_action(out, BPS_SOURCE_READ, middle - pos)
+        if end > middle:
+            _bps_action(out, BPS_TARGET_READ, end - middle)
+            out += target[middle:end]
+        pos = end
+    out += zlib.crc32(source).to_bytes(4, 'little')
+    out += zlib.crc32(target).to_bytes(4, 'little')
+    out += zlib.crc32(out).to_bytes(4, 'little')
+    return bytes(out)
+
+
+def diff_ranges(source, target, chunk: int = 0x1000):
+    '''[(start, end)] of the bytes of `target` that differ from `source` (or are past its end)'''
+    ranges = []
+    size = min(len(source), len(target))
+    for base in range(0, size, chunk):
+        end = min(base + chunk, size)
+        if source[base:end] == target[base:end]:
+            continue
+        for i in range(base, end):
+            if source[i] != target[i]:
+                if ranges and ranges[-1][1] == i:
+                    ranges[-1] = (ranges[-1][0], i + 1)
+                else:
+                    ranges.append((i, i + 1))
+    if len(target) > size:
+        if ranges and ranges[-1][1] == size:
+            ranges[-1] = (ranges[-1][0], len(target))
+        else:
+            ranges.append((size, len(target)))
+    return ranges
+
+
+def write_patch(path: str, source, target, ranges):
+    '''write an IPS or BPS patch (by the extension of `path`), return its size'''
+    if path.lower().endswith('.bps'):
+        data = make_bps(source, target, ranges)
+    elif path.lower().endswith('.ips'):
+        data = make_ips(target, ranges, len(source))
+    else:
+        raise ValueError(f'unknown patch format: {path}')
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return len(data)
+
+
+def _file_crc32(fp):
+    crc = 0
+    for chunk in iter(lambda: fp.read(0x100000), b''):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def apply_ips(patch: bytes, rom_path: str, output_path: str = None):
+    '''apply an IPS patch to `rom_path` (or to a copy at `output_path`), only the patched bytes are touched'''
+    if not patch.startswith(IPS_MAGIC):
+        raise ValueError('not an IPS patch')
+    if output_path:
+        shutil.copyfile(rom_path, output_path)
+    pos = len(IPS_MAGIC)
+    with open(output_path or rom_path, 'rb+') as fp:
+        while True:
+            if patch[pos : pos + 3] == IPS_EOF:
+                pos += 3
+                break
+            if pos + 5 > len(patch):
+                raise ValueError('truncated IPS patch')
+            offset = int.from_bytes(patch[pos : pos + 3], 'big')
+            size = int.from_bytes(patch[pos + 3 : pos + 5], 'big')
+            pos += 5
+            fp.seek(offset, os.SEEK_SET)
+            if size:
+                fp.write(patch[pos : pos + size])
+                pos += size
+            else:
+                size = int.from_bytes(patch[pos : pos + 2], 'big')
+                fp.write(patch[pos + 2 : pos + 3] * size)
+                pos += 3
+        if len(patch) >= pos + 3:
+            fp.truncate(int.from_bytes(patch[pos : pos + 3], 'big'))
+
+
+def _bps_decode(patch, pos):
+    value = 0
+    shift = 1
+    while True:
+        x = patch[pos]
+        pos += 1
+        value += (x & 0x7F) * shift
+        if x & 0x80:
+            return value, pos
+        shift <<= 7
+        value += shift
+
+
+def apply_bps(patch: bytes, rom_path: str, output_path: str = None):
+    '''
+    apply a BPS patch, the patch, source and target CRC32 are all checked
+    raise ValueError (leaving the files alone) when one does not match
+    '''
+    if not patch.startswith(BPS_MAGIC) or len(patch) < len(BPS_MAGIC) + 12:
+        raise ValueError('not a BPS patch')
+    footer = patch[-12:]
+    source_crc, target_crc, patch_crc = (int.from_bytes(footer[i : i + 4], 'little') for i in (0, 4, 8))
+    if zlib.crc32(patch[:-4]) != patch_crc:
+        raise ValueError('BPS patch checksum mismatch, the patch is damaged')
+
+    with open(rom_path, 'rb') as fp:
+        if _file_crc32(fp) != source_crc:
+            raise ValueError(f'{rom_path} is not the rom this patch was made for')
+        size = os.fstat(fp.fileno()).st_size
+        source = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    try:
+        pos = len(BPS_MAGIC)
+        source_size, pos = _bps_decode(patch, pos)
+        target_size, pos = _bps_decode(patch, pos)
+        metadata_size, pos = _bps_decode(patch, pos)
+        pos += metadata_size
+        if source_size != size:
+            raise ValueError(f'{rom_path} is not the rom this patch was made for')
+
+        target = bytearray(target_size)
+        out = 0
+        source_rel = target_rel = 0
+        end = len(patch) - 12
+        while pos < end:
+            data, pos = _bps_decode(patch, pos)
+            action, length = data & 3, (data >> 2) + 1
+            if out + length > target_size:
+                raise ValueError('broken BPS patch, writes past the target')
+            if action == BPS_SOURCE_READ:
+                if out + length > source_size:
+                    raise ValueError('broken BPS patch, reads past the source')
+                target[out : out + length] = source[out : out + length]
+            elif action == BPS_TARGET_READ:
+                target[out : out + length] = patch[pos : pos + length]
+                pos += length
+            else:
+                offset, pos = _bps_decode(patch, pos)
+                offset = -(offset >> 1) if offset & 1 else offset >> 1
+                if action == BPS_SOURCE_COPY:
+                    source_rel += offset
+                    if source_rel < 0 or source_rel + length > source_size:
+                        raise ValueError('broken BPS patch, reads past the source')
+                    target[out : out + length] = source[source_rel : source_rel + length]
+                    source_rel += length
+                else:
+                    target_rel += offset
+                    # may overlap the bytes being written, copy byte by byte
+                    for i in range(length):
+                        target[out + i] = target[target_rel + i]
+                    target_rel += length
+            out += length
+    finally:
+        if isinstance(source, mmap.mmap):
+            source.close()
+
+    if zlib.crc32(target) != target_crc:
+        raise ValueError('BPS target checksum mismatch')
+    with open(output_path or rom_path, 'wb') as fp:
+        fp.write(target)
+
+
+def apply_patch(patch_path: str, rom_path: str, output_path: str = None):
+    '''apply an IPS or BPS patch file (by its header) to `rom_path`, or to a copy at `output_path`'''
+    with open(patch_path, 'rb') as fp:
+        patch = fp.read()
+    if patch.startswith(BPS_MAGIC):
+        apply_bps(patch, rom_path, output_path)
+    elif patch.startswith(IPS_MAGIC):
+        apply_ips(patch, rom_path, output_path)
+    else:
+        raise ValueError(f'{patch_path} is neither an IPS nor a BPS patch')
@@ -0,0 +1,234 @@
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import mmap
+
+from .arm import ArmPatcher, ThumbPatcher
+from .cache import AsmCache
+from .session import RomBuffer
+
+
+def generate_hook(
+    patcher, hook_type: str, target_address: int, empty_address: int, function_codes, function_address=None
+):
+    '''
+    emit a hook at `empty_address` and take it back again
+    return (size, writes, read range, path, relocated), writes are (address, bytes) of
+    the final content, path the ranges a call runs (Patcher.hook_path), relocated the
+    instructions moved (Patcher.relocated), size is None when the hook does not fit
+    '''
+    method = patcher.set_hooker if hook_type == 'hook' else patcher.set_function_hooker
+    buffer = patcher._io
+    mark = buffer.checkpoint()
+    try:
+        # the bytes relocated from the target are the only bytes the hook reads
+        jmp_size = patcher._get_jmp_patch_size(target_address, empty_address)
+        read_range = (target_address, target_address + patcher.get_min_opcodes_len(target_address, jmp_size))
+        try:
+            size = method(
+                target_address=target_address,
+                empty_address=empty_address,
+                function_codes=function_codes,
+                function_address=function_address,
+            )
+        except IndexError:
+            return None, None, read_range, None, None
+        view = buffer.getbuffer()
+        writes = [(start, bytes(view[start:end])) for start, end in buffer.dirty_since(mark)]
+        view.release()
+        return size, writes, read_range, patcher.hook_path, patcher.relocated
+    finally:
+        buffer.rollback(mark)
+
+
+# per worker process state, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(source, base: int, asm_cache_path: str, stubs=(), minimal_save=False):
+    if isinstance(source, str):
+        fp = open(source, 'rb')
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        _worker['file'] = fp
+    else:
+        buf = bytearray(source)
+    buffer = RomBuffer(buf)
+    asm_cache = AsmCache(asm_cache_path)
+    _worker['patchers'] = {
+        'arm': ArmPatcher(buffer, base, asm_cache=asm_cache),
+        'thumb': ThumbPatcher(buffer, base, asm_cache=asm_cache),
+    }
+    for patcher in _worker['patchers'].values():
+        patcher.minimal_save = minimal_save
+    for stub in stubs:
+        _worker['patchers'][stub['arch']].add_shared_stub(stub['type'], stub['address'])
+
+
+def _generate(task):
+    key, arch, hook_type, target_address, empty_address, function_codes, function_address = task
+    patcher = _worker['patchers'][arch]
+    return key, generate_hook(patcher, hook_type, target_address, empty_address, function_codes, function_address)
+
+
+class ParallelPlanner:
+    '''
+    plan/commit pipeline for patch_rom
+
+    plan: replay the serial placement rule (utils.choose_block) with trampoline
+    sizes looked up in a memo of (job, address) -> generated code; sizes not in
+    the memo are guessed, the missing (job, address) pairs are generated in a
+    process pool against a read-only snapshot of the rom, and the replay runs
+    again until it needs nothing new
+
+    commit: write the memoized code of every job at its planned address in job
+    order, which gives the same bytes as the serial path as long as no job reads
+    bytes an earlier job writes (checked, the caller falls back to serial)
+    '''
+
+    MAX_ROUNDS = 8
+
+    def __init__(self, session, jobs: list, functions: dict, workers: int, stubs=(), linked=None):
+        self.session = session
+        self.jobs = jobs
+        self.functions = functions
+        # {function name: rom address} of the linked functions (utils.link_hook_functions)
+        self.linked = linked or {}
+        self.workers = workers
+        # shared stubs already in the session (utils.emit_shared_stubs)
+        self.stubs = [{'arch': stub['arch'], 'type': stub['type'], 'address': stub['address']} for stub in stubs]
+        self.memo = {}
+        self.last_size = {}
+
+    def _snapshot(self):
+        buffer = self.session.buffer
+        if self.session.codec is None and not buffer.dirty_ranges() and len(buffer) > 0:
+            # untouched, workers can map the file themselves
+            return self.session.rom_path
+        return bytes(buffer.getbuffer())
+
+    def _replay(self, allocator):
+        from .utils import choose_block, hook_estimate
+
+        placements = {}
+        missing = []
+        for index, job in enumerate(self.jobs):
+            if job['type'] not in ('hook', 'hook_func'):
+                continue
+            patcher = self.session.patcher(job['arch'])
+            codes = self.functions[job['func']]
+            estimate = hook_estimate(codes, job['func'] in self.linked)
+            guess = self.last_size.get(index) or estimate
+
+            def try_at(address):
+                result = self.memo.get((index, address))
+                if result is None:
+                    missing.append((index, address))
+                    return guess
+                return result[0]
+
+            try:
+                address, size = choose_block(allocator, job['address'], estimate, patcher._in_range, try_at)
+            except ValueError:
+                if missing:
+                    # maybe only out of space because of guessed sizes
+                    return None, missing
+                raise
+            allocator.take(address, size)
+            placements[index] = (address, size)
+        return placements, missing
+
+    def _generate(self, executor, keys):
+        tasks = []
+        for index, address in dict.fromkeys(keys):
+            job = self.jobs[index]
+            tasks.append(
+                (
+                    (index, address),
+                    job['arch'],
+                    job['type'],
+                    job['address'],
+                    address,
+                    bytes(self.functions[job['func']]),
+                    self.linked.get(job['func']),
+                )
+            )
+        chunksize = max(1, len(tasks) // (self.workers * 4))
+        for key, result in executor.map(_generate, tasks, chunksize=chunksize):
+            self.memo[key] = result
+            if result[0] is not None:
+                self.last_size[key[0]] = result[0]
+
+    def plan(self, allocator):
+        '''return {job index: (address, size)} for the hooks, the allocator is left untouched'''
+        cache = self.session.asm_cache
+        initargs = (
+            self._snapshot(),
+            self.session.base,
+            cache.path if cache is not None else None,
+            self.stubs,
+            self.session.minimal_save,
+        )
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=initargs) as executor:
+            for _ in range(self.MAX_ROUNDS):
+                placements, missing = self._replay(copy.deepcopy(allocator))
+                if not missing:
+                    return placements
+                self._generate(executor, missing)
+        return None
+
+    def commit(self, allocator, placements):
+        '''
+        write the planned code into the session, return {job index: (address, size)}
+        or None without touching anything when a job depends on bytes written before it
+        '''
+        buffer = self.session.buffer
+        writes = []
+        reads = []
+        paths = {}
+        relocated = {}
+        for index, job in enumerate(self.jobs):
+            if job['type'] in ('hook', 'hook_func'):
+                result = self.memo[(index, placements[index][0])]
+                size, job_writes, read_range, paths[index], relocated[index] = result
+                reads.append((read_range, index))
+            elif job['type'] == 'patch':
+                mark = buffer.checkpoint()
+                size = self.session.patcher(job['arch']).assemble(job['asm'], job['address'])
+                view = buffer.getbuffer()
+                job_writes = [(start, bytes(view[start:end])) for start, end in buffer.dirty_since(mark)]
+                view.release()
+                buffer.rollback(mark)
+                placements[index] = (None, size)
+            else:
+                raise TypeError(f"unknown type: {job['type']}")
+            writes.extend((start, data, index) for start, data in job_writes)
+
+        if self._depends(writes, reads):
+            return None
+
+        for start, data, _ in writes:
+            buffer.seek(start)
+            buffer.write(data)
+        self.session.paths.update(paths)
+        self.session.relocated.update(relocated)
+        for index, (address, size) in placements.items():
+            if address is not None:
+                allocator.take(address, size)
+        return placements
+
+    @staticmethod
+    def _depends(writes, reads):
+        '''does any job read a range written by an earlier job'''
+        if not writes:
+            return False
+        ranges = sorted((start, start + len(data), index) for start, data, index in writes)
+        starts = [start for start, _, _ in ranges]
+        longest = max(end - start for start, end, _ in ranges)
+        for (read_start, read_end), reader in reads:
+            i = bisect_left(starts, read_start - longest)
+            while i < len(ranges) and ranges[i][0] < read_end:
+                start, end, writer = ranges[i]
+                if end > read_start and writer < reader:
+                    return True
+                i += 1
+        return False
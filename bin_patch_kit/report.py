@@ -0,0 +1,101 @@
+import json
+
+
+class PatchReport:
+    '''
+    what patch_rom did: one entry per job plus the free space left
+    and the seconds spent in each phase (`timings`)
+
+    entries are plain dicts, `str(report)` gives a table, `to_json()` the raw data
+    '''
+
+    # (title, key, format)
+    COLUMNS = [
+        ('job', 'index', '{}'),
+        ('type', 'type', '{}'),
+        ('arch', 'arch', '{}'),
+        ('address', 'address', '{:08x}'),
+        ('func', 'func', '{}'),
+        ('trampoline', 'trampoline', '{:08x}'),
+        ('size', 'size', '0x{:x}'),
+        ('overwritten', 'overwritten', '0x{:x}'),
+        ('short', 'short_jump', '{}'),
+        ('cycles', 'cycles', '{}'),
+    ]
+
+    def __init__(self):
+        self.jobs = []
+        self.free = []
+        self.timings = {}
+        # shared stubs (patch_rom's `shared_stubs`) and what they saved
+        self.stubs = []
+        # linked hook functions (patch_rom's `link`)
+        self.segments = []
+        # {'address', 'size', 'used'} of patch_rom's `ram_region`
+        self.ram = None
+        # {'codec', 'size', 'raw_size'} of a compressed rom (patch_rom's `codec`)
+        self.packed = None
+
+    def add(self, **entry):
+        self.jobs.append(entry)
+        return entry
+
+    def used(self):
+        return (
+            sum(job.get('size') or 0 for job in self.jobs)
+            + sum(stub['size'] for stub in self.stubs)
+            + sum(segment['size'] for segment in self.segments)
+        )
+
+    def to_dict(self):
+        return {
+            'jobs': self.jobs,
+            'used': self.used(),
+            'free': [{'address': address, 'size': size} for address, size in self.free],
+            'timings': self.timings,
+            'stubs': self.stubs,
+            'segments': self.segments,
+            'ram': self.ram,
+            'packed': self.packed,
+        }
+
+    def to_json(self, path=None, indent=2):
+        text = json.dumps(self.to_dict(), indent=indent)
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(text)
+        return text
+
+    def __str__(self):
+        rows = [[title for title, _, _ in self.COLUMNS]]
+        for job in self.jobs:
+            rows.append([fmt.format(job[key]) if job.get(key) is not None else '-' for _, key, fmt in self.COLUMNS])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(self.COLUMNS))]
+        lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+        for stub in self.stubs:
+            lines.append(
+                f"shared stub {stub['arch']}/{stub['type']} at {stub['address']:08x} (0x{stub['size']:x} bytes): "
+                f"{stub['hooks']} hooks, 0x{stub['saved_per_hook']:x} bytes saved per hook, "
+                f"{stub['saved']:#x} in total, {stub['cycles_added']:+} cycles per call"
+            )
+        for segment in self.segments:
+            runs_at = f", runs at {segment['vma']:08x}" if segment['name'] == 'ram' else ''
+            lines.append(
+                f"linked {segment['name']} at {segment['address']:08x} (0x{segment['size']:x} bytes{runs_at}): "
+                f"{len(segment['sections'])} sections, {segment['veneers']} veneers"
+            )
+        for job in self.jobs:
+            if job.get('xrefs'):
+                sources = ', '.join(f'{source:08x}' for source in job['xrefs'])
+                lines.append(f"job {job['index']}: branches into the relocated code from {sources}")
+        if self.ram is not None:
+            ram = self.ram
+            lines.append(f"ram at {ram['address']:08x}: 0x{ram['used']:x} of 0x{ram['size']:x} bytes used")
+        if self.packed is not None:
+            packed = self.packed
+            lines.append(
+                f"{packed['codec']}: 0x{packed['size']:x} bytes compressed, 0x{packed['raw_size']:x} decompressed"
+            )
+        free = sum(size for _, size in self.free)
+        lines.append(f'used 0x{self.used():x} bytes, 0x{free:x} bytes left in {len(self.free)} regions')
+        return '\n'.join(lines)
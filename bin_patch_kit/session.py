@@ -0,0 +1,282 @@
+from bisect import bisect_right
+import mmap
+import os
+import shutil
+
+
+def coalesce_ranges(ranges):
+    '''sort (start, end) ranges and merge the overlapping or adjacent ones'''
+    result = []
+    for start, end in sorted(ranges):
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+    return result
+
+
+class RomBuffer:
+    '''
+    file-like object over an in-memory rom image (bytearray or mmap)
+    patchers read and write through it exactly like a real file, while every
+    written range is recorded so that only changed bytes need to be flushed
+
+    a PatchTracer in `tracer` loses the emissions undone by rollback()
+    '''
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+        self._dirty = []
+        # (start, old bytes) for every write since the outermost checkpoint
+        self._undo = None
+        self._checkpoints = 0
+        self.tracer = None
+
+    def __len__(self):
+        return len(self._buf)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = len(self._buf) + offset
+        else:
+            raise ValueError(f'invalid whence: {whence}')
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        start = self._pos
+        end = len(self._buf) if size is None or size < 0 else min(start + size, len(self._buf))
+        self._pos = max(end, start)
+        return bytes(self._buf[start:end])
+
+    def write(self, data):
+        size = len(data)
+        start = self._pos
+        end = start + size
+        if self._undo is not None:
+            self._undo.append((start, bytes(self._buf[start:end]), len(self._buf)))
+        if end > len(self._buf):
+            if isinstance(self._buf, bytearray):
+                self._buf.extend(bytes(end - len(self._buf)))
+            else:
+                raise IndexError(f'write out of rom range: 0x{start:x}-0x{end:x}')
+        self._buf[start:end] = data
+        self._pos = end
+        if size:
+            self._dirty.append((start, end))
+        return size
+
+    def getbuffer(self):
+        # zero-copy view, same name as io.BytesIO.getbuffer
+        return memoryview(self._buf)
+
+    def dirty_ranges(self):
+        '''sorted, coalesced list of (start, end) ranges written since the last clear'''
+        ranges = coalesce_ranges(self._dirty)
+        if self._undo is None:
+            # marks of open checkpoints index into the raw list
+            self._dirty = ranges[:]
+        return ranges
+
+    def dirty_since(self, mark):
+        '''sorted, coalesced list of (start, end) ranges written since checkpoint `mark`'''
+        return coalesce_ranges(self._dirty[mark[1] :])
+
+    def original_since(self, mark):
+        '''[(start, bytes)] of the ranges written since checkpoint `mark`, as they were at `mark`'''
+        view = self.getbuffer()
+        result = [(start, bytearray(view[start:end])) for start, end in self.dirty_since(mark)]
+        view.release()
+        starts = [start for start, _ in result]
+        # replay the undo log backwards into the copies, like rollback() does into the buffer
+        for start, data, _ in reversed(self._undo[mark[0] :]):
+            if not data:
+                continue
+            range_start, original = result[bisect_right(starts, start) - 1]
+            original[start - range_start : start - range_start + len(data)] = data
+        return [(start, bytes(original)) for start, original in result]
+
+    def clear_dirty(self):
+        self._dirty = []
+
+    def checkpoint(self):
+        '''start recording writes, the returned mark can be passed to rollback() or release()'''
+        if self._undo is None:
+            self._undo = []
+        self._checkpoints += 1
+        return (len(self._undo), len(self._dirty), self._pos, self.tracer.mark() if self.tracer is not None else 0)
+
+    def rollback(self, mark):
+        '''undo every write since `mark`'''
+        undo_len, dirty_len, pos, trace_len = mark
+        while len(self._undo) > undo_len:
+            start, data, length = self._undo.pop()
+            self._buf[start : start + len(data)] = data
+            if len(self._buf) > length:
+                del self._buf[length:]
+        del self._dirty[dirty_len:]
+        self._pos = pos
+        if self.tracer is not None:
+            self.tracer.truncate(trace_len)
+        self.release(mark)
+
+    def release(self, mark):
+        '''keep the writes since `mark`'''
+        self._checkpoints -= 1
+        if self._checkpoints == 0:
+            self._undo = None
+
+    def close(self):
+        if isinstance(self._buf, mmap.mmap):
+            try:
+                self._buf.close()
+            except BufferError:
+                # views are still alive (e.g. in a traceback), the map is released with them
+                pass
+
+
+class PatchSession:
+    '''
+    load a rom once, let every patcher share the same buffer, then write
+    the changed ranges back in a single commit
+
+    with output_path the source rom is never modified, the output is a copy
+    of the source with the changed ranges applied
+
+    all patchers of the session share `asm_cache` (an AsmCache) and `tracer`
+    (a PatchTracer) if given, `minimal_save` is set on each of them
+
+    with a `codec` (a Codec or a name in compress.CODECS, e.g. 'arm9' or 'blz')
+    the file is compressed: the buffer holds the decoded bytes, so addresses
+    are the ones of the code once the game decompressed it, and commit() encodes
+    it again and rewrites the whole file (`packed_size` is then its size)
+    '''
+
+    def __init__(
+        self,
+        rom_path: str,
+        base: int,
+        output_path: str = None,
+        use_mmap: bool = True,
+        asm_cache=None,
+        tracer=None,
+        minimal_save: bool = False,
+        codec=None,
+    ):
+        from .compress import get_codec
+
+        self.rom_path = rom_path
+        self.output_path = output_path
+        self.base = base
+        self.asm_cache = asm_cache
+        self.tracer = tracer
+        self.minimal_save = minimal_save
+        self.codec = get_codec(codec)
+        self.packed_size = None
+        self._file = open(rom_path, 'rb')
+        if self.codec is not None:
+            buf = self.codec.decode(self._file.read(), base)
+        elif use_mmap and os.fstat(self._file.fileno()).st_size > 0:
+            # ACCESS_COPY: pages are shared with the file until written, writes never reach the file
+            buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            buf = bytearray(self._file.read())
+        self.buffer = RomBuffer(buf)
+        self.buffer.tracer = tracer
+        self._patchers = {}
+        self._output_ready = False
+        # {job index: [(start, end)]} what each hook runs per call (Patcher.hook_path)
+        self.paths = {}
+        # {job index: (start, end)} the instructions each hook moved (Patcher.relocated)
+        self.relocated = {}
+
+    def patcher(self, arch: str):
+        if arch not in self._patchers:
+            from .arm import ArmPatcher, ThumbPatcher
+
+            if arch == 'arm':
+                patcher = ArmPatcher
+            elif arch == 'thumb':
+                patcher = ThumbPatcher
+            else:
+                raise TypeError(f'Not support architecture: {arch}')
+            self._patchers[arch] = patcher(self.buffer, base=self.base, asm_cache=self.asm_cache, tracer=self.tracer)
+            self._patchers[arch].minimal_save = self.minimal_save
+        return self._patchers[arch]
+
+    def commit(self):
+        '''write all changed ranges to the output (or back to the source rom), return the ranges written'''
+        ranges = self.buffer.dirty_ranges()
+        path = self.rom_path
+        if self.output_path:
+            path = self.output_path
+            if not self._output_ready:
+                if not os.path.exists(path) or not os.path.samefile(path, self.rom_path):
+                    shutil.copyfile(self.rom_path, path)
+                self._output_ready = True
+
+        view = self.buffer.getbuffer()
+        if self.codec is not None:
+            if ranges:
+                packed = self.codec.encode(view, self.base)
+                with open(path, 'wb') as fp:
+                    fp.write(packed)
+            self.packed_size = os.path.getsize(path)
+        else:
+            with open(path, 'rb+') as fp:
+                for start, end in ranges:
+                    fp.seek(start, os.SEEK_SET)
+                    fp.write(view[start:end])
+        view.release()
+        self.buffer.clear_dirty()
+        return ranges
+
+    def write_patch(self, path: str, ranges=None, source_path: str = None):
+        '''
+        write an IPS or BPS patch (by the extension of `path`) from the source rom
+        (or `source_path`) to the buffer, made of the changed ranges only (or
+        `ranges`), so call it before commit(); return the ranges in the patch
+
+        with a codec the patch goes from the compressed source to the buffer
+        encoded again, made of every byte that differs (`ranges` are ignored),
+        which is usually most of the compressed part
+        '''
+        from .patchfile import diff_ranges, write_patch
+
+        ranges = self.buffer.dirty_ranges() if ranges is None else coalesce_ranges(ranges)
+        with open(source_path or self.rom_path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            source = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        view = self.buffer.getbuffer()
+        try:
+            target = view
+            if self.codec is not None:
+                target = self.codec.encode(view, self.base)
+                ranges = diff_ranges(source, target)
+            write_patch(path, source, target, ranges)
+        finally:
+            view.release()
+            if size:
+                source.close()
+        return ranges
+
+    def close(self):
+        self._patchers.clear()
+        self.buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        self.close()
@@ -0,0 +1,260 @@
+from bisect import bisect_right
+import mmap
+import re
+
+from .base import lazy_import
+
+np = lazy_import('numpy')
+
+
+class FreeSpaceIndex:
+    '''free regions of a rom as (address, size), sorted by address'''
+
+    def __init__(self, regions=()):
+        self._regions = sorted((start, size) for start, size in regions if size > 0)
+        self._starts = [start for start, _ in self._regions]
+
+    def __len__(self):
+        return len(self._regions)
+
+    def __iter__(self):
+        return iter(self._regions)
+
+    def __getitem__(self, index):
+        return self._regions[index]
+
+    def __repr__(self):
+        return f'FreeSpaceIndex({len(self)} regions, 0x{self.total():x} bytes)'
+
+    def total(self):
+        return sum(size for _, size in self._regions)
+
+    def by_size(self):
+        '''largest first, like find_empty_space'''
+        return sorted(self._regions, key=lambda x: x[1], reverse=True)
+
+    def find(self, address):
+        '''the region containing `address`, or None'''
+        i = bisect_right(self._starts, address) - 1
+        if i >= 0:
+            start, size = self._regions[i]
+            if address < start + size:
+                return self._regions[i]
+        return None
+
+    def in_range(self, low, high, min_size=0):
+        '''regions overlapping [low, high) with at least `min_size` bytes'''
+        i = max(bisect_right(self._starts, low) - 1, 0)
+        result = []
+        for start, size in self._regions[i:]:
+            if start >= high:
+                break
+            if start + size > low and size >= min_size:
+                result.append((start, size))
+        return result
+
+    def nearest(self, address, min_size=0):
+        '''the region with at least `min_size` bytes closest to `address`, or None'''
+        best = None
+        best_distance = None
+        for start, size in self._regions:
+            if size < min_size:
+                continue
+            if start <= address < start + size:
+                return (start, size)
+            distance = start - address if start > address else address - (start + size)
+            if best is None or distance < best_distance:
+                best, best_distance = (start, size), distance
+        return best
+
+
+def _normalize_fill(fill):
+    if isinstance(fill, int):
+        return (fill,)
+    return tuple(sorted(set(fill)))
+
+
+def _runs_numpy(chunk, fills, min_size):
+    a = np.frombuffer(chunk, dtype=np.uint8)
+    n = len(a)
+    runs = []
+    for value in fills:
+        # rising/falling edges of the mask give run starts/ends, fill bytes are rare in code so this stays small
+        mask = np.concatenate(([False], a == value, [False]))
+        edges = np.flatnonzero(mask[1:] != mask[:-1])
+        starts = edges[0::2]
+        ends = edges[1::2]
+        # runs touching the chunk edges are kept whatever their size, they may continue in the neighbour chunk
+        keep = (ends - starts >= min_size) | (starts == 0) | (ends == n)
+        runs.extend((start, end, value) for start, end in zip(starts[keep].tolist(), ends[keep].tolist()))
+    if len(fills) > 1:
+        runs.sort()
+    return runs
+
+
+def _runs_regex(chunk, fills, min_size, pattern):
+    n = len(chunk)
+    runs = [(m.start(), m.end(), chunk[m.start()]) for m in pattern.finditer(chunk)]
+    if chunk[0] in fills and (not runs or runs[0][0] != 0):
+        m = re.compile(re.escape(bytes([chunk[0]])) + b'+').match(chunk)
+        runs.insert(0, (0, m.end(), chunk[0]))
+    if chunk[n - 1] in fills and (not runs or runs[-1][1] != n):
+        # shorter than min_size, otherwise the pattern would have found it
+        start = n - 1
+        while start > 0 and chunk[start - 1] == chunk[n - 1]:
+            start -= 1
+        runs.append((start, n, chunk[n - 1]))
+    return runs
+
+
+def scan_free_space(name_or_buf, min_size=0x100, align=0x10, fill=0x00, chunk_size=0x100000):
+    '''
+    find runs of at least `min_size` identical fill bytes
+    `fill` is a byte value or a collection of them, e.g. (0x00, 0xFF) for GBA carts padded with 0xFF
+
+    the rom is scanned chunk by chunk (memory-mapped when a path is given) with
+    numpy run-length detection when numpy is installed, runs crossing chunk
+    boundaries are joined, the result is a FreeSpaceIndex of aligned regions
+    '''
+    assert align & 1 == 0
+    fills = _normalize_fill(fill)
+
+    fp = None
+    if isinstance(name_or_buf, str):
+        fp = open(name_or_buf, 'rb')
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        buf = name_or_buf
+
+    pattern = None
+    if np is None:
+        pattern = re.compile(b'|'.join(re.escape(bytes([v])) + b'{%d,}' % min_size for v in fills))
+
+    regions = []
+
+    def emit(start, end):
+        if end - start >= min_size:
+            pos = (start + align - 1) & (-align)
+            size = (end - pos) & (-align)
+            if size > 0:
+                regions.append((pos, size))
+
+    view = memoryview(buf)
+    try:
+        carry = None
+        for base in range(0, len(view), chunk_size):
+            chunk = view[base : base + chunk_size]
+            n = len(chunk)
+            if np is not None:
+                runs = _runs_numpy(chunk, fills, min_size)
+            else:
+                runs = _runs_regex(chunk, fills, min_size, pattern)
+            for start, end, value in runs:
+                start += base
+                end += base
+                if carry is not None:
+                    if start == carry[1] and value == carry[2]:
+                        carry = (carry[0], end, value)
+                        continue
+                    emit(carry[0], carry[1])
+                    carry = None
+                if end == base + n:
+                    carry = (start, end, value)
+                else:
+                    emit(start, end)
+            if carry is not None and carry[1] != base + n:
+                emit(carry[0], carry[1])
+                carry = None
+            chunk.release()
+        if carry is not None:
+            emit(carry[0], carry[1])
+    finally:
+        view.release()
+        if fp is not None:
+            buf.close()
+            fp.close()
+
+    return FreeSpaceIndex(regions)
+
+
+class SpaceAllocator:
+    '''
+    hand out aligned blocks from several free regions
+
+    candidates() lists start addresses for a block that should be close to
+    `near`: blocks within the patcher's short branch range first, then the
+    rest, each group best-fit first so leftovers stay as large as possible
+    '''
+
+    def __init__(self, regions, align=0x10):
+        self.align = align
+        self.regions = sorted((start, size) for start, size in regions if size > 0)
+        self._free = []
+        for start, size in self.regions:
+            pos = (start + align - 1) & (-align)
+            end = (start + size) & (-align)
+            if end > pos:
+                self._free.append([pos, end])
+
+    @classmethod
+    def unbounded(cls, address, align=0x10):
+        '''one region from `address` to the end of the address space, like the old bump allocation'''
+        return cls([(address, (1 << 64) - address)], align)
+
+    def _block(self, address):
+        for block in self._free:
+            if block[0] <= address < block[1]:
+                return block
+        return None
+
+    def fits(self, address, size):
+        block = self._block(address)
+        return block is not None and address + size <= block[1]
+
+    def take(self, address, size):
+        block = self._block(address)
+        end = (address + size + self.align - 1) & (-self.align)
+        if block is None or end > block[1]:
+            raise ValueError(f'0x{address:x}+0x{size:x} is not free')
+        i = self._free.index(block)
+        pieces = [[block[0], address], [end, block[1]]]
+        self._free[i : i + 1] = [p for p in pieces if p[1] > p[0]]
+
+    def reserve(self, address, size):
+        '''take a block that may span several free blocks, ignore what is already used'''
+        end = address + size
+        result = []
+        for start, stop in self._free:
+            if stop <= address or start >= end:
+                result.append([start, stop])
+                continue
+            if start < address:
+                result.append([start, address])
+            if stop > end:
+                result.append([(end + self.align - 1) & (-self.align), stop])
+        self._free = [p for p in result if p[1] > p[0]]
+
+    def candidates(self, near, size, in_range=None):
+        '''
+        start addresses of free blocks able to hold `size` bytes
+        `in_range(address, near)` tells whether the short branch encodings reach
+        '''
+        near_blocks = []
+        far_blocks = []
+        for start, end in self._free:
+            if end - start < size:
+                continue
+            if start >= near:
+                address = start
+            else:
+                # as close to `near` as possible
+                address = max(start, (end - size) & (-self.align))
+            left = end - start - size
+            if in_range is not None and in_range(address, near):
+                near_blocks.append((left, address))
+            else:
+                far_blocks.append((left, address))
+        return [address for _, address in sorted(near_blocks)] + [address for _, address in sorted(far_blocks)]
+
+    def free(self):
+        return FreeSpaceIndex((start, end - start) for start, end in self._free)
@@ -0,0 +1,192 @@
+from collections import defaultdict
+import json
+from time import perf_counter
+
+from .base import ARCH, ENGINES
+
+
+class PatchTracer:
+    '''
+    counters for the hot paths of the patchers, and optionally every piece of
+    code they write
+
+    pass it to a Patcher, PatchSession or patch_rom (`tracer=`); counters are
+    kept per (patcher, job), the job being whatever was given to begin_job()
+    (patch_rom uses the job index):
+        keystone, keystone_time   keystone calls and seconds (asm cache hits are not calls)
+        asm_cache_hits
+        capstone, capstone_time   capstone calls and seconds
+        seeks
+        writes, bytes_written
+
+    with `emissions` every write is recorded as (address with base, bytes,
+    text, job, patcher, arch), text is the assembly for keystone output, a
+    `.word` for literals and None for the rest (disassembled on export);
+    writes undone by a RomBuffer rollback are dropped from the trace
+
+    export with to_json(), to_sym() (no$gba symbol file) or to_listing()
+    '''
+
+    COUNTERS = (
+        'keystone',
+        'keystone_time',
+        'asm_cache_hits',
+        'capstone',
+        'capstone_time',
+        'seeks',
+        'writes',
+        'bytes_written',
+    )
+
+    def __init__(self, emissions: bool = False):
+        self.emissions = emissions
+        self.job = None
+        # job -> dict given to begin_job
+        self.jobs = {}
+        # (patcher, job) -> {counter: value}
+        self.counters = defaultdict(lambda: dict.fromkeys(self.COUNTERS, 0))
+        # (address, bytes, text, job, patcher, arch)
+        self.events = []
+
+    def begin_job(self, job, **info):
+        self.job = job
+        self.jobs[job] = info
+
+    def end_job(self):
+        self.job = None
+
+    def count(self, patcher: str, counter: str, value=1):
+        self.counters[(patcher, self.job)][counter] += value
+
+    def elapsed(self, patcher: str, counter: str, start: float):
+        '''count one call of `counter` that started at `start` (a perf_counter() value)'''
+        counts = self.counters[(patcher, self.job)]
+        counts[counter] += 1
+        counts[counter + '_time'] += perf_counter() - start
+
+    def emit(self, patcher: str, arch: ARCH, address: int, data: bytes, text: str = None):
+        counts = self.counters[(patcher, self.job)]
+        counts['writes'] += 1
+        counts['bytes_written'] += len(data)
+        if self.emissions:
+            self.events.append((address, bytes(data), text, self.job, patcher, arch.name))
+
+    # RomBuffer keeps these in its checkpoints
+    def mark(self):
+        return len(self.events)
+
+    def truncate(self, mark):
+        del self.events[mark:]
+
+    def totals(self, by='patcher'):
+        '''sum the counters by 'patcher' or by 'job' '''
+        position = 0 if by == 'patcher' else 1
+        result = {}
+        for key, counts in self.counters.items():
+            total = result.setdefault(key[position], dict.fromkeys(self.COUNTERS, 0))
+            for name, value in counts.items():
+                total[name] += value
+        return result
+
+    def space_by_job(self):
+        '''[(job, bytes written)], most expensive first, needs `emissions`'''
+        sizes = defaultdict(int)
+        for address, data, _, job, _, _ in self.final_events():
+            sizes[job] += len(data)
+        return sorted(sizes.items(), key=lambda item: item[1], reverse=True)
+
+    def final_events(self):
+        '''the trace without the bytes overwritten later (call rewrites in set_hooker), sorted by address'''
+        owner = {}
+        for i, (address, data, _, _, _, _) in enumerate(self.events):
+            for byte in range(address, address + len(data)):
+                owner[byte] = i
+        alive = sorted(set(owner.values()))
+        return sorted((self.events[i] for i in alive), key=lambda event: event[0])
+
+    @staticmethod
+    def _disassemble(events):
+        '''yield (address, bytes, text, job) per instruction, everything but the literals is decoded'''
+        disassemblers = {}
+        for address, data, text, job, _, arch in events:
+            if text is not None and text.startswith('.word'):
+                yield address, data, text, job
+                continue
+            if arch not in disassemblers:
+                disassemblers[arch] = ENGINES.disassembler(ARCH[arch])
+            offset = 0
+            for insn_address, size, mnemonic, op_str in disassemblers[arch].disasm_lite(data, address):
+                offset = insn_address - address + size
+                yield insn_address, data[offset - size : offset], f'{mnemonic} {op_str}'.strip(), job
+            while offset < len(data):
+                # not code (or the hook function's data)
+                chunk = data[offset : offset + 4]
+                yield address + offset, chunk, '.byte ' + ', '.join(f'0x{b:02x}' for b in chunk), job
+                offset += len(chunk)
+
+    def to_dict(self):
+        return {
+            'counters': [
+                {'patcher': patcher, 'job': job, **counts} for (patcher, job), counts in self.counters.items()
+            ],
+            'by_patcher': self.totals('patcher'),
+            'by_job': self.totals('job'),
+            'jobs': [{'job': job, **info} for job, info in self.jobs.items()],
+            'emissions': [
+                {'address': address, 'bytes': data.hex(), 'text': text, 'job': job, 'patcher': patcher, 'arch': arch}
+                for address, data, text, job, patcher, arch in self.events
+            ],
+        }
+
+    def to_json(self, path=None, indent=2):
+        # str() the keys, jobs may be ints
+        data = self.to_dict()
+        data['by_job'] = {str(key): value for key, value in data['by_job'].items()}
+        text = json.dumps(data, indent=indent)
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(text)
+        return text
+
+    def _label(self, job):
+        info = self.jobs.get(job, {})
+        name = info.get('func') or info.get('type') or 'code'
+        return f'job{job}_{name}' if job is not None else name
+
+    def to_sym(self, path=None):
+        '''
+        no$gba .sym: a label where each job's code starts, .arm/.thm where the
+        instruction set changes and .wrd:0004 on literals, sorted by address
+        '''
+        lines = []
+        last = {}
+        blocks = defaultdict(int)
+        for address, data, text, job, _, arch in self.final_events():
+            mode = '.thm' if arch == ARCH.ARM_THUMB.name else '.arm'
+            if last.get(job) != address:
+                # a new block of this job
+                count = blocks[job]
+                blocks[job] += 1
+                lines.append((address, self._label(job) + (f'_{count}' if count else '')))
+                lines.append((address, mode))
+            if text is not None and text.startswith('.word'):
+                lines.append((address, f'.wrd:{len(data):04x}'))
+                lines.append((address + len(data), mode))
+            last[job] = address + len(data)
+        lines.sort(key=lambda line: line[0])
+        text = ''.join(f'{address:08x} {name}\n' for address, name in lines)
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(text)
+        return text
+
+    def to_listing(self, path=None):
+        '''address, bytes, text and job of every instruction written, by address'''
+        lines = []
+        for address, data, text, job in self._disassemble(self.final_events()):
+            lines.append(f'{address:08x}  {data.hex():<16}  {text:<40}  ; {self._label(job)}')
+        text = '\n'.join(lines) + '\n' if lines else ''
+        if path:
+            with open(path, 'w') as fp:
+                fp.write(text)
+        return text
@@ -1,13 +1,751 @@
-import re
+from bisect import bisect_left
+import hashlib
+from time import perf_counter
+import warnings
+
 from .elf import ElfHelper
-from .arm import ArmPatcher, ThumbPatcher, ALIGN_UP
-import os
+from .cache import AsmCache
+from .cycles import MEMORY_TIMINGS
+from .link import SHF_EXECINSTR, SHF_WRITE, ElfLinker, copy_routine
+from .pipeline import ParallelPlanner
+from .report import PatchReport
+from .manifest import PatchManifest, file_digest
+from .options import PatchOptions
+from .session import PatchSession
+from .trace import PatchTracer
+from .space import SpaceAllocator, scan_free_space
+from .xref import BranchIndex, XrefError
 
 GBA_BASE = 0x08000000
 NDS_BASE = 0x02000000
+# fast ram for patch_rom's `ram_region`: 32K of IWRAM, the 32K ITCM of the arm9
+GBA_IWRAM = 0x03000000
+NDS_ITCM = 0x01FF8000
+# the function of the job copying the ram segment at boot (ram_copy_job)
+RAM_COPY = '__ram_copy'
+
+
+def choose_block(allocator: SpaceAllocator, target_address: int, estimate: int, in_range, try_at):
+    '''
+    the placement rule shared by the serial and the parallel path
+
+    walk the allocator's candidates for `target_address`, `try_at(address)` gives
+    the trampoline size at that address (None if it can't be placed there),
+    the first one fitting its block wins, return (address, size)
+    '''
+    while True:
+        candidates = allocator.candidates(target_address, estimate, in_range)
+        for address in candidates:
+            size = try_at(address)
+            if size is None:
+                continue
+            if allocator.fits(address, size):
+                return address, size
+            if size > estimate:
+                estimate = size
+                break
+        else:
+            raise ValueError(f'no free space for the hook at 0x{target_address:x} (0x{estimate:x} bytes)')
+
+
+def hook_estimate(function_codes, linked=False):
+    # a linked function is not copied after the trampoline
+    return (0 if linked else len(function_codes)) + 0x40
+
+
+def place_hooker(
+    patcher, allocator: SpaceAllocator, hook_type: str, target_address: int, function_codes, function_address=None
+):
+    '''
+    emit a hook into the free block the allocator prefers, return (trampoline address, size)
+
+    the trampoline size depends on where it is placed (short or long branches,
+    alignment), so each candidate is tried on the buffer and rolled back if the
+    result does not fit its block
+    '''
+    method = patcher.set_hooker if hook_type == 'hook' else patcher.set_function_hooker
+    buffer = patcher._io
+
+    def try_at(address):
+        mark = buffer.checkpoint()
+        try:
+            size = method(
+                target_address=target_address,
+                empty_address=address,
+                function_codes=function_codes,
+                function_address=function_address,
+            )
+        except IndexError:
+            # ran out of the rom
+            buffer.rollback(mark)
+            return None
+        if allocator.fits(address, size):
+            buffer.release(mark)
+        else:
+            buffer.rollback(mark)
+        return size
+
+    estimate = hook_estimate(function_codes, function_address is not None)
+    address, size = choose_block(allocator, target_address, estimate, patcher._in_range, try_at)
+    allocator.take(address, size)
+    return address, size
+
+
+SEGMENT_KEYS = ('name', 'address', 'vma', 'size', 'reserved', 'data', 'digest', 'sections', 'veneers')
+
+
+def link_hook_functions(
+    session, allocator: SpaceAllocator, elf: ElfHelper, jobs, sections=(), symbols=None, ram_region=None
+):
+    '''
+    link the hook functions of `jobs` with everything they use from `elf`
+    (see ElfLinker.select, `sections` adds fnmatch patterns of more sections)
+    as one segment in the free space, close to the first hook
+
+    `symbols` ({name: address with base, bit 0 for thumb}) resolves what the
+    elf leaves undefined, e.g. functions of the game
+
+    with `ram_region` ((address with base, size), a part of GBA_IWRAM or
+    NDS_ITCM the game leaves alone) the functions of the jobs with 'ram' and
+    the code only they call go to a second segment running there, together
+    with the writable data (.data, .bss); read-only data stays in the rom.
+    Its image is in the free space of the rom, ram_copy_job copies it at boot
+
+    return the segments (the SEGMENT_KEYS of ElfLinker's segments, not written
+    yet, see emit_segments) and {function name: address it runs at, without
+    the base like the job addresses (below 0 for ram under the base)}
+    '''
+    hooks = [job for job in jobs if job['type'] in ('hook', 'hook_func')]
+    if not hooks:
+        return [], {}
+    ram_roots = [job['func'] for job in hooks if job.get('ram')]
+    if ram_roots and ram_region is None:
+        raise ValueError("jobs with 'ram' need ram_region")
+    linker = ElfLinker(elf, session.base, symbols)
+    selected = linker.select(dict.fromkeys(job['func'] for job in hooks), sections)
+    ram = []
+    if ram_region is not None:
+        ram_code = set(linker.select(ram_roots)) if ram_roots else set()
+        ram = [
+            index
+            for index in selected
+            if linker.flags(index) & SHF_WRITE or index in ram_code and linker.flags(index) & SHF_EXECINSTR
+        ]
+    rom = [index for index in selected if index not in ram]
+
+    first = hooks[0]
+    reach = session.patcher(first['arch']).CALL_RANGE
+    for name, chosen in (('rom', rom), ('ram', ram)):
+        if not chosen:
+            continue
+        size, align = linker.measure(chosen)
+        vma = None
+        if name == 'ram':
+            ram_start, ram_size = ram_region
+            vma = (ram_start + align - 1) & -align
+            if vma + size > ram_start + ram_size:
+                raise ValueError(f'the ram segment needs up to 0x{size:x} bytes, ram_region has 0x{ram_size:x}')
+            # the image is copied a word at a time
+            align = 4
+
+        def try_at(address):
+            return size if (session.base + address) % align == 0 else None
+
+        address, _ = choose_block(allocator, first['address'], size, lambda a, b: abs(a - b) < reach, try_at)
+        # measure() left room for the veneers, the segment may end up smaller
+        allocator.take(address, size)
+        linker.place(chosen, address, vma, name)
+    segments = [{key: segment[key] for key in SEGMENT_KEYS} for segment in linker.resolve()]
+
+    linked = {}
+    for job in hooks:
+        function_address, thumb = linker.address_of(job['func'])
+        if thumb != (job['arch'] == 'thumb'):
+            raise ValueError(f"{job['func']} is not a {job['arch']} function")
+        linked[job['func']] = function_address - session.base
+    return segments, linked
+
+
+def ram_copy_job(segments, init: dict, base: int):
+    '''
+    (hook job, function bytes) copying the ram segment of link_hook_functions
+    from its image to ram, None without one; the job hooks `init`
+    ({'arch', 'address'}), a place the game runs once at boot after it has
+    cleared the ram, and calls RAM_COPY
+    '''
+    ram = [segment for segment in segments if segment['name'] == 'ram']
+    if not ram:
+        return None
+    if init is None:
+        raise ValueError('a ram segment needs ram_init, where to copy it at boot')
+    segment = ram[0]
+    job = {'arch': init['arch'], 'type': 'hook', 'address': init['address'], 'func': RAM_COPY}
+    code = copy_routine(init['arch'] == 'thumb', base + segment['address'], segment['vma'], segment['size'])
+    return job, code
+
+
+def emit_segments(session, segments):
+    '''write the linked segments, each gets the bytes it overwrote in 'writes' '''
+    buffer = session.buffer
+    for segment in segments:
+        mark = buffer.checkpoint()
+        buffer.seek(segment['address'])
+        buffer.write(segment['data'])
+        segment['writes'] = buffer.original_since(mark)
+        buffer.release(mark)
+
+
+def plan_shared_stubs(session, allocator: SpaceAllocator, jobs, functions):
+    '''
+    where the shared save/restore stubs of the hooks go (see ArmPatcher.emit_shared_stub):
+    one per arch and hook type, plus one for every hook too far from the others
+    for a bl (thumb), close to that hook; hooks with a minimal save don't need
+    one; their space is taken from `allocator`
+    return [{'arch', 'type', 'address', 'size'}]
+    '''
+    stubs = []
+    for job in jobs:
+        if job['type'] not in ('hook', 'hook_func'):
+            continue
+        patcher = session.patcher(job['arch'])
+        if patcher.hook_usage(functions[job['func']]) is not None:
+            continue
+        # the trampoline lands somewhere around the target, keep half a bl in hand
+        reach = patcher.CALL_RANGE // 2
+        if any(
+            stub['arch'] == job['arch']
+            and stub['type'] == job['type']
+            and abs(stub['address'] - job['address']) < reach
+            for stub in stubs
+        ):
+            continue
+        buffer = patcher._io
+
+        def try_at(address):
+            mark = buffer.checkpoint()
+            try:
+                return patcher.emit_shared_stub(job['type'], address)
+            except IndexError:
+                return None
+            finally:
+                buffer.rollback(mark)
+
+        address, size = choose_block(allocator, job['address'], 0x80, lambda a, b: abs(a - b) < reach, try_at)
+        allocator.take(address, size)
+        stubs.append({'arch': job['arch'], 'type': job['type'], 'address': address, 'size': size})
+    return stubs
+
+
+def emit_shared_stubs(session, stubs):
+    '''write the stubs of plan_shared_stubs and hand them to their patchers, each gets the bytes it overwrote in 'writes' '''
+    buffer = session.buffer
+    for stub in stubs:
+        patcher = session.patcher(stub['arch'])
+        mark = buffer.checkpoint()
+        patcher.emit_shared_stub(stub['type'], stub['address'])
+        stub['writes'] = buffer.original_since(mark)
+        buffer.release(mark)
+        patcher.add_shared_stub(stub['type'], stub['address'])
+
+
+def _stub_summary(session, stubs, placements, jobs, functions):
+    '''what each shared stub saved: hooks calling it, bytes saved and cycles added per call'''
+    costs = {}
+    summary = []
+    for stub in stubs:
+        key = (stub['arch'], stub['type'])
+        patcher = session.patcher(stub['arch'])
+        if key not in costs:
+            costs[key] = patcher.shared_stub_cost(stub['type'])
+        cost = costs[key]
+        hooks = sum(
+            1
+            for index, job in enumerate(jobs)
+            if (job['arch'], job['type']) == key
+            and patcher.shared_stub(job['type'], placements[index][0]) == stub['address']
+            and patcher.hook_usage(functions[job['func']]) is None
+        )
+        saved_per_hook = cost['inline_size'] - cost['entry_size']
+        summary.append(
+            {
+                'arch': stub['arch'],
+                'type': stub['type'],
+                'address': stub['address'],
+                'size': stub['size'],
+                'hooks': hooks,
+                'saved_per_hook': saved_per_hook,
+                'saved': hooks * saved_per_hook - stub['size'],
+                'cycles_added': cost['shared_cycles'] - cost['inline_cycles'],
+            }
+        )
+    return summary
+
+
+def stub_key(stub):
+    return (stub['arch'], stub['type'], stub['address'], stub['size'])
+
+
+def segment_key(segment):
+    return (segment['address'], segment['size'], segment['digest'])
+
+
+def _patch_serial(session, allocator, jobs, functions, indexes=None, records=None, linked=None):
+    '''
+    patch `jobs` (only those at `indexes` if given) in order, return {job index: (address, size)}
+    the code each hook runs per call goes to session.paths
+    with `records` each job's {index: (writes, read range)} is stored there for a PatchManifest,
+    hooks whose function is in `linked` ({name: rom address}) call it there
+    '''
+    linked = linked or {}
+    placements = {}
+    tracer = session.tracer
+    buffer = session.buffer
+    for index in range(len(jobs)) if indexes is None else indexes:
+        job = jobs[index]
+        if tracer is not None:
+            tracer.begin_job(index, **job)
+        patcher = session.patcher(job['arch'])
+        if records is not None:
+            mark = buffer.checkpoint()
+        read = None
+        if job['type'] in ('hook', 'hook_func'):
+            if records is not None:
+                # what the longest jump would relocate, so it holds wherever the trampoline goes
+                target = job['address']
+                size = patcher._get_jmp_patch_size(target, target + (1 << 32))
+                read = (target, target + patcher.get_min_opcodes_len(target, size))
+            placements[index] = place_hooker(
+                patcher, allocator, job['type'], job['address'], functions[job['func']], linked.get(job['func'])
+            )
+            session.paths[index] = patcher.hook_path
+            session.relocated[index] = patcher.relocated
+        elif job['type'] == 'patch':
+            placements[index] = (None, patcher.assemble(job['asm'], job['address']))
+        else:
+            raise TypeError(f"unknown type: {job['type']}")
+        if records is not None:
+            records[index] = (buffer.original_since(mark), read)
+            buffer.release(mark)
+    if tracer is not None:
+        tracer.end_job()
+    return placements
+
+
+def _entry_ranges(entry):
+    ranges = [(start, start + len(data)) for start, data in entry['writes']]
+    if entry['read'] is not None:
+        ranges.append(tuple(entry['read']))
+    return ranges
+
 
+def _restore(buffer, entries):
+    '''put back the original bytes of manifest entries, latest job first'''
+    for entry in reversed(entries):
+        for start, data in entry['writes']:
+            buffer.seek(start)
+            buffer.write(data)
 
-def patch_rom(rom_path: str, rom_base: int, code_path: str, empty_address: int, jobs: list):
+
+def _patch_incremental(session, allocator, jobs, functions, manifest, keys, records, linked=None):
+    '''
+    keep the manifest entries whose key is still in `keys`, restore the others
+    and patch the jobs without an entry, return (placements, indexes of kept jobs)
+    or None (with the buffer untouched) when a job touches the bytes of a kept one
+    '''
+    pool = {}
+    for entry in manifest.entries:
+        pool.setdefault(entry['key'], []).append(entry)
+    kept = {}
+    for index, key in enumerate(keys):
+        if pool.get(key):
+            kept[index] = pool[key].pop(0)
+
+    # a kept job touching the bytes of a restored one has to go too
+    stale_ranges = []
+    stale = set(range(len(manifest.entries)))
+    order = {id(entry): i for i, entry in enumerate(manifest.entries)}
+    for entry in kept.values():
+        stale.discard(order[id(entry)])
+    pending = [manifest.entries[i] for i in stale]
+    while pending:
+        stale_ranges.extend(range_ for entry in pending for range_ in _entry_ranges(entry))
+        stale_index = _range_index(stale_ranges)
+        pending = []
+        for index, entry in list(kept.items()):
+            if _overlaps(stale_index, _entry_ranges(entry)):
+                del kept[index]
+                stale.add(order[id(entry)])
+                pending.append(entry)
+
+    buffer = session.buffer
+    mark = buffer.checkpoint()
+    _restore(buffer, [manifest.entries[i] for i in sorted(stale)])
+    for index, entry in kept.items():
+        address, size = entry['placement']
+        if address is not None:
+            allocator.reserve(address, size)
+        records[index] = (entry['writes'], entry['read'])
+        session.paths[index] = entry['path']
+        session.relocated[index] = entry['relocated']
+
+    todo = [index for index in range(len(jobs)) if index not in kept]
+    placements = _patch_serial(session, allocator, jobs, functions, todo, records, linked)
+    kept_index = _range_index(range_ for entry in kept.values() for range_ in _entry_ranges(entry))
+    for index in todo:
+        if _overlaps(kept_index, _entry_ranges({'writes': records[index][0], 'read': records[index][1]})):
+            buffer.rollback(mark)
+            return None
+    buffer.release(mark)
+
+    for index, entry in kept.items():
+        placements[index] = tuple(entry['placement'])
+    return placements, set(kept)
+
+
+def branch_conflicts(session, branch_index: BranchIndex, jobs):
+    '''{job index: [(source, target)]} of the branches into the instructions a hook moved, its first one aside'''
+    conflicts = {}
+    for index, job in enumerate(jobs):
+        relocated = session.relocated.get(index)
+        if job['type'] in ('hook', 'hook_func') and relocated is not None:
+            found = branch_index.into(*relocated, job['arch'] == 'thumb')
+            if found:
+                conflicts[index] = found
+    return conflicts
+
+
+def _range_index(ranges):
+    ranges = sorted(ranges)
+    return ranges, [start for start, _ in ranges], max((end - start for start, end in ranges), default=0)
+
+
+def _overlaps(index, others):
+    '''does any (start, end) of `others` overlap a range of `index` (from _range_index)'''
+    ranges, starts, longest = index
+    for other_start, other_end in others:
+        i = bisect_left(starts, other_start - longest)
+        while i < len(ranges) and ranges[i][0] < other_end:
+            if ranges[i][1] > other_start:
+                return True
+            i += 1
+    return False
+
+
+class _RomPatch:
+    '''
+    one run of patch_rom, its phases share the session, the allocator and
+    what was planned (stubs, segments, placements) through the instance
+    '''
+
+    def __init__(self, rom_path, rom_base, code_path, empty_address, jobs, output_path, options: PatchOptions):
+        self.rom_path = rom_path
+        self.rom_base = rom_base
+        self.code_path = code_path
+        self.empty_address = empty_address
+        self.jobs = jobs
+        self.output_path = output_path
+        self.options = options
+        self.functions = options.functions
+        self.elf = None
+        self.report = PatchReport()
+        self.timings = self.report.timings
+
+    def run(self):
+        try:
+            self._load_code()
+            self.allocator = self._make_allocator()
+            self._load_manifest()
+            self._patch()
+            self._save()
+            if not isinstance(self.empty_address, int):
+                self.report.free = list(self.allocator.free())
+            return self.report
+        finally:
+            if self.elf is not None:
+                self.elf.close()
+
+    def _load_code(self):
+        options = self.options
+        start = perf_counter()
+        linking = options.link or any(job.get('ram') for job in self.jobs)
+        if self.functions is None:
+            self.functions = {}
+            if self.code_path:
+                self.elf = ElfHelper(self.code_path, cache_path=options.elf_cache_path)
+                self.functions = self.elf.get_many(
+                    {job['func'] for job in self.jobs if job['type'] in ('hook', 'hook_func')}
+                )
+        if linking and self.elf is None:
+            self.elf = ElfHelper(self.code_path, cache_path=options.elf_cache_path)
+        self.timings['elf'] = perf_counter() - start
+
+    def _make_allocator(self):
+        if isinstance(self.empty_address, int):
+            return SpaceAllocator.unbounded(self.empty_address, self.options.align)
+        return SpaceAllocator(self.empty_address, self.options.align)
+
+    def _load_manifest(self):
+        '''the manifest of the previous run if it still matches, and where the session loads from and writes to'''
+        manifest_path, output_path = self.options.manifest_path, self.output_path
+        start = perf_counter()
+        self.manifest = None
+        self.session_path, self.session_output = self.rom_path, output_path
+        if manifest_path:
+            self.source_digest = file_digest(self.rom_path) if output_path else None
+            manifest = PatchManifest.load(manifest_path)
+            if manifest is not None and not manifest.matches(
+                self.rom_base, output_path or self.rom_path, self.source_digest
+            ):
+                manifest = None
+            if manifest is not None and output_path:
+                # the output holds the previous run, patch it in place
+                self.session_path, self.session_output = output_path, None
+            self.manifest = manifest
+        self.timings['manifest'] = perf_counter() - start
+
+    def _patch(self):
+        options = self.options
+        start = perf_counter()
+        with PatchSession(
+            self.session_path,
+            self.rom_base,
+            output_path=self.session_output,
+            asm_cache=options.asm_cache,
+            tracer=options.tracer,
+            minimal_save=options.minimal_save,
+            codec=options.codec,
+        ) as session:
+            self.session = session
+            self.timings['load'] = perf_counter() - start
+            if options.xrefs:
+                start = perf_counter()
+                view = session.buffer.getbuffer()
+                branch_index = BranchIndex.cached(view, options.xref_cache_path, options.xref_regions)
+                view.release()
+                self.timings['xrefs'] = perf_counter() - start
+            start = perf_counter()
+            self._emit_shared_code()
+            self._patch_jobs()
+            self.timings['patch'] = perf_counter() - start
+
+            self.conflicts = self._check_xrefs(branch_index) if options.xrefs else {}
+            if options.manifest_path:
+                self._make_manifest()
+            if options.patch_path:
+                start = perf_counter()
+                self._write_patch_file()
+                self.timings['patch_file'] = perf_counter() - start
+            self._fill_report()
+            raw_size = len(session.buffer)
+            start = perf_counter()
+        self.timings['commit'] = perf_counter() - start
+        if session.codec is not None:
+            self.report.packed = {'codec': session.codec.name, 'size': session.packed_size, 'raw_size': raw_size}
+
+    def _emit_shared_code(self):
+        '''
+        plan and write the shared stubs and the linked segments (and add the
+        ram copy job), the previous run is dropped when they moved
+        '''
+        session, allocator, options = self.session, self.allocator, self.options
+        self.stubs = plan_shared_stubs(session, allocator, self.jobs, self.functions) if options.shared_stubs else []
+        self.segments, self.linked = [], {}
+        if options.link or any(job.get('ram') for job in self.jobs):
+            self.segments, self.linked = link_hook_functions(
+                session,
+                allocator,
+                self.elf,
+                [job for job in self.jobs if options.link or job.get('ram')],
+                options.link_sections,
+                options.link_symbols,
+                options.ram_region,
+            )
+            copy = ram_copy_job(self.segments, options.ram_init, self.rom_base)
+            if copy is not None:
+                self.jobs = self.jobs + [copy[0]]
+                self.functions = {**self.functions, RAM_COPY: copy[1]}
+        if options.manifest_path:
+            self.keys = [
+                PatchManifest.job_key(
+                    job, self.functions.get(job.get('func')), options.minimal_save, self.linked.get(job.get('func'))
+                )
+                for job in self.jobs
+            ]
+        manifest = self.manifest
+        if manifest is not None and (
+            [stub_key(stub) for stub in manifest.stubs] != [stub_key(stub) for stub in self.stubs]
+            or [segment_key(segment) for segment in manifest.segments]
+            != [segment_key(segment) for segment in self.segments]
+        ):
+            # the kept hooks would call stubs or functions that are gone, start over from the unpatched rom
+            _restore(session.buffer, manifest.entries)
+            _restore(session.buffer, manifest.stubs)
+            _restore(session.buffer, manifest.segments)
+            self.manifest = manifest = None
+        emit_shared_stubs(session, self.stubs)
+        emit_segments(session, self.segments)
+        if manifest is not None:
+            # the stubs and segments are already there, the bytes they replaced are in the manifest
+            for stub, old in zip(self.stubs, manifest.stubs):
+                stub['writes'] = old['writes']
+            for segment, old in zip(self.segments, manifest.segments):
+                segment['writes'] = old['writes']
+
+    def _patch_jobs(self):
+        '''emit every job (incrementally, in parallel or serially), setting placements, reused and records'''
+        session, jobs, functions, linked, options = self.session, self.jobs, self.functions, self.linked, self.options
+        placements = None
+        self.reused = set()
+        self.records = {}
+        if options.manifest_path:
+            manifest = self.manifest
+            if manifest is not None:
+                result = _patch_incremental(
+                    session, self.allocator, jobs, functions, manifest, self.keys, self.records, linked
+                )
+                if result is not None:
+                    placements, self.reused = result
+                else:
+                    # start over from the unpatched rom, the stubs and segments stay
+                    _restore(session.buffer, manifest.entries)
+                    self.allocator = self._make_allocator()
+                    for stub in self.stubs:
+                        self.allocator.take(stub['address'], stub['size'])
+                    for segment in self.segments:
+                        self.allocator.take(segment['address'], segment['reserved'])
+                    self.records = {}
+            if placements is None:
+                placements = _patch_serial(
+                    session, self.allocator, jobs, functions, records=self.records, linked=linked
+                )
+        elif options.workers and options.workers > 1 and options.tracer is None:
+            planner = ParallelPlanner(session, jobs, functions, options.workers, self.stubs, linked)
+            placements = planner.plan(self.allocator)
+            if placements is not None:
+                placements = planner.commit(self.allocator, placements)
+        if placements is None:
+            placements = _patch_serial(session, self.allocator, jobs, functions, linked=linked)
+        self.placements = placements
+
+    def _check_xrefs(self, branch_index):
+        '''the branch_conflicts, warned about or refused (XrefError) as `xrefs` says'''
+        conflicts = branch_conflicts(self.session, branch_index, self.jobs)
+        if conflicts:
+            message = '; '.join(
+                f"job {index} at {self.rom_base + self.jobs[index]['address']:08x} is branched into from "
+                + ', '.join(f'{self.rom_base + source:08x}' for source, _ in found)
+                for index, found in conflicts.items()
+            )
+            if self.options.xrefs == 'refuse':
+                raise XrefError(message)
+            warnings.warn(message)
+        return conflicts
+
+    def _make_manifest(self):
+        session = self.session
+        view = session.buffer.getbuffer()
+        self.new_manifest = PatchManifest(
+            self.rom_base,
+            digest=hashlib.sha1(view).hexdigest(),
+            source_digest=self.source_digest,
+            stubs=self.stubs,
+            segments=self.segments,
+        )
+        view.release()
+        for index, job in enumerate(self.jobs):
+            self.new_manifest.add(
+                self.keys[index],
+                job,
+                self.placements[index],
+                *self.records[index],
+                session.paths.get(index),
+                session.relocated.get(index),
+            )
+
+    def _write_patch_file(self):
+        session = self.session
+        ranges = session.buffer.dirty_ranges()
+        if self.options.manifest_path:
+            # the kept jobs were written by an earlier run
+            for entry in self.new_manifest.entries:
+                ranges += [(address, address + len(data)) for address, data in entry['writes']]
+        session.write_patch(self.options.patch_path, ranges, source_path=self.rom_path)
+        if not self.output_path:
+            session.buffer.clear_dirty()
+
+    def _fill_report(self):
+        session, report, options, rom_base = self.session, self.report, self.options, self.rom_base
+        memory = MEMORY_TIMINGS[options.platform or ('gba' if rom_base == GBA_BASE else 'nds9')]
+        view = session.buffer.getbuffer()
+        for index, job in enumerate(self.jobs):
+            address, size = self.placements[index]
+            if job['type'] == 'patch':
+                entry = report.add(index=index, type=job['type'], arch=job['arch'], address=job['address'], size=size)
+            else:
+                patcher = session.patcher(job['arch'])
+                entry = report.add(
+                    index=index,
+                    type=job['type'],
+                    arch=job['arch'],
+                    address=job['address'],
+                    func=job['func'],
+                    trampoline=address,
+                    size=size,
+                    overwritten=patcher._get_jmp_patch_size(job['address'], address),
+                    short_jump=patcher._in_range(job['address'], address),
+                )
+            if options.manifest_path:
+                entry['reused'] = index in self.reused
+            if job['type'] != 'patch':
+                minimal = patcher.hook_usage(self.functions[job['func']]) is not None
+                if options.minimal_save:
+                    entry['minimal'] = minimal
+                if options.shared_stubs:
+                    entry['shared'] = not minimal and patcher.shared_stub(job['type'], address) is not None
+                if job['func'] in self.linked:
+                    entry['linked'] = rom_base + self.linked[job['func']]
+                if session.paths.get(index) is not None:
+                    try:
+                        entry['cycles'] = memory.path_cycles(
+                            view, session.paths[index], patcher._arch_mode.arch, rom_base
+                        )
+                    except ValueError:
+                        # the code is outside the memory map of the platform
+                        pass
+                if index in self.conflicts:
+                    entry['xrefs'] = [rom_base + source for source, _ in self.conflicts[index]]
+        view.release()
+        report.stubs = _stub_summary(session, self.stubs, self.placements, self.jobs, self.functions)
+        report.segments = [
+            {key: segment[key] for key in ('name', 'address', 'vma', 'size', 'sections', 'veneers')}
+            for segment in self.segments
+        ]
+        if options.ram_region is not None:
+            used = sum(segment['size'] for segment in self.segments if segment['name'] == 'ram')
+            report.ram = {'address': options.ram_region[0], 'size': options.ram_region[1], 'used': used}
+
+    def _save(self):
+        '''the manifest and the asm cache, once the rom is written'''
+        options = self.options
+        if options.manifest_path:
+            if self.session.codec is not None:
+                # the buffer was encoded again, the manifest tracks the file
+                self.new_manifest.digest = file_digest(self.output_path or self.rom_path)
+            self.new_manifest.save(options.manifest_path)
+        if options.asm_cache is not None and options.asm_cache.path:
+            options.asm_cache.save()
+
+
+def patch_rom(
+    rom_path: str,
+    rom_base: int,
+    code_path: str,
+    empty_address,
+    jobs: list,
+    output_path: str = None,
+    options: PatchOptions = None,
+    **features,
+):
     '''
     jobs = [
             {'arch': str `arm/thumb`,
@@ -18,46 +756,32 @@ def patch_rom(rom_path: str, rom_base: int, code_path: str, empty_address: int,
             }
         ...
         ]
-    '''
-    if code_path:
-        elf = ElfHelper(code_path)
-    for job in jobs:
-        if job['arch'] == 'arm':
-            patcher = ArmPatcher(open(rom_path, 'rb+'), base=rom_base)
-        elif job['arch'] == 'thumb':
-            patcher = ThumbPatcher(open(rom_path, 'rb+'), base=rom_base)
-        else:
-            raise TypeError(f"Not support architecture: {job['arch']}")
-
-        if job['type'] == 'hook':
-            codes = elf.get_opcodes(job['func'])
-            size = patcher.set_hooker(target_address=job['address'], empty_address=empty_address, function_codes=codes)
-            empty_address = ALIGN_UP(empty_address + size, 0x10)
-        elif job['type'] == 'hook_func':
-            codes = elf.get_opcodes(job['func'])
-            size = patcher.set_function_hooker(
-                target_address=job['address'], empty_address=empty_address, function_codes=codes
-            )
-            empty_address = ALIGN_UP(empty_address + size, 0x10)
-        elif job['type'] == 'patch':
-            patcher.assemble(job['asm'], job['address'])
-        else:
-            raise TypeError(f"unknown type: {job['type']}")
-        del patcher
 
+    `empty_address` is either one address (everything after it is free) or a list
+    of (address, size) regions, e.g. from find_empty_space/scan_free_space, each
+    trampoline then goes to a region close enough to its target for the short
+    branch encodings when there is one
 
-def find_empty_space(name_or_buf, min_size=0x100, align=0x10):
-    assert align & 1 == 0
+    the rom is loaded once and every job works on the same in-memory buffer,
+    changed bytes are written in one go at the end, to `output_path` if given
+    (the source rom is left untouched) or back to `rom_path`
 
-    if isinstance(name_or_buf, str):
-        buf = open(name_or_buf, 'rb').read()
-    else:
-        buf = name_or_buf
+    the optional features (caches, workers, manifest, patch file, shared stubs,
+    linking, xrefs, codec...) are a PatchOptions in `options` or keyword
+    arguments of the same names, see PatchOptions
+
+    return a PatchReport with the layout chosen for every job and the time spent
+    in each phase (elf, manifest, load, patch, patch_file, commit)
+    '''
+    options = (options or PatchOptions()).replace(**features)
+    options.check(jobs, code_path, output_path)
+    return _RomPatch(rom_path, rom_base, code_path, empty_address, jobs, output_path, options).run()
 
-    spaces = []
-    for m in re.finditer(b'\x00{%d,}' % min_size, buf):
-        pos = (m.start() + align - 1) & (-align)
-        size = (m.end() - pos) & (-align)
-        spaces.append((pos, size))
-    spaces.sort(key=lambda x: x[1], reverse=True)
-    return spaces
+
+def find_empty_space(name_or_buf, min_size=0x100, align=0x10, fill=0x00):
+    '''
+    list of (address, size) of free regions, largest first
+    `fill` can be a byte value or several of them, e.g. (0x00, 0xFF)
+    use scan_free_space for a FreeSpaceIndex sorted by address
+    '''
+    return scan_free_space(name_or_buf, min_size=min_size, align=align, fill=fill).by_size()
@@ -0,0 +1,247 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import hashlib
+import json
+import os
+import struct
+import sys
+
+from .base import lazy_import
+
+np = lazy_import('numpy')
+
+# flags of a branch
+SOURCE_THUMB = 1
+TARGET_THUMB = 2
+LINK = 4
+
+
+class XrefError(ValueError):
+    pass
+
+
+def _sign_extend(value, bits):
+    sign = 1 << (bits - 1)
+    return (value ^ sign) - sign
+
+
+def _sign_extend_numpy(values, bits):
+    sign = 1 << (bits - 1)
+    return ((values & ((1 << bits) - 1)) ^ sign) - sign
+
+
+def _arm_branches_numpy(view, start, end):
+    words = np.frombuffer(view[start:end], dtype='<u4')
+    hits = np.flatnonzero((words & 0x0E000000) == 0x0A000000)
+    words = words[hits].astype(np.int64)
+    sources = start + hits.astype(np.int64) * 4
+    blx = (words >> 28) == 0xF
+    offsets = _sign_extend_numpy(words, 24) * 4 + np.where(blx, (words >> 23) & 2, 0)
+    link = blx | ((words >> 24) & 1).astype(bool)
+    flags = np.where(blx, TARGET_THUMB, 0) | np.where(link, LINK, 0)
+    return sources, sources + 8 + offsets, flags
+
+
+def _thumb_branches_numpy(view, start, end):
+    halves = np.frombuffer(view[start:end], dtype='<u2').astype(np.int64)
+    offsets = np.arange(len(halves), dtype=np.int64) * 2
+    # b<cond>, not udf/svc
+    conditional = ((halves & 0xF000) == 0xD000) & ((halves & 0x0E00) != 0x0E00)
+    always = (halves & 0xF800) == 0xE000
+    # bl/blx pairs, the second half tells which, blx offsets are even
+    first = (halves[:-1] & 0xF800) == 0xF000
+    second = halves[1:] & 0xF801
+    pair = np.flatnonzero(first & (((second & 0xF800) == 0xF800) | (second == 0xE800)))
+    sources, targets, flags = [], [], []
+    # b and b<cond> stay in thumb
+    for mask, bits in ((conditional, 8), (always, 11)):
+        hits = np.flatnonzero(mask)
+        sources.append(start + offsets[hits])
+        targets.append(sources[-1] + 4 + _sign_extend_numpy(halves[hits], bits) * 2)
+        flags.append(np.full(len(hits), SOURCE_THUMB | TARGET_THUMB, dtype=np.int64))
+    exchange = (halves[pair + 1] & 0xF800) == 0xE800
+    sources.append(start + offsets[pair])
+    target = sources[-1] + 4 + (_sign_extend_numpy(halves[pair], 11) << 12) + ((halves[pair + 1] & 0x7FF) << 1)
+    targets.append(np.where(exchange, target & ~3, target))
+    flags.append(SOURCE_THUMB | LINK | np.where(exchange, 0, TARGET_THUMB))
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(flags)
+
+
+def _arm_branches(view, start, end):
+    for i, (word,) in enumerate(struct.iter_unpack('<I', view[start:end])):
+        if word & 0x0E000000 != 0x0A000000:
+            continue
+        source = start + i * 4
+        offset = _sign_extend(word & 0xFFFFFF, 24) * 4
+        if word >> 28 == 0xF:
+            yield source, source + 8 + offset + ((word >> 23) & 2), TARGET_THUMB | LINK
+        else:
+            yield source, source + 8 + offset, LINK if word & 0x01000000 else 0
+
+
+def _thumb_branches(view, start, end):
+    halves = [half for half, in struct.iter_unpack('<H', view[start:end])]
+    for i, half in enumerate(halves):
+        source = start + i * 2
+        top = half & 0xF800
+        if half & 0xF000 == 0xD000 and half & 0x0E00 != 0x0E00:
+            yield source, source + 4 + _sign_extend(half & 0xFF, 8) * 2, SOURCE_THUMB | TARGET_THUMB
+        elif top == 0xE000:
+            yield source, source + 4 + _sign_extend(half & 0x7FF, 11) * 2, SOURCE_THUMB | TARGET_THUMB
+        elif (
+            top == 0xF000
+            and i + 1 < len(halves)
+            and (halves[i + 1] & 0xF800 == 0xF800 or halves[i + 1] & 0xF801 == 0xE800)
+        ):
+            target = source + 4 + (_sign_extend(half & 0x7FF, 11) << 12) + ((halves[i + 1] & 0x7FF) << 1)
+            if halves[i + 1] & 0xF800 == 0xE800:
+                yield source, target & ~3, SOURCE_THUMB | LINK
+            else:
+                yield source, target, SOURCE_THUMB | TARGET_THUMB | LINK
+
+
+class BranchIndex:
+    '''
+    the direct branches of a rom (arm b/bl/blx, thumb b/b<cond>/bl/blx), found
+    by a linear sweep of its code regions decoded both as arm and as thumb,
+    sorted by target so the branches into a range are a bisect away
+
+    addresses are rom offsets (no base) like the patchers use; the columns are
+    arrays of machine ints, which is what save() writes (little endian, after a
+    header and the sha1 of the rom and the regions swept, as JSON)
+
+    a linear sweep reads data as code too, so some branches are noise: the
+    index tells where the rom *may* jump, which is what a hook site has to avoid
+    '''
+
+    VERSION = 3
+    MAGIC = b'BXRF'
+    # magic, version, branches, size of the JSON part
+    HEADER = struct.Struct('<4sIII')
+
+    def __init__(self, targets=(), sources=(), flags=(), digest: str = None, regions=None):
+        self.targets = array('I', targets)
+        self.sources = array('I', sources)
+        self.flags = array('B', flags)
+        self.digest = digest
+        self.regions = regions
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        return f'BranchIndex({len(self)} branches)'
+
+    @classmethod
+    def build(cls, buf, regions=None, digest: str = None):
+        '''
+        sweep `buf` (the rom) over `regions` ([(start, end)], the whole rom by
+        default), keeping the branches landing inside the rom
+        '''
+        view = memoryview(buf)
+        size = len(view)
+        rows = []
+        for start, end in regions or [(0, size)]:
+            end = min(end, size)
+            arm_start, arm_end = (start + 3) & ~3, end & ~3
+            thumb_start, thumb_end = (start + 1) & ~1, end & ~1
+            if np is not None:
+                for found in (
+                    _arm_branches_numpy(view, arm_start, max(arm_start, arm_end)),
+                    _thumb_branches_numpy(view, thumb_start, max(thumb_start, thumb_end)),
+                ):
+                    sources, targets, flags = found
+                    keep = (targets >= 0) & (targets < size)
+                    rows.extend(zip(targets[keep].tolist(), sources[keep].tolist(), flags[keep].tolist()))
+            else:
+                for found in (
+                    _arm_branches(view, arm_start, arm_end),
+                    _thumb_branches(view, thumb_start, thumb_end),
+                ):
+                    rows.extend((target, source, flags) for source, target, flags in found if 0 <= target < size)
+        view.release()
+        rows.sort()
+        return cls(
+            (row[0] for row in rows),
+            (row[1] for row in rows),
+            (row[2] for row in rows),
+            digest,
+            regions and [tuple(region) for region in regions],
+        )
+
+    @classmethod
+    def cached(cls, buf, path: str = None, regions=None):
+        '''the index of `buf`, from `path` when it was made for the same bytes and regions, else built (and saved)'''
+        view = memoryview(buf)
+        digest = hashlib.sha1(view).hexdigest()
+        view.release()
+        regions = regions and [tuple(region) for region in regions]
+        if path:
+            index = cls.load(path)
+            if index is not None and index.digest == digest and index.regions == regions:
+                return index
+        index = cls.build(buf, regions, digest)
+        if path:
+            index.save(path)
+        return index
+
+    def sources_of(self, target: int):
+        '''[(source, flags)] of the branches to `target`'''
+        low = bisect_left(self.targets, target)
+        high = bisect_right(self.targets, target, low)
+        return [(self.sources[i], self.flags[i]) for i in range(low, high)]
+
+    def into(self, start: int, end: int, thumb: bool):
+        '''
+        [(source, target)] of the branches to (arm or thumb) code in [start, end)
+        other than `start` itself, where a hook's jump goes
+        '''
+        low = bisect_right(self.targets, start)
+        high = bisect_left(self.targets, end, low)
+        mode = TARGET_THUMB if thumb else 0
+        return [(self.sources[i], self.targets[i]) for i in range(low, high) if self.flags[i] & TARGET_THUMB == mode]
+
+    @classmethod
+    def load(cls, path: str):
+        '''the index saved at `path`, None if there is none (or a broken/foreign one)'''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, version, count, meta_size = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION or len(data) != cls.HEADER.size + meta_size + count * 9:
+            return None
+        pos = cls.HEADER.size
+        try:
+            meta = json.loads(data[pos : pos + meta_size])
+            index = cls(
+                digest=str(meta['digest']), regions=meta['regions'] and [tuple(map(int, r)) for r in meta['regions']]
+            )
+        except (KeyError, TypeError, ValueError):
+            return None
+        pos += meta_size
+        columns = []
+        for typecode, size in (('I', 4), ('I', 4), ('B', 1)):
+            column = array(typecode)
+            column.frombytes(data[pos : pos + count * size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column)
+            pos += count * size
+        index.targets, index.sources, index.flags = columns
+        return index
+
+    def save(self, path: str):
+        meta = json.dumps({'digest': self.digest, 'regions': self.regions}).encode()
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(self), len(meta)))
+            fp.write(meta)
+            for column in (self.targets, self.sources, self.flags):
+                if sys.byteorder == 'big':
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                fp.write(column.tobytes())
+        os.replace(tmp, path)
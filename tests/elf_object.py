@@ -0,0 +1,80 @@
+'''
+a relocatable ELF32 ARM object writer for the linker tests, like
+benchmarks/synth.write_elf but with any sections, symbols and REL relocations
+'''
+
+import struct
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_REL = 9
+SHF_ALLOC = 2
+SHF_EXECINSTR = 4
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+
+
+def write_object(path, sections, symbols, relocs=()):
+    '''
+    sections: [(name, data, flags)], executable ones get SHF_EXECINSTR in flags
+    symbols: [(name, section name or None for undefined, value, size, bind, type)], locals first
+    relocs: [(section name, offset, type, symbol name)], REL, the addends are in the data
+    '''
+    names = bytearray(b'\0')
+
+    def name_of(name, table):
+        offset = len(table)
+        table += name.encode() + b'\0'
+        return offset
+
+    index = {name: i + 1 for i, (name, _, _) in enumerate(sections)}
+    strtab = bytearray(b'\0')
+    symtab = bytearray(16)
+    numbers = {}
+    first_global = len(symbols) + 1
+    for number, (name, section, value, size, bind, stype) in enumerate(symbols, 1):
+        if bind != STB_LOCAL:
+            first_global = min(first_global, number)
+        numbers.setdefault(name, number)
+        shndx = index[section] if section else 0
+        symtab += struct.pack('<IIIBBH', name_of(name, strtab), value, size, bind << 4 | stype, 0, shndx)
+
+    by_section = {}
+    for section, offset, rtype, name in relocs:
+        by_section.setdefault(section, bytearray())
+        by_section[section] += struct.pack('<II', offset, numbers[name] << 8 | rtype)
+
+    symtab_index = len(sections) + len(by_section) + 1
+    # name, type, flags, link, info, addralign, entsize, data
+    headers = [(0, 0, 0, 0, 0, 0, 0, b'')]
+    for name, data, flags in sections:
+        headers.append((name_of(name, names), SHT_PROGBITS, SHF_ALLOC | flags, 0, 0, 4, 0, data))
+    for section, data in by_section.items():
+        headers.append((name_of('.rel' + section, names), SHT_REL, 0, symtab_index, index[section], 4, 8, data))
+    headers.append((name_of('.symtab', names), SHT_SYMTAB, 0, symtab_index + 1, first_global, 4, 16, symtab))
+    headers.append((name_of('.strtab', names), SHT_STRTAB, 0, 0, 0, 1, 0, strtab))
+    headers.append((name_of('.shstrtab', names), SHT_STRTAB, 0, 0, 0, 1, 0, names))
+
+    out = bytearray(52)
+    table = []
+    for name, stype, flags, link, info, align, entsize, data in headers:
+        out += bytes(-len(out) & 3)
+        table.append(
+            struct.pack('<10I', name, stype, flags, 0, len(out) if data else 0, len(data), link, info, align, entsize)
+        )
+        out += data
+    out += bytes(-len(out) & 3)
+    section_offset = len(out)
+    out += b''.join(table)
+    ident = b'\x7fELF' + bytes([1, 1, 1]) + bytes(9)
+    # ET_REL, EM_ARM, EABI version 5
+    out[:52] = ident + struct.pack(
+        '<HHIIIIIHHHHHH', 1, 40, 1, 0, 0, section_offset, 0x05000000, 52, 0, 0, 40, len(headers), len(headers) - 1
+    )
+    with open(path, 'wb') as fp:
+        fp.write(out)
@@ -0,0 +1,27 @@
+'''
+run patched code with unicorn: the rom at its base, a stack in IWRAM, from
+`start` until `stop` (rom offsets, thumb when `thumb`)
+'''
+
+from unicorn import UC_ARCH_ARM, UC_MODE_ARM, Uc, arm_const
+
+from bin_patch_kit import GBA_BASE
+
+STACK = 0x03000000
+STACK_SIZE = 0x8000
+REGS = [getattr(arm_const, f'UC_ARM_REG_R{i}') for i in range(13)]
+
+
+def run(rom, start, stop, thumb, regs=(), base=GBA_BASE, count=10000):
+    '''r0-r12 after running, `regs` sets the first ones; fails if `stop` is not reached'''
+    uc = Uc(UC_ARCH_ARM, UC_MODE_ARM)
+    uc.mem_map(base, (len(rom) + 0xFFF) & ~0xFFF)
+    uc.mem_write(base, bytes(rom))
+    uc.mem_map(STACK, STACK_SIZE)
+    uc.reg_write(arm_const.UC_ARM_REG_SP, STACK + STACK_SIZE - 0x100)
+    for reg, value in zip(REGS, regs):
+        uc.reg_write(reg, value)
+    uc.emu_start(base + start | thumb, base + stop, count=count)
+    pc = uc.reg_read(arm_const.UC_ARM_REG_PC)
+    assert pc == base + stop, f'stopped at {pc:08x}'
+    return [uc.reg_read(reg) for reg in REGS]
@@ -0,0 +1,52 @@
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, analyze_hook_function
+
+REG_R4 = 4
+
+
+def assemble(arch, asm):
+    return bytes(ENGINES.assembler(arch).asm(asm, 0)[0])
+
+
+@pytest.mark.parametrize(
+    'arch, asm',
+    [
+        (ARCH.ARM_THUMB, 'push {r4, lr}; ldr r3, [r0, #20]; adds r3, #1; str r3, [r0, #20]; movs r0, #0; pop {r4, pc}'),
+        (ARCH.ARM, 'stmdb sp!, {r4, lr}; ldr r3, [r0, #20]; add r3, r3, #1; str r3, [r0, #20]; ldmia sp!, {r4, pc}'),
+        (ARCH.ARM, 'push {r4}; mov r3, r0; str r2, [r3, #20]; pop {r4}; bx lr'),
+    ],
+)
+def test_field_access(arch, asm):
+    usage = analyze_hook_function(assemble(arch, asm), arch)
+    assert usage is not None
+    assert REG_R4 in usage.written and REG_R4 in usage.restore()
+
+
+@pytest.mark.parametrize(
+    'arch, asm',
+    [
+        # the pointer goes to the stack and comes back in another register
+        (ARCH.ARM_THUMB, 'push {r0}; ldr r3, [sp]; str r2, [r3, #20]; add sp, #4; bx lr'),
+        (ARCH.ARM_THUMB, 'mov r1, r0; push {r1, lr}; pop {r3}; str r2, [r3, #20]; pop {pc}'),
+        (ARCH.ARM, 'stmdb sp!, {r0}; ldmia sp!, {r3}; str r2, [r3, #20]; bx lr'),
+        (ARCH.ARM, 'stmib sp, {r0, r1}; ldr r3, [sp, #4]; str r2, [r3, #20]; bx lr'),
+        (ARCH.ARM, 'str r0, [sp, #-4]!; ldr r3, [sp], #4; str r2, [r3, #20]; bx lr'),
+    ],
+)
+def test_pointer_spilled(arch, asm):
+    assert analyze_hook_function(assemble(arch, asm), arch) is None
+
+
+@pytest.mark.parametrize(
+    'arch, asm',
+    [
+        (ARCH.ARM_THUMB, 'push {lr}; bl #0x100; pop {pc}'),
+        (ARCH.ARM, 'ldr r1, [r0, r2]; bx lr'),
+        (ARCH.ARM, 'str r1, [r0, #60]; bx lr'),
+        (ARCH.ARM, 'mrs r1, cpsr; bx lr'),
+    ],
+)
+def test_unsure(arch, asm):
+    # a call, a register offset, regs->sp written, the cpsr
+    assert analyze_hook_function(assemble(arch, asm), arch) is None
@@ -0,0 +1,184 @@
+from struct import unpack
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES
+from bin_patch_kit.arm import (
+    ARM_LOADS,
+    THUMB_FAR_CALL,
+    THUMB_LOADS,
+    encode_arm_add_pc,
+    encode_arm_blx,
+    encode_arm_branch,
+    encode_arm_ldr_pc,
+    encode_arm_load,
+    encode_thumb2_add_pc,
+    encode_thumb2_ldr_pc,
+    encode_thumb_bl,
+    encode_thumb_blx,
+    encode_thumb_branch,
+    encode_thumb_cbz,
+    encode_thumb_far_call,
+    encode_thumb_ldr_pc,
+    encode_thumb_load,
+)
+
+SRC = 0x08100000
+CONDS = ['al', 'eq', 'ne', 'hs', 'lo', 'mi', 'pl', 'vs', 'vc', 'hi', 'ls', 'ge', 'lt', 'gt', 'le']
+
+
+def keystone(arch, asm, address=0):
+    return bytes(ENGINES.assembler(arch).asm(asm, address)[0])
+
+
+def branch_target(arch, code, address):
+    '''(size, target) of the branch capstone decodes from `code`'''
+    insn = next(ENGINES.disassembler(arch).disasm(code, address))
+    return insn.size, int(insn.op_str.lstrip('#'), 16)
+
+
+def edges(low, high, step):
+    '''offsets around both limits and zero, `step` apart'''
+    near = [low, low + step, -step, 0, step, high - step, high]
+    return sorted({offset for offset in near if low <= offset <= high})
+
+
+@pytest.mark.parametrize('link', [False, True])
+@pytest.mark.parametrize('cond', CONDS)
+def test_arm_branch(cond, link):
+    for offset in edges(-0x2000000, 0x1FFFFFC, 4) + [0x123454, -0x7654320]:
+        if not -0x2000000 <= offset <= 0x1FFFFFC:
+            continue
+        dst = SRC + 8 + offset
+        mnemonic = ('bl' if link else 'b') + ('' if cond == 'al' else cond)
+        code = encode_arm_branch(SRC, dst, cond, link)
+        assert code == keystone(ARCH.ARM, f'{mnemonic} #{dst:#x}', SRC)
+        assert branch_target(ARCH.ARM, code, SRC) == (4, dst)
+
+
+@pytest.mark.parametrize('offset', [-0x2000004, 0x2000000, 2])
+def test_arm_branch_out_of_range(offset):
+    with pytest.raises(ValueError):
+        encode_arm_branch(SRC, SRC + 8 + offset)
+
+
+@pytest.mark.parametrize('imm', [-0xFFF, -0x100, -4, 0, 4, 0x7F8, 0xFFF])
+@pytest.mark.parametrize('rt', [0, 3, 12, 15])
+def test_arm_ldr_pc(rt, imm):
+    assert encode_arm_ldr_pc(imm, rt) == keystone(ARCH.ARM, f'ldr r{rt}, [pc, #{imm}]')
+
+
+@pytest.mark.parametrize('kind', list(ARM_LOADS))
+def test_arm_load(kind):
+    assert encode_arm_load(kind, 2, 7) == keystone(ARCH.ARM, f'{kind} r2, [r7]')
+
+
+@pytest.mark.parametrize('imm', [0, 4, 0x80, 0xFF])
+def test_arm_add_pc(imm):
+    assert encode_arm_add_pc(5, imm) == keystone(ARCH.ARM, f'add r5, pc, #{imm}')
+
+
+@pytest.mark.parametrize('cond', CONDS)
+def test_thumb_branch(cond):
+    mnemonic = 'b' if cond == 'al' else f'b{cond}'
+    if cond == 'al':
+        # the narrow limits, where keystone relaxes to the wide form, and wide ones short of the last words
+        # (keystone can't encode those, and wraps -0x804/-0x802 into a narrow forward branch)
+        offsets = [-0x806, -0x800, 0x7F8, 0x7FA, 0x7FC, 0x7FE] + edges(-0xFFFFFE, 0xFFFFF6, 2) + [0x12344, -0x65432]
+    else:
+        # keystone's b<cond>.w has J1/J2 swapped and the offset off by 4, only the narrow form is comparable
+        offsets = range(-0x100, 0xFC, 2)
+    for offset in offsets:
+        dst = SRC + 4 + offset
+        assert encode_thumb_branch(SRC, dst, cond) == keystone(ARCH.ARM_THUMB, f'{mnemonic} #{dst:#x}', SRC), hex(
+            offset
+        )
+
+
+@pytest.mark.parametrize('cond', CONDS)
+def test_thumb_branch_target(cond):
+    high = 0xFFFFFE if cond == 'al' else 0xFFFFE
+    narrow = [-0x802, -0x800, 0x7FA, 0x7FC] if cond == 'al' else [-0x102, -0x100, 0xFA, 0xFC]
+    for offset in edges(-high - 2, high, 2) + narrow + [0x12344, -0x65432]:
+        dst = SRC + 4 + offset
+        code = encode_thumb_branch(SRC, dst, cond)
+        assert branch_target(ARCH.ARM_THUMB, code, SRC) == (len(code), dst), hex(offset)
+
+
+def test_thumb_branch_out_of_range():
+    with pytest.raises(ValueError):
+        encode_thumb_branch(SRC, SRC + 4 + 0x1000000)
+    with pytest.raises(ValueError):
+        encode_thumb_branch(SRC, SRC + 4 + 0x100000, 'eq')
+    with pytest.raises(ValueError):
+        encode_thumb_branch(SRC, SRC + 5)
+
+
+def test_thumb_bl():
+    for offset in edges(-0x1000000, 0xFFFFFE, 2) + [0x3FFFFE, -0x400000, 0x123456]:
+        dst = SRC + 4 + offset
+        code = encode_thumb_bl(SRC, dst)
+        assert code == keystone(ARCH.ARM_THUMB, f'bl #{dst:#x}', SRC), hex(offset)
+        assert branch_target(ARCH.ARM_THUMB, code, SRC) == (4, dst)
+
+
+def test_arm_blx():
+    for offset in edges(-0x2000000, 0x1FFFFFE, 2) + [0x123456, -0x1654322]:
+        dst = SRC + 8 + offset
+        code = encode_arm_blx(SRC, dst)
+        assert code == keystone(ARCH.ARM, f'blx #{dst:#x}', SRC), hex(offset)
+        assert branch_target(ARCH.ARM, code, SRC) == (4, dst)
+    with pytest.raises(ValueError):
+        encode_arm_blx(SRC, SRC + 9)
+
+
+@pytest.mark.parametrize('src', [SRC, SRC + 2])
+def test_thumb_blx(src):
+    for offset in edges(-0x1000000, 0xFFFFFC, 4) + [0x3FFFFC, -0x400000, 0x123454]:
+        dst = SRC + 4 + offset
+        code = encode_thumb_blx(src, dst)
+        assert code == keystone(ARCH.ARM_THUMB, f'blx #{dst:#x}', src), hex(offset)
+        assert branch_target(ARCH.ARM_THUMB, code, src) == (4, dst)
+    with pytest.raises(ValueError):
+        encode_thumb_blx(src, SRC + 6)
+
+
+@pytest.mark.parametrize('nonzero', [False, True])
+def test_thumb_cbz(nonzero):
+    mnemonic = 'cbnz' if nonzero else 'cbz'
+    for offset in range(0, 0x80, 2):
+        dst = SRC + 4 + offset
+        assert encode_thumb_cbz(SRC, dst, 3, nonzero) == keystone(ARCH.ARM_THUMB, f'{mnemonic} r3, #{dst:#x}', SRC)
+
+
+@pytest.mark.parametrize('imm', [0, 4, 0x100, 0x3FC])
+def test_thumb_ldr_pc(imm):
+    assert encode_thumb_ldr_pc(6, imm) == keystone(ARCH.ARM_THUMB, f'ldr r6, [pc, #{imm}]')
+
+
+@pytest.mark.parametrize('kind', list(THUMB_LOADS))
+def test_thumb_load(kind):
+    assert encode_thumb_load(kind, 1, 4) == keystone(ARCH.ARM_THUMB, f'{kind} r1, [r4]')
+
+
+@pytest.mark.parametrize('imm', [-0xFFF, -4, 0, 4, 0x800, 0xFFF])
+def test_thumb2_ldr_pc(imm):
+    assert encode_thumb2_ldr_pc(imm) == keystone(ARCH.ARM_THUMB, f'ldr.w pc, [pc, #{imm}]')
+
+
+@pytest.mark.parametrize('imm', [0, 4, 0xFF, 0x100, 0x801, 0xFFF])
+def test_thumb2_add_pc(imm):
+    assert encode_thumb2_add_pc(2, imm) == keystone(ARCH.ARM_THUMB, f'addw r2, pc, #{imm}')
+
+
+@pytest.mark.parametrize('src', [SRC, SRC + 2])
+def test_thumb_far_call(src):
+    code = encode_thumb_far_call(src)
+    halves = unpack('<7H', code)
+    assert halves[:2] + halves[3:] == THUMB_FAR_CALL[:2] + THUMB_FAR_CALL[3:]
+    # lr = pc of `mov r0, pc` + imm, the thumb address past the (aligned) literal
+    literal = src + 14 + (src + 14) % 4
+    assert src + 6 + (halves[2] & 0xFF) == (literal + 4) | 1
+    assert (
+        code == keystone(ARCH.ARM_THUMB, f'push {{r0, r1}}; mov r0, pc; adds r0, #{halves[2] & 0xFF}', src) + code[6:]
+    )
@@ -0,0 +1,125 @@
+import json
+import struct
+
+import pytest
+
+from bin_patch_kit import GBA_BASE, AsmCache, ElfHelper, patch_batch, patch_rom
+from bin_patch_kit.__main__ import main
+
+from elf_object import SHF_ALLOC, SHF_EXECINSTR, STB_GLOBAL, STT_FUNC, write_object
+
+# mov r0, #0; bx lr
+HOOK_ARM = struct.pack('<2I', 0xE3A00000, 0xE12FFF1E)
+# movs r0, #0; bx lr
+HOOK_THUMB = struct.pack('<2H', 0x2000, 0x4770)
+ARM_NOP = struct.pack('<I', 0xE1A00000)
+THUMB_NOP = struct.pack('<H', 0x46C0)
+
+
+@pytest.fixture
+def elf_path(tmp_path):
+    path = str(tmp_path / 'hooks.o')
+    write_object(
+        path,
+        [('.text', HOOK_ARM + HOOK_THUMB, SHF_ALLOC | SHF_EXECINSTR)],
+        [
+            ('hook_arm', '.text', 0, 8, STB_GLOBAL, STT_FUNC),
+            ('hook_thumb', '.text', 8 | 1, 4, STB_GLOBAL, STT_FUNC),
+        ],
+    )
+    return path
+
+
+def make_rom(path, arm_code, thumb_code):
+    '''arm nops, then thumb nops from `thumb_code`, free space at 0x1000'''
+    rom = bytearray(ARM_NOP * 0x400)
+    rom[thumb_code:arm_code] = THUMB_NOP * ((arm_code - thumb_code) // 2)
+    path.write_bytes(bytes(rom) + bytes(0x1000))
+    return str(path)
+
+
+def make_roms(tmp_path):
+    '''two revisions with the same hooks at other addresses, and a third one calling a missing function'''
+    roms = {}
+    for name, arm_site, thumb_site in (('usa', 0x100, 0x800), ('jpn', 0x140, 0x880)):
+        rom_path = make_rom(tmp_path / f'{name}.gba', 0x1000, 0x600)
+        roms[name] = {
+            'rom_path': rom_path,
+            'rom_base': GBA_BASE,
+            'empty_address': 0x1000,
+            'jobs': [
+                {'arch': 'arm', 'type': 'hook', 'address': arm_site, 'func': 'hook_arm'},
+                {'arch': 'thumb', 'type': 'hook_func', 'address': thumb_site, 'func': 'hook_thumb'},
+            ],
+            'output_path': str(tmp_path / f'{name}_out.gba'),
+        }
+    roms['bad'] = {
+        **roms['usa'],
+        'jobs': [{'arch': 'arm', 'type': 'hook', 'address': 0x100, 'func': 'missing'}],
+        'output_path': str(tmp_path / 'bad_out.gba'),
+    }
+    return roms
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_batch(tmp_path, elf_path, workers):
+    roms = make_roms(tmp_path)
+    cache = AsmCache(str(tmp_path / 'asm.cache'))
+    report = patch_batch(elf_path, roms, workers=workers, asm_cache=cache)
+    assert [rom['name'] for rom in report.roms] == ['usa', 'jpn', 'bad']
+    assert not report.ok and [rom['name'] for rom in report.failed()] == ['bad']
+    assert 'missing' in report.failed()[0]['error']
+    text = str(report)
+    assert 'FAILED' in text and text.endswith('2/3 roms patched')
+    assert json.loads(report.to_json())['ok'] is False
+
+    # like patch_rom on each rom, with the functions of the elf
+    with ElfHelper(elf_path) as elf:
+        functions = {name: elf.get_opcodes(name) for name in ('hook_arm', 'hook_thumb')}
+    for name in ('usa', 'jpn'):
+        expected = patch_rom(
+            **{**roms[name], 'output_path': str(tmp_path / 'expected.gba')}, code_path=None, functions=functions
+        )
+        with open(roms[name]['output_path'], 'rb') as fp, open(tmp_path / 'expected.gba', 'rb') as expected_fp:
+            assert fp.read() == expected_fp.read()
+        summary = report.roms[[rom['name'] for rom in report.roms].index(name)]
+        assert summary['report']['jobs'] == json.loads(expected.to_json())['jobs']
+
+    # the workers' keystone results came back and were saved
+    assert len(cache) > 0 and len(AsmCache(str(tmp_path / 'asm.cache'))) == len(cache)
+
+
+def test_command_line(tmp_path, elf_path, capsys):
+    make_rom(tmp_path / 'usa.gba', 0x1000, 0x600)
+    make_rom(tmp_path / 'jpn.gba', 0x1000, 0x600)
+    config = {
+        'code': 'hooks.o',
+        'asm_cache': 'asm.cache',
+        'jobs': [{'name': 'font', 'arch': 'thumb', 'type': 'hook', 'func': 'hook_thumb'}],
+        'roms': {
+            'usa': {'rom': 'usa.gba', 'base': '0x08000000', 'empty': '0x1000', 'addresses': {'font': '0x800'}},
+            'jpn': {
+                'rom': 'jpn.gba',
+                'base': '0x08000000',
+                'empty': [['0x1000', '0x800']],
+                'addresses': {'font': '0x880'},
+                'output': 'jpn_out.gba',
+                'patch': 'jpn.ips',
+            },
+            # no address for the shared job
+            'eur': {'rom': 'usa.gba', 'base': '0x08000000', 'empty': '0x1000'},
+        },
+    }
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    original = (tmp_path / 'jpn.gba').read_bytes()
+    argv = ['batch', str(tmp_path / 'config.json'), '-j', '1', '--report', str(tmp_path / 'report.json')]
+    assert main(argv) == 1
+    assert 'eur' in capsys.readouterr().out
+    report = json.loads((tmp_path / 'report.json').read_text())
+    assert [(rom['name'], rom['ok']) for rom in report['roms']] == [('usa', True), ('jpn', True), ('eur', False)]
+    assert report['roms'][1]['report']['jobs'][0]['address'] == 0x880
+    # patched in place, to an output and as a patch
+    assert (tmp_path / 'usa.gba').read_bytes() != original
+    assert (tmp_path / 'jpn.gba').read_bytes() == original
+    main(['apply', str(tmp_path / 'jpn.ips'), str(tmp_path / 'jpn.gba'), str(tmp_path / 'applied.gba')])
+    assert (tmp_path / 'applied.gba').read_bytes() == (tmp_path / 'jpn_out.gba').read_bytes()
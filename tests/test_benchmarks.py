@@ -0,0 +1,89 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, ElfHelper, find_empty_space
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks')
+sys.path.insert(0, BENCHMARKS)
+
+import scaling  # noqa: E402
+import synth  # noqa: E402
+
+# small roms, the default sizes take seconds to generate
+SIZE = 0x40000
+
+
+@pytest.fixture(params=list(synth.PROFILES))
+def rom(request, tmp_path):
+    '''a rom where scaling.prepare finds it'''
+    path = str(tmp_path / f'{request.param}.bin')
+    return path, synth.make_rom(path, request.param, size=SIZE)
+
+
+def test_make_rom(rom):
+    path, info = rom
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    assert len(data) == info['size'] == SIZE and synth.load_rom_info(path) == json.loads(json.dumps(info))
+    assert info['arm'] and info['thumb'] and max(info['arm']) < min(info['thumb'])
+    # every function starts with push {r4-r7, lr}
+    assert all(data[offset : offset + 4] == synth.ARM_PROLOGUE for offset in info['arm'])
+    assert all(data[offset : offset + 2] == synth.THUMB_PROLOGUE for offset in info['thumb'])
+    for hole, size in info['holes']:
+        assert data[hole : hole + size] == bytes([info['fill']]) * size
+    # the code decodes
+    for arch, cs_arch in (('arm', ARCH.ARM), ('thumb', ARCH.ARM_THUMB)):
+        offset = info[arch][len(info[arch]) // 2]
+        assert len(list(ENGINES.disassembler(cs_arch).disasm_lite(data[offset : offset + 0x20], 0))) > 4
+    # the free space is the holes and the tail
+    free = find_empty_space(path, fill=info['fill'], min_size=0x200)
+    assert all(any(start <= hole < start + size for start, size in free) for hole, _ in info['holes'])
+    other = str(os.path.dirname(path) + '/again.bin')
+    synth.make_rom(other, info['profile'], size=SIZE)
+    with open(other, 'rb') as fp:
+        assert fp.read() == data
+
+
+def test_write_elf(tmp_path):
+    functions = synth.hook_functions(6)
+    path = str(tmp_path / 'hooks.o')
+    synth.write_elf(path, functions)
+    elf = ElfHelper(path)
+    for name, code, _ in functions:
+        assert bytes(elf.get_opcodes(name)) == code
+
+
+@pytest.mark.parametrize('benchmark', scaling.BENCHMARKS)
+def test_run_one(rom, benchmark):
+    path, info = rom
+    result = scaling.run_one(benchmark, os.path.dirname(path), info['profile'], 8, None)
+    assert result['wall'] > 0 and result['phases']
+    if benchmark == 'patch_rom':
+        assert {'scan', 'elf', 'load', 'patch', 'commit'} <= set(result['phases'])
+
+
+def test_compare(tmp_path, capsys):
+    result = {'profile': 'gba', 'benchmark': 'patch_rom', 'jobs': 10, 'wall': 2.0}
+    path = tmp_path / 'old.json'
+    path.write_text(json.dumps({'meta': {'revision': 'abc'}, 'results': [{**result, 'wall': 4.0}]}))
+    scaling.compare(str(path), [result, {**result, 'jobs': 20}])
+    lines = capsys.readouterr().out.splitlines()
+    assert 'abc' in lines[1] and len(lines) == 4 and lines[3].split()[-1] == '0.50'
+
+
+def test_command_line(rom, tmp_path):
+    path, info = rom
+    output = tmp_path / 'results.json'
+    subprocess.check_call(
+        [sys.executable, os.path.join(BENCHMARKS, 'scaling.py'), '--jobs', '4', '--profiles', info['profile']]
+        + ['--benchmarks', 'patch_rom', 'find_empty_space', '--keep', os.path.dirname(path)]
+        + ['--output', str(output)],
+        stdout=subprocess.DEVNULL,
+    )
+    results = json.loads(output.read_text())
+    assert [(r['benchmark'], r['jobs']) for r in results['results']] == [('patch_rom', 4), ('find_empty_space', None)]
+    assert results['meta']['workers'] is None
@@ -0,0 +1,33 @@
+import io
+
+import pytest
+
+from bin_patch_kit import ArmPatcher, AsmCache, ThumbPatcher
+
+BASE = 0x08000000
+
+
+@pytest.mark.parametrize(
+    'asm',
+    ['bl 0x8000800', 'bl #0x8000800', 'b 0x8000800', 'beq 0x8000800', 'blx 0x8000800', 'bne.w 0x8000800'],
+)
+def test_branch_is_address_dependent(asm):
+    assert AsmCache.is_address_dependent(asm)
+
+
+@pytest.mark.parametrize('asm', ['bx lr', 'blx r3', 'push {r0-r12, lr}', 'ldr pc, [pc, #-4]', 'mov r0, #1'])
+def test_fixed_encoding_is_not_address_dependent(asm):
+    assert not AsmCache.is_address_dependent(asm)
+
+
+@pytest.mark.parametrize('patcher_type', [ArmPatcher, ThumbPatcher])
+@pytest.mark.parametrize('asm', ['bl 0x8000800', 'bl #0x8000800', 'b 0x8000800'])
+def test_branch_at_two_addresses(patcher_type, asm):
+    cached = patcher_type(io.BytesIO(bytes(0x400)), BASE, AsmCache())
+    plain = patcher_type(io.BytesIO(bytes(0x400)), BASE)
+    for address in (0x100, 0x200):
+        size = cached.assemble(asm, address)
+        plain.assemble(asm, address)
+        assert cached._io.getvalue()[address : address + size] == plain._io.getvalue()[address : address + size]
+    assert cached._io.getvalue() == plain._io.getvalue()
+    assert cached._asm_cache.stats()['hits'] == 0
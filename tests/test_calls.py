@@ -0,0 +1,47 @@
+import io
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE
+from bin_patch_kit.arm import ThumbPatcher
+
+pytest.importorskip('unicorn')
+from emulate import run  # noqa: E402
+
+
+def keystone(asm):
+    return bytes(ENGINES.assembler(ARCH.ARM_THUMB).asm(asm)[0])
+
+
+def called(src, dst):
+    '''movs r0, #1; call dst (adds r0, #4; bx lr); adds r0, #2; b . from src, return (rom, call size, stop)'''
+    rom = bytearray(max(src, dst) + 0x100)
+    rom[dst : dst + 4] = keystone('adds r0, #4; bx lr')
+    buf = io.BytesIO(bytes(rom))
+    patcher = ThumbPatcher(buf, GBA_BASE)
+    patcher.emit(keystone('movs r0, #1'), src)
+    size = patcher.call_patch(dst)
+    patcher.emit(keystone('adds r0, #2'))
+    stop = buf.tell()
+    patcher.emit(keystone('b .'))
+    return buf.getvalue(), size, stop
+
+
+@pytest.mark.parametrize(
+    'src, dst, size',
+    [
+        # the thumb-1 bl pair, up to CALL_RANGE
+        (0x100, 0x300, 4),
+        (0x100, 0x100 + 2 + ThumbPatcher.CALL_RANGE - 2, 4),
+        (0x3FFF00, 0x200, 4),
+        # THUMB_FAR_CALL (at src + 2) and its literal, without and with the nop aligning it
+        (0x100, 0x500000, 0x12),
+        (0x102, 0x500000, 0x14),
+        (0x500000, 0x200, 0x12),
+        (0x500002, 0x202, 0x14),
+    ],
+)
+def test_thumb_call_runs(src, dst, size):
+    rom, call_size, stop = called(src, dst)
+    assert call_size == size
+    assert run(rom, src, stop, True)[0] == 7
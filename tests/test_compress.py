@@ -0,0 +1,184 @@
+import random
+import struct
+
+import pytest
+
+from bin_patch_kit import NDS_BASE, compress
+from bin_patch_kit.compress import (
+    CODECS,
+    NITRO_CODE,
+    CompressionError,
+    blz_compress,
+    blz_decompress,
+    lz77_compress,
+    lz77_decompress,
+    lz_parse,
+    set_overlay_size,
+)
+
+
+def samples():
+    '''(name, data): empty, tiny, random, few-symbol, runs, code-like, compressible tail after a random head'''
+    rnd = random.Random(7)
+    words = [rnd.getrandbits(32) for _ in range(24)]
+    code = b''.join(struct.pack('<I', rnd.choice(words)) for _ in range(0x1800))
+    mixed = bytes(rnd.getrandbits(8) for _ in range(0x800)) + bytes(rnd.randrange(3) for _ in range(0x1000))
+    return [
+        ('empty', b''),
+        ('tiny', b'abc'),
+        ('random', bytes(rnd.getrandbits(8) for _ in range(0x1000))),
+        ('few', bytes(rnd.randrange(4) for _ in range(0x3000))),
+        ('runs', b'\0' * 0x2345 + b'\xff' * 0x17 + b'ab' * 0x300),
+        ('code', code),
+        ('mixed', mixed),
+    ]
+
+
+SAMPLES = samples()
+IDS = [name for name, _ in SAMPLES]
+
+
+@pytest.fixture(params=['numpy', 'hash chains'])
+def finder(request, monkeypatch):
+    '''run with the numpy match finder and with the hash-chain fallback'''
+    if request.param == 'numpy':
+        if compress.np is None:
+            pytest.skip('numpy is not installed')
+    else:
+        monkeypatch.setattr(compress, 'np', None)
+    return request.param
+
+
+def decode_blz_in_place(packed):
+    '''MIi_UncompressBackward on one buffer, the way the arm9 decompresses itself'''
+    end = len(packed)
+    encoded, increase = struct.unpack_from('<II', packed, end - 8)
+    buf = bytearray(packed) + bytes(increase)
+    read, stop, write = end - (encoded >> 24), end - (encoded & 0xFFFFFF), end + increase
+    while read > stop:
+        read -= 1
+        flags = buf[read]
+        for _ in range(8):
+            if read <= stop:
+                break
+            if flags & 0x80:
+                read -= 2
+                high, low = buf[read + 1], buf[read]
+                disp = ((high & 0xF) << 8 | low) + 2
+                for _ in range((high >> 4) + 3):
+                    write -= 1
+                    buf[write] = buf[write + disp + 1]
+            else:
+                read -= 1
+                write -= 1
+                buf[write] = buf[read]
+            # the bytes written must never overtake the ones still to read
+            assert write >= read
+            flags <<= 1
+    return bytes(buf)
+
+
+@pytest.mark.parametrize('data', [data for _, data in SAMPLES], ids=IDS)
+@pytest.mark.parametrize('vram', [False, True])
+def test_lz77_round_trip(finder, data, vram):
+    packed = lz77_compress(data, vram)
+    assert len(packed) % 4 == 0
+    assert packed[0] == 0x10 and int.from_bytes(packed[1:4], 'little') == len(data)
+    assert bytes(lz77_decompress(packed)) == data
+
+
+@pytest.mark.parametrize('data', [data for _, data in SAMPLES], ids=IDS)
+def test_blz_round_trip(finder, data):
+    packed = blz_compress(data)
+    if len(packed) < len(data):
+        assert len(packed) % 4 == 0
+        assert bytes(blz_decompress(packed)) == data
+        assert decode_blz_in_place(packed) == data
+    else:
+        # nothing to gain, the data as it is
+        assert packed == data
+
+
+def test_match_finders_agree(monkeypatch):
+    if compress.np is None:
+        pytest.skip('numpy is not installed')
+    for _, data in SAMPLES:
+        for min_disp, max_disp in ((1, 0x1000), (2, 0x1000), (3, 0x1002)):
+            expected = lz_parse(data, min_disp, max_disp)
+            with monkeypatch.context() as patch:
+                patch.setattr(compress, 'np', None)
+                assert lz_parse(data, min_disp, max_disp) == expected
+
+
+@pytest.mark.parametrize('min_disp', [1, 2, 3])
+def test_parse_limits(finder, min_disp):
+    data = SAMPLES[3][1]
+    for position, length, disp in lz_parse(data, min_disp, 0x1000):
+        assert 3 <= length <= 0x12 and min_disp <= disp <= 0x1000
+        assert data[position : position + length] == data[position - disp : position - disp + length]
+
+
+def test_compresses():
+    code = SAMPLES[5][1]
+    assert len(lz77_compress(code)) < len(code) // 2
+    assert len(blz_compress(code)) < len(code) // 2
+
+
+def test_broken_data():
+    with pytest.raises(CompressionError):
+        lz77_decompress(b'\x11\x10\0\0')
+    with pytest.raises(CompressionError):
+        lz77_decompress(lz77_compress(SAMPLES[5][1])[:0x40])
+    packed = bytearray(blz_compress(SAMPLES[5][1]))
+    packed[-8:-5] = (len(packed) + 1).to_bytes(3, 'little')
+    with pytest.raises(CompressionError):
+        blz_decompress(packed)
+
+
+def make_arm9():
+    rnd = random.Random(3)
+    raw = bytearray(rnd.getrandbits(8) for _ in range(0x4000))
+    raw += SAMPLES[5][1] * 2
+    params = 0xB00
+    struct.pack_into('<7I', raw, params, 0, 0, 0, 0x02100000, 0x02110000, 0, 0x5000000)
+    raw[params + 0x1C : params + 0x24] = NITRO_CODE
+    return bytes(raw), params
+
+
+@pytest.mark.parametrize('footer', [False, True])
+def test_arm9_codec(footer):
+    raw, params = make_arm9()
+    if footer:
+        raw += struct.pack('<III', 0xDEC00621, params, 0)
+    codec = CODECS['arm9']
+    packed = codec.encode(raw, NDS_BASE)
+    end = struct.unpack_from('<I', packed, params + 0x14)[0]
+    assert len(packed) < len(raw)
+    # the secure area is kept but for compressed_static_end, where the compressed part ends
+    head = bytearray(packed[:0x4000])
+    struct.pack_into('<I', head, params + 0x14, 0)
+    assert head == raw[:0x4000]
+    assert end == NDS_BASE + len(packed) - (12 if footer else 0)
+    if footer:
+        assert packed[-12:] == raw[-12:]
+    assert bytes(codec.decode(packed, NDS_BASE)) == raw
+    # an uncompressed arm9 passes through
+    assert bytes(codec.decode(raw, NDS_BASE)) == raw
+
+
+def test_codecs_round_trip():
+    data = SAMPLES[5][1]
+    for name in ('lz77', 'lz77_vram', 'blz'):
+        codec = CODECS[name]
+        assert bytes(codec.decode(codec.encode(data, 0), 0)) == data
+
+
+def test_set_overlay_size(tmp_path):
+    table = tmp_path / 'y9.bin'
+    table.write_bytes(b''.join(struct.pack('<8I', i, 0, 0, 0, 0, 0, i, 0x1234) for i in range(3)))
+    set_overlay_size(str(table), 1, 0xABCDE)
+    data = table.read_bytes()
+    assert struct.unpack_from('<I', data, 32 + 0x1C)[0] == 0x010ABCDE
+    assert struct.unpack_from('<I', data, 0x1C)[0] == struct.unpack_from('<I', data, 64 + 0x1C)[0] == 0x1234
+    with pytest.raises(KeyError):
+        set_overlay_size(str(table), 7, 0x100)
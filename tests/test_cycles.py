@@ -0,0 +1,102 @@
+import struct
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE, NDS_BASE, patch_rom
+from bin_patch_kit.analysis import REGISTERS_OFFSETS
+from bin_patch_kit.cycles import GBA_TIMINGS, MEMORY_TIMINGS, NDS9_TIMINGS, count_cycles
+
+# (S, N, I) from the ARM7TDMI TRM
+ARM_CYCLES = [
+    ('mov r0, r1', (1, 0, 0)),
+    ('add r0, r1, r2, lsl r3', (1, 0, 1)),
+    ('mov pc, lr', (2, 1, 0)),
+    ('mul r0, r1, r2', (1, 0, 4)),
+    ('ldr r0, [r1]', (1, 1, 1)),
+    ('ldr pc, [r0]', (2, 2, 1)),
+    ('str r0, [r1]', (0, 2, 0)),
+    ('ldm r0, {r1, r2}', (2, 1, 1)),
+    ('push {r4-r7, lr}', (4, 2, 0)),
+    ('pop {r4-r7, pc}', (6, 2, 1)),
+    ('swp r0, r1, [r2]', (1, 2, 1)),
+    ('b #0x100', (2, 1, 0)),
+    ('svc #0', (2, 1, 0)),
+]
+THUMB_CYCLES = [
+    ('movs r0, #1', (1, 0, 0)),
+    ('push {r4, lr}', (1, 2, 0)),
+    # two instructions
+    ('bl #0x100', (3, 1, 0)),
+]
+
+
+def assemble(asm, arch=ARCH.ARM, address=0):
+    return bytes(ENGINES.assembler(arch).asm(asm, address)[0])
+
+
+@pytest.mark.parametrize('asm, cycles', ARM_CYCLES)
+def test_arm(asm, cycles):
+    assert count_cycles(assemble(asm), ARCH.ARM) == cycles
+
+
+@pytest.mark.parametrize('asm, cycles', THUMB_CYCLES)
+def test_thumb(asm, cycles):
+    assert count_cycles(assemble(asm, ARCH.ARM_THUMB), ARCH.ARM_THUMB) == cycles
+
+
+def test_sequence():
+    asm = '; '.join(asm for asm, _ in ARM_CYCLES)
+    assert count_cycles(assemble(asm), ARCH.ARM) == tuple(map(sum, zip(*(cycles for _, cycles in ARM_CYCLES))))
+
+
+def test_memory_timings():
+    assert GBA_TIMINGS.access(GBA_BASE) == (6, 4) and GBA_TIMINGS.access(GBA_BASE, 16) == (4, 2)
+    assert GBA_TIMINGS.region(0x03000000)[2] == 'iwram'
+    with pytest.raises(ValueError):
+        GBA_TIMINGS.region(0x10000000)
+    assert set(MEMORY_TIMINGS) == {'gba', 'nds7', 'nds9'}
+
+
+def test_path_cycles():
+    code = assemble('mov r0, r1; ldr r0, [sp]')
+    # rom fetches: 1S, then 1S + 1N data in iwram (the stack) + 1I
+    assert GBA_TIMINGS.path_cycles(code, [(0, 8)], ARCH.ARM, GBA_BASE) == 4 + 4 + 1 + 1
+    # all in iwram
+    assert GBA_TIMINGS.path_cycles(code, [(0, 8)], ARCH.ARM, 0x03000000) == 4
+    # a literal is read from the rom
+    code = assemble('ldr r0, [pc, #0]; ldrh r1, [r2]')
+    assert GBA_TIMINGS.path_cycles(code, [(0, 4)], ARCH.ARM, GBA_BASE) == 4 + 6 + 1
+    assert NDS9_TIMINGS.path_cycles(code, [(4, 8)], ARCH.ARM, NDS_BASE) == 4 + 1 + 1
+
+
+def test_path_branches():
+    # b over a literal goes on at its target, a branch out of the range ends the run
+    code = assemble('b #8; mov r0, r0; mov r1, r1', address=GBA_BASE)
+    assert GBA_TIMINGS.path_cycles(code, [(0, 12)], ARCH.ARM, GBA_BASE) == 2 * 4 + 6 + 4
+    assert GBA_TIMINGS.path_cycles(code, [(0, 4)], ARCH.ARM, GBA_BASE) == 2 * 4 + 6
+    assert GBA_TIMINGS.path_cycles(code, [(0, 4), (8, 12)], ARCH.ARM, GBA_BASE) == 2 * 4 + 6 + 4
+
+
+def test_report(tmp_path):
+    rom = tmp_path / 'rom.gba'
+    # arm nops (mov r0, r0) then free space
+    rom.write_bytes(struct.pack('<I', 0xE1A00000) * 0x400 + bytes(0x1000))
+    jobs = [{'arch': 'arm', 'type': 'hook_func', 'address': 0x100, 'func': 'hook'}]
+    # reads regs->r0 only
+    functions = {'hook': assemble(f'ldr r0, [r0, #{REGISTERS_OFFSETS[0]}]; bx lr')}
+    cycles = {}
+    for name, base, features in (
+        ('gba', GBA_BASE, {}),
+        ('minimal', GBA_BASE, {'minimal_save': True}),
+        # main ram, nds9 by default
+        ('nds9', NDS_BASE, {}),
+        ('nds7', NDS_BASE, {'platform': 'nds7'}),
+        # not mapped on the nds
+        ('unmapped', GBA_BASE, {'platform': 'nds9'}),
+    ):
+        report = patch_rom(
+            str(rom), base, None, 0x1000, jobs, str(tmp_path / f'{name}.bin'), functions=functions, **features
+        )
+        cycles[name] = report.jobs[0].get('cycles')
+    assert 0 < cycles['minimal'] < cycles['gba'] and cycles['nds7'] < cycles['nds9']
+    assert cycles['unmapped'] is None
@@ -0,0 +1,97 @@
+import io
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE
+from bin_patch_kit.arm import ArmPatcher, ThumbPatcher
+from bin_patch_kit.trace import PatchTracer
+
+CODE = {
+    ArmPatcher: 'mov r0, #1; ldr r1, [pc, #8]; add r0, r0, r1; bl 0x08000400; bx lr',
+    # bl is 4 bytes among 2 byte instructions
+    ThumbPatcher: 'movs r0, #1; bl 0x08000400; adds r0, #2; ldr r1, [pc, #4]; bx lr; mov r8, r8',
+}
+ARCHS = {ArmPatcher: ARCH.ARM, ThumbPatcher: ARCH.ARM_THUMB}
+START = 0x100
+
+
+def make_patcher(cls, file=None):
+    code = bytes(ENGINES.assembler(ARCHS[cls]).asm(CODE[cls], GBA_BASE + START)[0])
+    rom = bytearray(0x800)
+    rom[START : START + len(code)] = code
+    if file is not None:
+        file.write(rom)
+        file.seek(0)
+    # the tracer counts the capstone calls
+    patcher = cls(file or io.BytesIO(bytes(rom)), GBA_BASE, tracer=PatchTracer())
+    return patcher, len(code)
+
+
+def decodes(patcher):
+    return patcher._tracer.totals()[patcher._name]['capstone']
+
+
+def one_by_one(patcher, size):
+    result = []
+    address = START
+    while address < START + size:
+        insn = patcher.diassemble(address)
+        result.append((insn.address, insn.size, insn.mnemonic, insn.op_str))
+        address += insn.size
+    return result
+
+
+@pytest.mark.parametrize('cls', ARCHS)
+def test_same_as_one_by_one(cls, tmp_path):
+    patcher, size = make_patcher(cls)
+    expected = one_by_one(patcher, size)
+    assert patcher.disassemble_range(START, size) == expected
+    # without getbuffer() the range is read from the file
+    with open(tmp_path / 'rom.bin', 'wb+') as fp:
+        patcher, size = make_patcher(cls, fp)
+        fp.seek(0x20)
+        assert patcher.disassemble_range(START, size) == expected
+        assert fp.tell() == 0x20
+
+
+def test_min_opcodes_len():
+    patcher, _ = make_patcher(ThumbPatcher)
+    # the bl at +2 is not split
+    assert [patcher.get_min_opcodes_len(START, size) for size in (1, 2, 3, 4, 6, 7)] == [2, 2, 6, 6, 6, 8]
+    patcher, _ = make_patcher(ArmPatcher)
+    assert patcher.get_min_opcodes_len(START, 5) == 8
+
+
+@pytest.mark.parametrize('cls', ARCHS)
+def test_cache(cls):
+    patcher, size = make_patcher(cls)
+    first = patcher.disassemble_range(START, size)
+    assert decodes(patcher) == 1
+    # sub ranges are served from the cache
+    assert patcher.disassemble_range(START, size) == first
+    assert patcher.disassemble_range(first[1][0] - GBA_BASE, 2) == first[1:2]
+    assert decodes(patcher) == 1
+    # patched bytes are decoded again
+    patcher.assemble('mov r8, r8' if cls is ThumbPatcher else 'mov r2, r2', START)
+    assert patcher.disassemble_range(START, 1)[0][2:] == ('mov', 'r8, r8' if cls is ThumbPatcher else 'r2, r2')
+    assert decodes(patcher) == 2
+    patcher.clear_insn_cache()
+    patcher.disassemble_range(START, size)
+    assert decodes(patcher) == 3
+
+
+def test_invalid_instruction():
+    patcher, _ = make_patcher(ArmPatcher)
+    patcher.emit(b'\xff\xff\xff\xff', START)
+    with pytest.raises(ValueError):
+        patcher.disassemble_range(START, 4)
+
+
+@pytest.mark.parametrize('cls', ARCHS)
+def test_relocate_keeps_source(cls):
+    # the pc relative ldr is fixed up in the destination, the source is never written
+    patcher, size = make_patcher(cls)
+    source = patcher._io.getvalue()[START : START + size]
+    patcher.relocate_opcodes(size, START, 0x400)
+    assert patcher._io.getvalue()[START : START + size] == source
+    assert patcher.relocated == (START, START + size)
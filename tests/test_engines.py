@@ -0,0 +1,86 @@
+import io
+import os
+import subprocess
+import sys
+import threading
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE
+from bin_patch_kit.arm import ArmPatcher, ThumbPatcher
+from bin_patch_kit.base import CapstoneTable, EnginePool, lazy_import
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def test_pool():
+    pool = EnginePool()
+    assert pool.assembler(ARCH.ARM) is pool.assembler(ARCH.ARM)
+    assert pool.assembler(ARCH.ARM) is not pool.assembler(ARCH.ARM_THUMB)
+    plain, detail = pool.disassembler(ARCH.ARM), pool.disassembler(ARCH.ARM, detail=True)
+    assert plain is not detail and not plain.detail and detail.detail
+    assert pool.disassembler(ARCH.ARM, True) is detail
+    # one set per thread
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.assembler(ARCH.ARM)))
+    thread.start()
+    thread.join()
+    assert other[0] is not pool.assembler(ARCH.ARM)
+
+
+def test_shared_by_patchers():
+    buf = io.BytesIO(bytes(0x100))
+    first, second = ArmPatcher(buf, GBA_BASE), ArmPatcher(buf, GBA_BASE)
+    assert first._disassembler is second._disassembler is ENGINES.disassembler(ARCH.ARM)
+    assert ThumbPatcher(buf, GBA_BASE)._disassembler is ENGINES.disassembler(ARCH.ARM_THUMB)
+
+
+def test_threads():
+    # patchers in several threads at once, each on its own engines
+    expected = bytes(ENGINES.assembler(ARCH.ARM).asm('mov r0, r0; add r1, r1, #1', 0)[0])
+    results = []
+
+    def work():
+        buf = io.BytesIO(bytes(0x800))
+        patcher = ArmPatcher(buf, GBA_BASE)
+        for i in range(0, 0x800, 8):
+            patcher.assemble('mov r0, r0; add r1, r1, #1', i)
+        results.append(buf.getvalue() == expected * 0x100)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 4
+
+
+def test_capstone_table():
+    made = []
+
+    def make(arm_const):
+        made.append(arm_const)
+        return {arm_const.ARM_INS_MUL: 4}
+
+    table = CapstoneTable(make)
+    assert made == []
+    from capstone import arm_const
+
+    assert arm_const.ARM_INS_MUL in table and table[arm_const.ARM_INS_MUL] == 4
+    assert len(table) == 1 and list(table) == [arm_const.ARM_INS_MUL] and table.get(0, 'x') == 'x'
+    assert len(made) == 1
+
+
+def test_lazy_import():
+    assert lazy_import('no_such_module_here') is None
+    assert lazy_import('os') is os
+
+
+def test_package_import_is_lazy():
+    # in a new interpreter: nothing heavy on import, keystone/capstone on first use
+    code = (
+        'import sys, bin_patch_kit\n'
+        'print(sorted(m for m in ("keystone", "capstone", "elftools") if m in sys.modules))\n'
+        'bin_patch_kit.ENGINES.assembler(bin_patch_kit.ARCH.ARM)\n'
+        'print(sorted(m for m in ("keystone", "capstone", "elftools") if m in sys.modules))\n'
+    )
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, text=True)
+    assert output.splitlines() == ['[]', "['keystone']"]
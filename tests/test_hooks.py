@@ -0,0 +1,105 @@
+import io
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE
+from bin_patch_kit.analysis import REGISTERS_OFFSETS
+from bin_patch_kit.arm import ArmPatcher, Thumb2Patcher, ThumbPatcher
+
+pytest.importorskip('unicorn')
+from emulate import run  # noqa: E402
+
+ROM_SIZE = 0x3000
+FUNC = 0x200
+# the hooked code runs from START to STOP, r0 = 1 + 4 (func) + 2
+START, STOP = 0x100, 0x110
+CODE = {
+    'thumb': 'movs r0, #1; movs r2, #0; movs r2, #0; movs r2, #0; movs r2, #0; {call} {func}; adds r0, #2; b .',
+    'arm': 'mov r0, #1; mov r2, #0; {call} {func}; add r0, r0, #2; b .',
+}
+# at FUNC, in the instruction set of the code for a bl, the other one for a blx
+FUNC_CODE = {'thumb': 'adds r0, #4; bx lr', 'arm': 'add r0, r0, #4; bx lr'}
+# regs->r1 = 0x55, return 0
+HOOK_CODE = {
+    'thumb': f'movs r1, #0x55; str r1, [r0, #{REGISTERS_OFFSETS[1]}]; movs r0, #0; bx lr',
+    'arm': f'mov r1, #0x55; str r1, [r0, #{REGISTERS_OFFSETS[1]}]; mov r0, #0; bx lr',
+}
+PATCHERS = {'thumb': ThumbPatcher, 'thumb2': Thumb2Patcher, 'arm': ArmPatcher}
+KS_ARCH = {'thumb': ARCH.ARM_THUMB, 'arm': ARCH.ARM}
+
+HOOK_SITES = [
+    # a 2 bytes b over the bl, which is moved whole
+    ('thumb', 0x10A, 0x400),
+    # the far jump (0xC) ends in the middle of the bl
+    ('thumb', 0x100, 0x2000),
+    ('thumb2', 0x10A, 0x400),
+    # out of b.w range, the relocated calls go through literals
+    ('thumb2', 0x104, 0x1001000),
+    ('arm', 0x104, 0x400),
+    ('arm', 0x104, 0x2001000),
+]
+
+
+def state(arch):
+    return 'arm' if arch == 'arm' else 'thumb'
+
+
+def keystone(code_state, asm, address=0):
+    return bytes(ENGINES.assembler(KS_ARCH[code_state]).asm(asm, GBA_BASE + address)[0])
+
+
+def make_rom(arch, call='bl', size=ROM_SIZE):
+    rom = bytearray(size)
+    code_state = state(arch)
+    code = keystone(code_state, CODE[code_state].format(call=call, func=hex(GBA_BASE + FUNC)), START)
+    rom[START : START + len(code)] = code
+    func_state = code_state if call == 'bl' else {'arm': 'thumb', 'thumb': 'arm'}[code_state]
+    func = keystone(func_state, FUNC_CODE[func_state], FUNC)
+    rom[FUNC : FUNC + len(func)] = func
+    return rom
+
+
+def hooked(arch, hook_type, target, empty, call='bl', minimal_save=False, stub=None, code=None):
+    '''the rom with a hook (HOOK_CODE or `code`) at `target`, through a shared stub emitted at `stub` if given'''
+    buf = io.BytesIO(bytes(make_rom(arch, call, max(ROM_SIZE, empty + 0x1000))))
+    patcher = PATCHERS[arch](buf, GBA_BASE)
+    patcher.minimal_save = minimal_save
+    if stub is not None:
+        patcher.emit_shared_stub(hook_type, stub)
+        patcher.add_shared_stub(hook_type, stub)
+    method = patcher.set_hooker if hook_type == 'hook' else patcher.set_function_hooker
+    method(target, empty, code or keystone(state(arch), HOOK_CODE[state(arch)]))
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize('call', ['bl', 'blx'])
+def test_unhooked(call):
+    for arch in PATCHERS:
+        assert run(make_rom(arch, call), START, STOP, arch != 'arm')[:2] == [7, 0]
+
+
+@pytest.mark.parametrize('call', ['bl', 'blx'])
+@pytest.mark.parametrize('minimal_save', [False, True])
+@pytest.mark.parametrize('hook_type', ['hook', 'hook_func'])
+@pytest.mark.parametrize('arch, target, empty', HOOK_SITES)
+def test_hook_runs(arch, hook_type, target, empty, minimal_save, call):
+    rom = hooked(arch, hook_type, target, empty, call, minimal_save)
+    assert run(rom, START, STOP, arch != 'arm')[:2] == [7, 0x55]
+
+
+@pytest.mark.parametrize('call', ['bl', 'blx'])
+@pytest.mark.parametrize('hook_type', ['hook', 'hook_func'])
+@pytest.mark.parametrize('arch, target, empty', HOOK_SITES)
+def test_shared_hook_runs(arch, hook_type, target, empty, call):
+    rom = hooked(arch, hook_type, target, empty, call, stub=empty + 0x800)
+    assert run(rom, START, STOP, arch != 'arm')[:2] == [7, 0x55]
+
+
+@pytest.mark.parametrize('minimal_save', [False, True])
+@pytest.mark.parametrize('result, r0', [(0, 7), (1, 3)])
+@pytest.mark.parametrize('arch', PATCHERS)
+def test_hook_func_result(arch, result, r0, minimal_save):
+    # hooked at the entry of FUNC: 0 runs it, anything else returns to the caller
+    code = keystone(state(arch), f'movs r0, #{result}; bx lr' if arch != 'arm' else f'mov r0, #{result}; bx lr')
+    rom = hooked(arch, 'hook_func', FUNC, 0x400, minimal_save=minimal_save, code=code)
+    assert run(rom, START, STOP, arch != 'arm')[0] == r0
@@ -0,0 +1,111 @@
+from struct import pack, unpack_from
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE, ElfHelper, ElfLinker, LinkError
+from bin_patch_kit.link import ARM_VENEER, R_ARM_ABS32, R_ARM_CALL, R_ARM_THM_CALL, THUMB_VENEER
+from elf_object import SHF_EXECINSTR, STB_GLOBAL, STB_LOCAL, STT_FUNC, STT_NOTYPE, STT_OBJECT, write_object
+
+DRAW_TEXT = 0x08012345
+# bl with the REL addend -8/-4: the target is the symbol itself
+ARM_BL = 0xEBFFFFFE
+THUMB_BL = (0xF7FF, 0xFFFE)
+
+
+@pytest.fixture
+def hooks(tmp_path):
+    '''
+    main (arm) calls helper (arm), thumb_func and DrawText (the game's, thumb),
+    loads the address of message; thumb_func calls helper; unused is in a
+    section of its own nothing refers to
+    '''
+    main = pack('<6I', ARM_BL, ARM_BL, ARM_BL, 0xE59F0000, 0xE12FFF1E, 0)
+    helper = pack('<I', 0xE12FFF1E)
+    thumb_func = pack('<4H', *THUMB_BL, 0x4770, 0x46C0)
+    text = main + helper + thumb_func
+    path = str(tmp_path / 'hooks.o')
+    write_object(
+        path,
+        [
+            ('.text', text, SHF_EXECINSTR),
+            ('.text.unused', pack('<I', 0xE12FFF1E), SHF_EXECINSTR),
+            ('.rodata', b'hello\0\0\0', 0),
+        ],
+        [
+            ('$a', '.text', 0, 0, STB_LOCAL, STT_NOTYPE),
+            ('$d', '.text', 0x14, 0, STB_LOCAL, STT_NOTYPE),
+            ('$t', '.text', 0x1C, 0, STB_LOCAL, STT_NOTYPE),
+            ('main', '.text', 0, len(main), STB_GLOBAL, STT_FUNC),
+            ('helper', '.text', 0x18, 4, STB_GLOBAL, STT_FUNC),
+            ('thumb_func', '.text', 0x1C | 1, 8, STB_GLOBAL, STT_FUNC),
+            ('unused', '.text.unused', 0, 4, STB_GLOBAL, STT_FUNC),
+            ('message', '.rodata', 0, 6, STB_GLOBAL, STT_OBJECT),
+            ('DrawText', None, 0, 0, STB_GLOBAL, STT_NOTYPE),
+        ],
+        [
+            ('.text', 0x0, R_ARM_CALL, 'helper'),
+            ('.text', 0x4, R_ARM_CALL, 'thumb_func'),
+            ('.text', 0x8, R_ARM_CALL, 'DrawText'),
+            ('.text', 0x14, R_ARM_ABS32, 'message'),
+            ('.text', 0x1C, R_ARM_THM_CALL, 'helper'),
+        ],
+    )
+    with ElfHelper(path) as elf:
+        yield elf
+
+
+def branch_target(arch, data, offset, vma):
+    insn = next(ENGINES.disassembler(arch).disasm(data[offset : offset + 4], vma + offset))
+    assert insn.mnemonic == 'bl'
+    return int(insn.op_str.lstrip('#'), 16)
+
+
+def veneer_word(segment, target, thumb):
+    '''the target word of the veneer at `target`, checking its code'''
+    offset = target - segment['vma']
+    code = THUMB_VENEER if thumb else ARM_VENEER
+    assert segment['data'][offset : offset + len(code)] == code
+    return unpack_from('<I', segment['data'], offset + len(code))[0]
+
+
+def test_link(hooks):
+    linker = ElfLinker(hooks, GBA_BASE, symbols={'DrawText': DRAW_TEXT})
+    sections = linker.select(['main'])
+    assert [hooks.elf.get_section(index).name for index in sections] == ['.text', '.rodata']
+    segment = linker.place(sections, 0x1000)
+    (segment,) = linker.resolve()
+    data, vma = segment['data'], segment['vma']
+    assert vma == GBA_BASE + 0x1000
+    assert segment['size'] <= segment['reserved']
+    helper, _ = linker.address_of('helper')
+    thumb_func, thumb = linker.address_of('thumb_func')
+    message, _ = linker.address_of('message')
+    assert thumb and (helper, thumb_func) == (vma + 0x18, vma + 0x1C)
+    assert data[message - vma : message - vma + 6] == b'hello\0'
+
+    # arm to arm, direct
+    assert branch_target(ARCH.ARM, data, 0x0, vma) == helper
+    # arm to thumb and to the game's thumb function, through arm veneers
+    assert veneer_word(segment, branch_target(ARCH.ARM, data, 0x4, vma), False) == thumb_func | 1
+    assert veneer_word(segment, branch_target(ARCH.ARM, data, 0x8, vma), False) == DRAW_TEXT
+    assert unpack_from('<I', data, 0x14)[0] == message
+    # thumb to arm, a bl to a thumb veneer
+    assert veneer_word(segment, branch_target(ARCH.ARM_THUMB, data, 0x1C, vma), True) == helper
+    assert segment['veneers'] == 3
+
+
+def test_link_far(hooks):
+    # the game's function out of bl reach for arm code linked to ram
+    linker = ElfLinker(hooks, GBA_BASE, symbols={'DrawText': DRAW_TEXT & ~1})
+    linker.place(linker.select(['main']), 0x1000, vma=0x03007000, name='ram')
+    (segment,) = linker.resolve()
+    assert veneer_word(segment, branch_target(ARCH.ARM, segment['data'], 0x8, 0x03007000), False) == DRAW_TEXT & ~1
+
+
+def test_link_errors(hooks):
+    linker = ElfLinker(hooks, GBA_BASE)
+    with pytest.raises(LinkError):
+        linker.select(['missing'])
+    linker.place(linker.select(['main']), 0x1000)
+    with pytest.raises(LinkError, match='DrawText'):
+        linker.resolve()
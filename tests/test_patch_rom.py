@@ -0,0 +1,57 @@
+import struct
+
+import pytest
+
+from bin_patch_kit import GBA_BASE, PatchOptions, patch_rom
+
+# bx lr
+HOOK = struct.pack('<I', 0xE12FFF1E)
+JOBS = [
+    {'arch': 'arm', 'type': 'hook', 'address': 0x100, 'func': 'hook'},
+    {'arch': 'thumb', 'type': 'patch', 'address': 0x200, 'asm': 'mov r8, r8'},
+]
+
+
+@pytest.fixture
+def rom(tmp_path):
+    path = tmp_path / 'rom.gba'
+    # arm nops (mov r0, r0) then free space
+    path.write_bytes(struct.pack('<I', 0xE1A00000) * 0x400 + bytes(0x1000))
+    return path
+
+
+def test_options_or_keywords(tmp_path, rom):
+    outputs = []
+    for name, options, features in (
+        ('keywords', None, {'functions': {'hook': HOOK}, 'align': 0x20, 'shared_stubs': True}),
+        ('options', PatchOptions(functions={'hook': HOOK}, align=0x20, shared_stubs=True), {}),
+        # a keyword overrides the options
+        ('both', PatchOptions(functions={'hook': HOOK}, align=0x4, shared_stubs=True), {'align': 0x20}),
+    ):
+        output = tmp_path / f'{name}.gba'
+        report = patch_rom(str(rom), GBA_BASE, None, 0x1000, JOBS, str(output), options, **features)
+        outputs.append((output.read_bytes(), [entry['trampoline'] for entry in report.jobs[:1]], len(report.stubs)))
+    assert outputs[0] == outputs[1] == outputs[2]
+    # the shared stub comes first, the hook after it on the 0x20 alignment
+    assert outputs[0][1][0] > 0x1000 and outputs[0][1][0] % 0x20 == 0 and outputs[0][2] == 1
+
+
+def test_options():
+    options = PatchOptions(workers=4)
+    assert options.replace(xrefs='warn').xrefs == 'warn' and options.xrefs is None
+    assert repr(options) == 'PatchOptions(workers=4)'
+    with pytest.raises(TypeError):
+        options.replace(worker=4)
+    with pytest.raises(ValueError):
+        PatchOptions(manifest_path='out.manifest', patch_path='out.ips').check(JOBS)
+    with pytest.raises(ValueError):
+        PatchOptions(link=True).check(JOBS)
+    with pytest.raises(ValueError):
+        PatchOptions().check([{**JOBS[0], 'ram': True}])
+    PatchOptions(manifest_path='out.manifest', patch_path='out.ips').check(JOBS, output_path='out.gba')
+
+
+def test_unknown_keyword(tmp_path, rom):
+    with pytest.raises(TypeError):
+        patch_rom(str(rom), GBA_BASE, None, 0x1000, JOBS, str(tmp_path / 'out.gba'), minimal=True)
+    assert not (tmp_path / 'out.gba').exists()
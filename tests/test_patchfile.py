@@ -0,0 +1,81 @@
+import random
+
+import pytest
+
+from bin_patch_kit import apply_patch, diff_ranges, make_bps, make_ips, write_patch
+from bin_patch_kit.patchfile import IPS_EOF_OFFSET
+
+
+def edit(source, size=None):
+    '''a copy of `source` with scattered edits, a long run of one byte and one write at the IPS EOF offset'''
+    rnd = random.Random(len(source))
+    target = bytearray(source)
+    for _ in range(40):
+        start, length = rnd.randrange(len(target) - 0x100), rnd.randrange(1, 0x80)
+        target[start : start + length] = rnd.randbytes(length)
+    target[0x1000:0x1400] = b'\xff' * 0x400
+    if len(target) > IPS_EOF_OFFSET + 4:
+        target[IPS_EOF_OFFSET : IPS_EOF_OFFSET + 4] = b'\xaa\xbb\xcc\xdd'
+    if size is not None:
+        target = target[:size] + rnd.randbytes(max(size - len(target), 0))
+    return bytes(target)
+
+
+def source_rom(size):
+    rnd = random.Random(size)
+    return rnd.randbytes(size)
+
+
+@pytest.mark.parametrize('extension', ['ips', 'bps'])
+@pytest.mark.parametrize(
+    'size, target_size',
+    [(0x8000, None), (IPS_EOF_OFFSET + 0x100, None), (0x8000, 0x9000), (0x8000, 0x7000)],
+    ids=['same', 'eof offset', 'longer', 'shorter'],
+)
+def test_round_trip(tmp_path, extension, size, target_size):
+    source = source_rom(size)
+    target = edit(source, target_size)
+    rom, patch, out = tmp_path / 'rom.gba', tmp_path / f'hack.{extension}', tmp_path / 'out.gba'
+    rom.write_bytes(source)
+    write_patch(str(patch), source, target, diff_ranges(source, target))
+    apply_patch(str(patch), str(rom), str(out))
+    assert out.read_bytes() == target
+    assert rom.read_bytes() == source
+    # in place
+    apply_patch(str(patch), str(rom))
+    assert rom.read_bytes() == target
+
+
+def test_diff_ranges():
+    source = source_rom(0x3000)
+    target = bytearray(source)
+    target[0x10] ^= 1
+    target[0xFFF:0x1002] = bytes(b ^ 0xFF for b in target[0xFFF:0x1002])
+    assert diff_ranges(source, bytes(target)) == [(0x10, 0x11), (0xFFF, 0x1002)]
+    assert diff_ranges(source, source + b'xy') == [(0x3000, 0x3002)]
+    assert diff_ranges(source, source) == []
+
+
+def test_bps_checks(tmp_path):
+    source = source_rom(0x2000)
+    target = edit(source)
+    patch = bytearray(make_bps(source, target, diff_ranges(source, target)))
+    rom = tmp_path / 'rom.gba'
+    rom.write_bytes(source[:-1] + b'\0')
+    (tmp_path / 'hack.bps').write_bytes(patch)
+    with pytest.raises(ValueError):
+        apply_patch(str(tmp_path / 'hack.bps'), str(rom), str(tmp_path / 'out.gba'))
+    rom.write_bytes(source)
+    patch[-20] ^= 1
+    (tmp_path / 'hack.bps').write_bytes(patch)
+    with pytest.raises(ValueError):
+        apply_patch(str(tmp_path / 'hack.bps'), str(rom), str(tmp_path / 'out.gba'))
+
+
+def test_ips_limits():
+    target = bytes(0x1000010)
+    with pytest.raises(ValueError):
+        make_ips(target, [(0x1000000, 0x1000010)])
+    # the records stay under 64K
+    patch = make_ips(bytes(range(256)) * 0x200, [(0, 0x20000)])
+    assert patch.startswith(b'PATCH') and patch.endswith(b'EOF')
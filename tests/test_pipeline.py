@@ -0,0 +1,117 @@
+import io
+import os
+import time
+
+import pytest
+
+from bin_patch_kit import ARCH, ENGINES, GBA_BASE, patch_rom
+from bin_patch_kit.arm import ArmPatcher
+from bin_patch_kit.pipeline import ParallelPlanner, generate_hook
+from bin_patch_kit.session import PatchSession, RomBuffer
+from bin_patch_kit.space import SpaceAllocator
+
+# one function every 0x20 bytes, arm and thumb in turn, then 0xFF free space
+FUNCTION_SIZE = 0x20
+ARM_CODE = 'push {r4, lr}; mov r4, r0; add r0, r0, #1; cmp r0, #3; mov r1, #2; pop {r4, pc}'
+THUMB_CODE = 'push {r4, lr}; movs r4, r0; adds r0, #1; cmp r0, #3; movs r1, #2; pop {r4, pc}'
+FUNCTIONS = {'arm': 'mov r0, #0; bx lr', 'thumb': 'movs r0, #0; bx lr'}
+
+
+def assemble(arch, asm):
+    return bytes(ENGINES.assembler(ARCH.ARM if arch == 'arm' else ARCH.ARM_THUMB).asm(asm)[0])
+
+
+def make_rom(path, count, free=0x10000):
+    rom = bytearray()
+    for i in range(count):
+        code = assemble('arm', ARM_CODE) if i % 2 == 0 else assemble('thumb', THUMB_CODE)
+        rom += code + bytes(FUNCTION_SIZE - len(code))
+    code_end = len(rom)
+    rom += b'\xff' * free
+    path.write_bytes(rom)
+    return [(code_end, free)]
+
+
+def make_jobs(count):
+    jobs = []
+    for i in range(count):
+        arch = 'arm' if i % 2 == 0 else 'thumb'
+        jobs.append(
+            {'arch': arch, 'type': 'hook_func' if i % 3 else 'hook', 'address': i * FUNCTION_SIZE, 'func': arch}
+        )
+    return jobs
+
+
+def functions():
+    return {name: assemble(name, asm) for name, asm in FUNCTIONS.items()}
+
+
+def patch(tmp_path, name, jobs, regions, **features):
+    output = tmp_path / f'{name}.gba'
+    report = patch_rom(
+        str(tmp_path / 'rom.gba'), GBA_BASE, None, regions, jobs, str(output), functions=functions(), **features
+    )
+    return output.read_bytes(), [(entry.get('trampoline'), entry['size']) for entry in report.jobs]
+
+
+@pytest.mark.parametrize('features', [{}, {'shared_stubs': True}, {'minimal_save': True}, {'align': 0x20}])
+def test_same_as_serial(tmp_path, features):
+    regions = make_rom(tmp_path / 'rom.gba', 48)
+    jobs = make_jobs(48) + [{'arch': 'thumb', 'type': 'patch', 'address': 0x3E, 'asm': 'mov r8, r8'}]
+    serial = patch(tmp_path, 'serial', jobs, regions, **features)
+    assert patch(tmp_path, 'parallel', jobs, regions, workers=3, **features) == serial
+
+
+def test_dependency_falls_back(tmp_path, monkeypatch):
+    regions = make_rom(tmp_path / 'rom.gba', 8)
+    # the hook at 0x20 relocates the instruction written by the patch before it
+    jobs = [{'arch': 'thumb', 'type': 'patch', 'address': 0x20, 'asm': 'push {r4, r5, lr}'}] + make_jobs(8)
+    commits = []
+    commit = ParallelPlanner.commit
+    monkeypatch.setattr(ParallelPlanner, 'commit', lambda *args: commits.append(commit(*args)) or commits[-1])
+    serial = patch(tmp_path, 'serial', jobs, regions)
+    assert patch(tmp_path, 'parallel', jobs, regions, workers=2) == serial
+    assert commits == [None]
+
+
+def test_generate_hook_rolls_back():
+    rom = bytearray(0x1000)
+    rom[0x100:0x118] = assemble('arm', ARM_CODE)
+    buffer = RomBuffer(bytearray(rom))
+    patcher = ArmPatcher(buffer, GBA_BASE)
+    size, writes, read_range, path, relocated = generate_hook(patcher, 'hook_func', 0x100, 0x800, functions()['arm'])
+    assert bytes(buffer.getbuffer()) == rom and buffer.dirty_ranges() == []
+    assert read_range == relocated == (0x100, 0x104)
+    expected = io.BytesIO(bytes(rom))
+    assert ArmPatcher(expected, GBA_BASE).set_function_hooker(0x100, 0x800, functions()['arm']) == size
+    for start, data in writes:
+        rom[start : start + len(data)] = data
+    assert rom == expected.getvalue()
+    assert path[0] == (0x100, 0x104)
+
+
+def test_depends():
+    writes = [(0x10, b'ab', 0), (0x100, b'abcd', 2)]
+    assert ParallelPlanner._depends(writes, [((0x11, 0x13), 1)])
+    # written by a later job
+    assert not ParallelPlanner._depends(writes, [((0x100, 0x104), 1)])
+    assert not ParallelPlanner._depends(writes, [((0x12, 0x100), 1)])
+    assert ParallelPlanner._depends(writes, [((0x12, 0x100), 1), ((0xF0, 0x101), 3)])
+    assert not ParallelPlanner._depends([], [((0, 0x1000), 1)])
+
+
+@pytest.mark.skipif((os.cpu_count() or 1) < 2, reason='needs two cores')
+def test_pool_scales(tmp_path):
+    # the same plan, generated by one worker process and by two, see benchmarks/workers.py
+    regions = make_rom(tmp_path / 'rom.gba', 2000, free=0x80000)
+    jobs = make_jobs(2000)
+    elapsed = {}
+    plans = {}
+    for workers in (1, 2):
+        with PatchSession(str(tmp_path / 'rom.gba'), GBA_BASE) as session:
+            planner = ParallelPlanner(session, jobs, functions(), workers)
+            start = time.perf_counter()
+            plans[workers] = planner.plan(SpaceAllocator(regions))
+            elapsed[workers] = time.perf_counter() - start
+    assert plans[1] == plans[2]
+    assert elapsed[2] < elapsed[1] * 0.8, elapsed
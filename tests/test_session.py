@@ -0,0 +1,116 @@
+import pytest
+
+from bin_patch_kit import GBA_BASE
+from bin_patch_kit.session import PatchSession, RomBuffer, coalesce_ranges
+
+SIZE = 0x4000
+
+
+@pytest.fixture
+def rom(tmp_path):
+    path = tmp_path / 'rom.gba'
+    path.write_bytes(bytes(range(256)) * (SIZE // 256))
+    return path
+
+
+def test_coalesce_ranges():
+    assert coalesce_ranges([(8, 10), (0, 4), (4, 6), (2, 3), (12, 14), (13, 20)]) == [(0, 6), (8, 10), (12, 20)]
+    assert coalesce_ranges([]) == []
+
+
+def test_rom_buffer():
+    buffer = RomBuffer(bytearray(0x10))
+    buffer.seek(4)
+    buffer.write(b'\x01\x02')
+    buffer.write(b'\x03')
+    buffer.seek(-2, 2)
+    buffer.write(b'\x04\x05\x06')
+    # a bytearray grows, the write at the end is kept
+    assert len(buffer) == 0x11 and buffer.tell() == 0x11
+    assert buffer.dirty_ranges() == [(4, 7), (0xE, 0x11)]
+    buffer.seek(4)
+    assert buffer.read(3) == b'\x01\x02\x03' and buffer.read() == bytes(7) + b'\x04\x05\x06'
+    buffer.clear_dirty()
+    assert buffer.dirty_ranges() == []
+
+
+def test_rom_buffer_rollback():
+    buffer = RomBuffer(bytearray(0x10))
+    buffer.write(b'\xaa')
+    outer = buffer.checkpoint()
+    buffer.seek(2)
+    buffer.write(b'\xbb\xbb')
+    inner = buffer.checkpoint()
+    buffer.seek(0xF)
+    buffer.write(b'\xcc\xcc')
+    assert buffer.dirty_since(outer) == [(2, 4), (0xF, 0x11)]
+    assert buffer.original_since(outer) == [(2, b'\0\0'), (0xF, b'\0\xcc')]
+    buffer.rollback(inner)
+    assert len(buffer) == 0x10 and buffer.tell() == 4
+    buffer.release(outer)
+    assert bytes(buffer.getbuffer()) == b'\xaa\0\xbb\xbb' + bytes(12)
+    buffer.rollback(buffer.checkpoint())
+    assert buffer.dirty_ranges() == [(0, 1), (2, 4)]
+
+
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_commit_in_place(rom, use_mmap):
+    original = rom.read_bytes()
+    with PatchSession(str(rom), GBA_BASE, use_mmap=use_mmap) as session:
+        session.buffer.seek(0x100)
+        session.buffer.write(b'\xff' * 4)
+        session.buffer.seek(0x104)
+        session.buffer.write(b'\xee' * 4)
+        # nothing reaches the file before the commit
+        assert rom.read_bytes() == original
+        assert session.commit() == [(0x100, 0x108)]
+        assert session.commit() == []
+        session.buffer.seek(0x3000)
+        session.buffer.write(b'\xdd')
+    expected = bytearray(original)
+    expected[0x100:0x108] = b'\xff' * 4 + b'\xee' * 4
+    expected[0x3000] = 0xDD
+    assert rom.read_bytes() == expected
+
+
+def test_commit_to_output(tmp_path, rom):
+    original = rom.read_bytes()
+    output = tmp_path / 'out.gba'
+    output.write_bytes(b'stale')
+    with PatchSession(str(rom), GBA_BASE, str(output)) as session:
+        session.buffer.seek(0x10)
+        session.buffer.write(b'\x01')
+        session.commit()
+        session.buffer.seek(0x20)
+        session.buffer.write(b'\x02')
+    assert rom.read_bytes() == original
+    expected = bytearray(original)
+    expected[0x10], expected[0x20] = 1, 2
+    assert output.read_bytes() == expected
+
+
+def test_no_commit_on_error(rom):
+    original = rom.read_bytes()
+    with pytest.raises(RuntimeError):
+        with PatchSession(str(rom), GBA_BASE) as session:
+            session.buffer.write(b'\xff')
+            raise RuntimeError
+    assert rom.read_bytes() == original
+
+
+def test_mmap_write_out_of_range(rom):
+    with PatchSession(str(rom), GBA_BASE) as session:
+        session.buffer.seek(SIZE - 1)
+        with pytest.raises(IndexError):
+            session.buffer.write(b'\0\0')
+
+
+def test_shared_patchers(rom):
+    with PatchSession(str(rom), GBA_BASE, minimal_save=True) as session:
+        arm = session.patcher('arm')
+        assert session.patcher('arm') is arm and arm.minimal_save
+        size = session.patcher('thumb').assemble('mov r8, r8', 0x200)
+        arm.assemble('mov r0, r0', 0x204)
+        assert size == 2 and session.buffer.dirty_ranges() == [(0x200, 0x202), (0x204, 0x208)]
+        with pytest.raises(TypeError):
+            session.patcher('mips')
@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+from bin_patch_kit import space
+from bin_patch_kit.space import FreeSpaceIndex, SpaceAllocator, scan_free_space
+from bin_patch_kit.utils import find_empty_space
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def scanner(request, monkeypatch):
+    '''scan with the numpy run detection and with the regex one'''
+    if request.param == 'numpy':
+        if space.np is None:
+            pytest.skip('numpy is not installed')
+    else:
+        monkeypatch.setattr(space, 'np', None)
+    return request.param
+
+
+def naive_scan(buf, min_size, align, fills):
+    '''byte by byte reference of scan_free_space'''
+    regions = []
+    start = 0
+    for i in range(1, len(buf) + 1):
+        if i < len(buf) and buf[i] == buf[start]:
+            continue
+        if buf[start] in fills and i - start >= min_size:
+            pos = (start + align - 1) & -align
+            size = (i - pos) & -align
+            if size > 0:
+                regions.append((pos, size))
+        start = i
+    return regions
+
+
+def make_rom(seed=0, size=0x3000):
+    '''random code with runs of 0x00 and 0xFF of random lengths, some of them touching'''
+    rng = random.Random(seed)
+    rom = bytearray()
+    while len(rom) < size:
+        rom += bytes(rng.randrange(1, 0xFF) for _ in range(rng.randrange(1, 0x40)))
+        for _ in range(rng.randrange(1, 3)):
+            rom += bytes([rng.choice((0x00, 0xFF))]) * rng.randrange(1, 0x180)
+    return bytes(rom[:size])
+
+
+@pytest.mark.parametrize('chunk_size', [0x3, 0x40, 0x1000, 0x100000])
+@pytest.mark.parametrize('fill', [0x00, 0xFF, (0x00, 0xFF)])
+def test_same_as_naive(scanner, fill, chunk_size):
+    fills = space._normalize_fill(fill)
+    for seed in range(4):
+        rom = make_rom(seed)
+        found = scan_free_space(rom, min_size=0x40, align=0x10, fill=fill, chunk_size=chunk_size)
+        assert list(found) == naive_scan(rom, 0x40, 0x10, fills)
+
+
+def test_runs_across_chunks(scanner):
+    rom = b'\x01' * 0x30 + bytes(0x100) + b'\x01' * 0x10 + b'\xff' * 0x80 + bytes(0x80) + b'\x01'
+    # one run spans many chunks, the 0xFF and 0x00 runs touch but are not joined
+    assert list(scan_free_space(rom, min_size=0x80, fill=(0, 0xFF), chunk_size=0x20)) == [
+        (0x30, 0x100),
+        (0x140, 0x80),
+        (0x1C0, 0x80),
+    ]
+    # the same with a byte at each edge of a chunk
+    assert list(scan_free_space(rom, min_size=0x80, fill=(0, 0xFF), chunk_size=0x30)) == [
+        (0x30, 0x100),
+        (0x140, 0x80),
+        (0x1C0, 0x80),
+    ]
+
+
+def test_file(tmp_path, scanner):
+    rom = make_rom(1)
+    path = tmp_path / 'rom.gba'
+    path.write_bytes(rom)
+    assert list(scan_free_space(str(path), min_size=0x20, fill=0xFF, chunk_size=0x100)) == naive_scan(
+        rom, 0x20, 0x10, (0xFF,)
+    )
+    assert find_empty_space(str(path), min_size=0x20, fill=0xFF) == sorted(
+        naive_scan(rom, 0x20, 0x10, (0xFF,)), key=lambda x: x[1], reverse=True
+    )
+
+
+def test_free_space_index():
+    index = FreeSpaceIndex([(0x300, 0x40), (0x100, 0x100), (0x50, 0)])
+    assert len(index) == 2 and index.total() == 0x140
+    assert index.by_size() == [(0x100, 0x100), (0x300, 0x40)]
+    assert index.find(0x1FF) == (0x100, 0x100) and index.find(0x200) is None
+    assert index.in_range(0x180, 0x310) == [(0x100, 0x100), (0x300, 0x40)]
+    assert index.in_range(0x180, 0x310, min_size=0x80) == [(0x100, 0x100)]
+    assert index.nearest(0x2A0) == (0x300, 0x40)
+    assert index.nearest(0x2A0, min_size=0x80) == (0x100, 0x100)
+
+
+def test_allocator():
+    allocator = SpaceAllocator([(0x104, 0x100), (0x1000, 0x1000)], align=0x10)
+    assert list(allocator.free()) == [(0x110, 0xF0), (0x1000, 0x1000)]
+    # best fit first, all blocks are in range
+    assert allocator.candidates(0, 0x80, lambda address, near: True) == [0x110, 0x1000]
+    # near blocks before far ones
+    assert allocator.candidates(0, 0x80, lambda address, near: address >= 0x1000) == [0x1000, 0x110]
+    # below `near`, as close to it as possible
+    assert allocator.candidates(0x3000, 0x80) == [0x180, 0x1F80]
+    allocator.take(0x110, 0x21)
+    assert allocator.fits(0x140, 0xC0) and not allocator.fits(0x130, 0xD0)
+    with pytest.raises(ValueError):
+        allocator.take(0x120, 0x10)
+    allocator.reserve(0xFF0, 0x20)
+    assert list(allocator.free()) == [(0x140, 0xC0), (0x1010, 0xFF0)]
@@ -0,0 +1,92 @@
+import os
+import pickle
+
+import pytest
+
+from bin_patch_kit import ARCH, AsmCache, BranchIndex, PatchManifest
+from bin_patch_kit.elf import ElfHelper
+from elf_object import SHF_EXECINSTR, STB_GLOBAL, STT_FUNC, write_object
+
+RAN = []
+
+
+class Payload:
+    '''what a malicious pickle would do: run code when loaded'''
+
+    def __reduce__(self):
+        return RAN.append, ('payload',)
+
+
+@pytest.fixture
+def payload(tmp_path):
+    path = tmp_path / 'payload'
+    RAN.clear()
+    path.write_bytes(pickle.dumps(Payload()))
+    return str(path)
+
+
+def test_manifest(tmp_path, payload):
+    manifest = PatchManifest(0x08000000, digest='ab' * 20, source_digest=None)
+    manifest.stubs = [{'arch': 'arm', 'type': 'hook', 'address': 0x100, 'size': 0x40, 'writes': [(0x100, b'\xff' * 4)]}]
+    manifest.segments = [
+        {'name': 'rom', 'address': 0x200, 'vma': 0x08000200, 'size': 8, 'data': b'\1' * 8, 'digest': 'd', 'writes': []}
+    ]
+    manifest.add(
+        'key', {'arch': 'thumb', 'type': 'hook'}, (0x300, 0x20), [(0x40, b'\0\1')], (0x40, 0x48), [(1, 2)], (0x40, 0x44)
+    )
+    manifest.add('patch', {'arch': 'arm', 'type': 'patch'}, (None, 4), [(0x50, b'\0' * 4)])
+    path = str(tmp_path / 'out.manifest')
+    manifest.save(path)
+    loaded = PatchManifest.load(path)
+    assert loaded.entries == manifest.entries
+    assert (loaded.stubs, loaded.segments, loaded.base, loaded.digest) == (
+        manifest.stubs,
+        manifest.segments,
+        manifest.base,
+        manifest.digest,
+    )
+    assert PatchManifest.load(payload) is None and not RAN
+    assert PatchManifest.load(str(tmp_path / 'missing')) is None
+
+
+def test_asm_cache(tmp_path, payload):
+    path = str(tmp_path / 'asm.cache')
+    cache = AsmCache(path)
+    key = cache.make_key(ARCH.ARM, 'bl 0x8000800', 0x08000100)
+    cache.put(key, b'\xbe\x01\x00\xeb')
+    cache.put(cache.make_key(ARCH.ARM, 'bx lr', 0), b'\x1e\xff\x2f\xe1')
+    cache.save()
+    assert AsmCache(path).items() == cache.items()
+    assert len(AsmCache(payload)) == 0 and not RAN
+
+
+def test_elf_index(tmp_path, payload):
+    elf_path = str(tmp_path / 'hooks.o')
+    write_object(elf_path, [('.text', b'\0' * 12, SHF_EXECINSTR)], [('hook', '.text', 4 | 1, 8, STB_GLOBAL, STT_FUNC)])
+    cache_path = str(tmp_path / 'hooks.index')
+    with ElfHelper(elf_path, cache_path=cache_path) as elf:
+        index = elf.index
+    assert os.path.exists(cache_path)
+    with ElfHelper(elf_path, cache_path=cache_path) as elf:
+        # from the cache, pyelftools is not used
+        assert elf.index == index and elf._elf is None
+        assert elf.is_thumb('hook') and elf.get_size('hook') == 8
+    with ElfHelper(elf_path, cache_path=payload) as elf:
+        assert elf.index == index and not RAN
+
+
+def test_branch_index(tmp_path, payload):
+    # bl to 0x100 at 0x0 (arm), b to 0x0 at 0x100 (thumb)
+    rom = bytearray(0x200)
+    rom[0:4] = (0xEB00003E).to_bytes(4, 'little')
+    rom[0x100:0x102] = (0xE77E).to_bytes(2, 'little')
+    path = str(tmp_path / 'rom.xref')
+    index = BranchIndex.cached(rom, path, [(0, 0x200)])
+    loaded = BranchIndex.load(path)
+    assert (loaded.targets, loaded.sources, loaded.flags) == (index.targets, index.sources, index.flags)
+    assert (loaded.digest, loaded.regions) == (index.digest, [(0, 0x200)])
+    assert BranchIndex.cached(rom, path, [(0, 0x200)]).targets == index.targets
+    assert BranchIndex.load(payload) is None and not RAN
+    with open(path, 'r+b') as fp:
+        fp.truncate(os.path.getsize(path) - 1)
+    assert BranchIndex.load(path) is None
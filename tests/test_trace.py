@@ -0,0 +1,99 @@
+import json
+import struct
+
+from bin_patch_kit import GBA_BASE, PatchTracer, patch_rom
+from bin_patch_kit.arm import ArmPatcher, ThumbPatcher
+from bin_patch_kit.cache import AsmCache
+from bin_patch_kit.session import RomBuffer
+
+# bx lr
+HOOK = struct.pack('<I', 0xE12FFF1E)
+
+
+def traced(emissions=True):
+    tracer = PatchTracer(emissions=emissions)
+    buffer = RomBuffer(bytearray(0x1000))
+    buffer.tracer = tracer
+    return tracer, buffer
+
+
+def test_counters():
+    tracer, buffer = traced(emissions=False)
+    cache = AsmCache()
+    arm = ArmPatcher(buffer, GBA_BASE, asm_cache=cache, tracer=tracer)
+    thumb = ThumbPatcher(buffer, GBA_BASE, asm_cache=cache, tracer=tracer)
+    tracer.begin_job(0, type='patch')
+    arm.assemble('mov r0, r0', 0x100)
+    arm.assemble('mov r0, r0', 0x104)
+    tracer.end_job()
+    tracer.begin_job(1, type='patch')
+    thumb.assemble('mov r8, r8', 0x200)
+    thumb.disassemble_range(0x200, 2)
+    tracer.end_job()
+    arm = tracer.counters[('ArmPatcher', 0)]
+    assert (arm['keystone'], arm['asm_cache_hits'], arm['writes'], arm['bytes_written']) == (1, 1, 2, 8)
+    assert arm['seeks'] >= 2 and arm['keystone_time'] > 0
+    thumb = tracer.counters[('ThumbPatcher', 1)]
+    assert (thumb['keystone'], thumb['capstone'], thumb['bytes_written']) == (1, 1, 2)
+    assert tracer.totals()['ArmPatcher']['bytes_written'] == 8
+    assert tracer.totals('job') == {0: arm, 1: thumb}
+    assert tracer.events == []
+
+
+def test_emissions():
+    tracer, buffer = traced()
+    patcher = ArmPatcher(buffer, GBA_BASE, tracer=tracer)
+    tracer.begin_job(0, type='patch')
+    patcher.assemble('mov r0, r0', 0x100)
+    patcher.emit_word(0x12345678, 0x104)
+    mark = buffer.checkpoint()
+    patcher.assemble('mov r1, r1', 0x200)
+    buffer.rollback(mark)
+    # overwritten, only the last write is final
+    patcher.assemble('mov r2, r2', 0x100)
+    tracer.end_job()
+    base = GBA_BASE
+    assert [(address - base, text) for address, _, text, _, _, _ in tracer.events] == [
+        (0x100, 'mov r0, r0'),
+        (0x104, '.word 0x12345678'),
+        (0x100, 'mov r2, r2'),
+    ]
+    assert [(address - base, text) for address, _, text, _, _, _ in tracer.final_events()] == [
+        (0x100, 'mov r2, r2'),
+        (0x104, '.word 0x12345678'),
+    ]
+    assert tracer.to_sym() == '08000100 job0_patch\n08000100 .arm\n08000104 .wrd:0004\n08000108 .arm\n'
+    assert tracer.to_listing().splitlines() == [
+        '08000100  0220a0e1          mov r2, r2                                ; job0_patch',
+        '08000104  78563412          .word 0x12345678                          ; job0_patch',
+    ]
+
+
+def test_patch_rom(tmp_path):
+    rom = tmp_path / 'rom.gba'
+    # arm nops (mov r0, r0) then free space
+    rom.write_bytes(struct.pack('<I', 0xE1A00000) * 0x400 + bytes(0x1000))
+    jobs = [
+        {'arch': 'arm', 'type': 'hook', 'address': 0x100, 'func': 'hook'},
+        {'arch': 'arm', 'type': 'hook_func', 'address': 0x200, 'func': 'hook'},
+        {'arch': 'thumb', 'type': 'patch', 'address': 0x300, 'asm': 'mov r8, r8'},
+    ]
+    tracer = PatchTracer(emissions=True)
+    # a tracer keeps patch_rom serial
+    report = patch_rom(
+        str(rom), GBA_BASE, None, 0x1000, jobs, str(tmp_path / 'out.gba'), functions={'hook': HOOK}, tracer=tracer
+    )
+    assert set(tracer.jobs) == {0, 1, 2} and tracer.jobs[0]['func'] == 'hook'
+    by_job = tracer.totals('job')
+    assert by_job[2]['keystone'] + by_job[2]['asm_cache_hits'] == 1
+    space = dict(tracer.space_by_job())
+    for entry in report.jobs:
+        if entry['type'] != 'patch':
+            # the trampoline and the jump to it
+            assert space[entry['index']] == entry['size'] + entry['overwritten']
+    assert space[2] == 2
+    listing = tracer.to_listing()
+    assert all(f'job{index}_' in listing for index in range(3))
+    data = json.loads(tracer.to_json(str(tmp_path / 'trace.json')))
+    assert set(data['by_job']) == {'0', '1', '2'} and len(data['emissions']) == len(tracer.events)
+    assert json.loads((tmp_path / 'trace.json').read_text()) == data
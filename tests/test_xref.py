@@ -0,0 +1,69 @@
+import struct
+
+import pytest
+
+from bin_patch_kit import BranchIndex, xref
+from bin_patch_kit.xref import LINK, SOURCE_THUMB, TARGET_THUMB
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def sweep(request, monkeypatch):
+    '''build with the numpy sweep and with the pure-python one'''
+    if request.param == 'numpy':
+        if xref.np is None:
+            pytest.skip('numpy is not installed')
+    else:
+        monkeypatch.setattr(xref, 'np', None)
+    return request.param
+
+
+def make_rom():
+    '''a thumb loop at 0x40 and an arm loop at 0x100, each branching back into its own site'''
+    rom = bytearray(0x200)
+    # movs r0, #0; adds r0, #1; cmp r0, #10; bne #0x42
+    struct.pack_into('<4H', rom, 0x40, 0x2000, 0x3001, 0x280A, 0xD1FC)
+    # b #0x40
+    struct.pack_into('<H', rom, 0x80, 0xE7DE)
+    # mov r0, #0; add r0, r0, #1; cmp r0, #10; bne #0x104
+    struct.pack_into('<4I', rom, 0x100, 0xE3A00000, 0xE2800001, 0xE350000A, 0x1AFFFFFC)
+    return rom
+
+
+def test_thumb_loop(sweep):
+    index = BranchIndex.build(make_rom())
+    assert index.sources_of(0x42) == [(0x46, SOURCE_THUMB | TARGET_THUMB)]
+    assert index.sources_of(0x40) == [(0x80, SOURCE_THUMB | TARGET_THUMB)]
+    assert index.into(0x40, 0x4C, True) == [(0x46, 0x42)]
+    # not an arm site
+    assert index.into(0x40, 0x4C, False) == []
+
+
+def test_arm_loop(sweep):
+    index = BranchIndex.build(make_rom())
+    assert index.sources_of(0x104) == [(0x10C, 0)]
+    assert index.into(0x100, 0x110, False) == [(0x10C, 0x104)]
+    assert index.into(0x100, 0x110, True) == []
+
+
+def test_links(sweep):
+    rom = bytearray(0x100)
+    # arm bl #0x80, arm blx #0x82, thumb bl #0x80, thumb blx #0x80
+    struct.pack_into('<2I', rom, 0, 0xEB00001E, 0xFB00001D)
+    struct.pack_into('<4H', rom, 0x10, 0xF000, 0xF836, 0xF000, 0xE834)
+    index = BranchIndex.build(rom)
+    assert sorted(index.sources_of(0x80)) == [
+        (0, LINK),
+        (0x10, SOURCE_THUMB | TARGET_THUMB | LINK),
+        (0x14, SOURCE_THUMB | LINK),
+    ]
+    assert index.sources_of(0x82) == [(4, TARGET_THUMB | LINK)]
+
+
+def test_sweeps_agree(monkeypatch):
+    if xref.np is None:
+        pytest.skip('numpy is not installed')
+    rom = bytes(range(256)) * 0x40 + make_rom()
+    expected = BranchIndex.build(rom, [(0, 0x3000), (0x3001, len(rom))])
+    monkeypatch.setattr(xref, 'np', None)
+    index = BranchIndex.build(rom, [(0, 0x3000), (0x3001, len(rom))])
+    assert (index.targets, index.sources, index.flags) == (expected.targets, expected.sources, expected.flags)